@@ -1,8 +1,10 @@
 import argparse
 import json
+import time
 
 from cron_tools.agent.config import AgentConfiguration
-from cron_tools.common.rpc_client import RPCClient
+from cron_tools.common.output import decode_output_chunk
+from cron_tools.common.rpc_client import MultiplexedRPCClient
 
 agent_admin_argument_parser = argparse.ArgumentParser()
 agent_admin_argument_parser.add_argument("-v", "--verbose", action="store_true", help="Extra verbose output.")
@@ -10,12 +12,20 @@ agent_admin_argument_parser.add_argument("-j", "--json-output", action="store_tr
 agent_admin_argument_parser.add_argument(
     "-f", "--config-file", default=None, type=str, help="The agent configuration file."
 )
+agent_admin_argument_parser.add_argument(
+    "-t", "--timeout", default=10.0, type=float, help="Seconds to wait for the agent to connect and answer."
+)
 subparsers = agent_admin_argument_parser.add_subparsers(title='command', dest='command')
 
 show_active_jobs_parser = subparsers.add_parser('show-active-jobs')
+show_active_jobs_parser.add_argument(
+    "--output-tail", default=0, type=int, help="Also show up to this many of the last bytes of each job's output."
+)
 
 ping_agent_parser = subparsers.add_parser("ping-agent")
 
+rpc_stats_parser = subparsers.add_parser("rpc-stats")
+
 
 def main(args=None, config=None):
     args = args or agent_admin_argument_parser.parse_args()
@@ -26,12 +36,98 @@ def main(args=None, config=None):
     else:
         config = AgentConfiguration.default()
 
-    rpc_client = RPCClient(config.listen_socket_path)
+    rpc_client = MultiplexedRPCClient(config.listen_socket_path, timeout=args.timeout, reconnect_attempts=3)
     rpc_client.connect()
-    if args.command == "show-active-jobs":
-        pass
-    elif args.command == "ping-agent":
-        if args.json_output:
-            print(json.dumps(rpc_client.handle_rpc_call('ping', {})))
-        else:
-            print(rpc_client.handle_rpc_call('ping', {})['response'])
+    try:
+        if args.command == "show-active-jobs":
+            show_active_jobs(rpc_client, args)
+        elif args.command == "rpc-stats":
+            show_rpc_stats(rpc_client, args)
+        elif args.command == "ping-agent":
+            if args.json_output:
+                print(json.dumps(rpc_client.handle_rpc_call('ping', {})))
+            else:
+                print(rpc_client.handle_rpc_call('ping', {})['response'])
+    finally:
+        rpc_client.disconnect()
+
+
+def output_tail(chunks, tail_bytes):
+    """
+    The last tail_bytes of each stream of a job's output, from its get_job_output chunks.
+    """
+    streams = {}
+    for chunk in sorted(chunks, key=lambda c: c['sequence_number']):
+        streams.setdefault(chunk['stream_name'], []).append(decode_output_chunk(chunk['data']))
+    return dict(
+        (stream_name, b"".join(data)[-tail_bytes:].decode('utf-8', 'replace'))
+        for stream_name, data in streams.items()
+    )
+
+
+def show_active_jobs(rpc_client, args):
+    active_jobs = rpc_client.handle_rpc_call('get_active_jobs', {})['active_jobs']
+    if args.output_tail > 0:
+        # The output of every job is asked for at once over the one connection, and arrives as the agent reads it.
+        outputs = rpc_client.map_rpc_calls([
+            ('get_job_output', {'job_uuid': job['job_uuid']}) for job in active_jobs
+        ])
+        for job, output in zip(active_jobs, outputs):
+            job['job_output_tail'] = output_tail(output['chunks'], args.output_tail)
+    if args.json_output:
+        print(json.dumps(active_jobs))
+        return
+    now = time.time()
+    for job in active_jobs:
+        heartbeat_age = job['job_last_heartbeat_age_seconds']
+        print("{0} {1} on {2}: running {3:.0f}s, last heartbeat {4}".format(
+            job['job_uuid'], job['job_name'], job['job_host'], now - job['job_start_time_utc_epoch_seconds'],
+            "{0:.0f}s ago".format(heartbeat_age) if heartbeat_age is not None else "never"
+        ))
+        for stream_name, tail in sorted(job.get('job_output_tail', {}).items()):
+            print("  {0}:".format(stream_name))
+            for line in tail.splitlines():
+                print("    " + line)
+
+
+def format_seconds(seconds):
+    if seconds is None:
+        return "-"
+    elif seconds < 0.001:
+        return "{0:.0f}us".format(seconds * 1000000)
+    elif seconds < 1:
+        return "{0:.1f}ms".format(seconds * 1000)
+    return "{0:.2f}s".format(seconds)
+
+
+def show_rpc_stats(rpc_client, args):
+    stats = rpc_client.handle_rpc_call('get_rpc_stats', {})
+    if args.json_output:
+        print(json.dumps(stats))
+        return
+    print("{0:<36} {1:>9} {2:>7} {3:>8} {4:>9} {5:>9} {6:>9} {7:>9} {8:>12} {9:>12}".format(
+        "method", "calls", "errors", "running", "p50", "p90", "p99", "max", "bytes in", "bytes out"
+    ))
+    for name, method in sorted(stats['methods'].items()):
+        print("{0:<36} {1:>9} {2:>7} {3:>8} {4:>9} {5:>9} {6:>9} {7:>9} {8:>12} {9:>12}".format(
+            name, method['calls'], method['errors'], method['in_flight'], format_seconds(method['p50_seconds']),
+            format_seconds(method['p90_seconds']), format_seconds(method['p99_seconds']),
+            format_seconds(method['max_seconds']), method['request_bytes'], method['response_bytes']
+        ))
+    admission = stats.get('admission')
+    if admission is not None:
+        print("")
+        print("{0} connections open, {1} connections shed, {2} requests shed, {3} requests queued for {4}".format(
+            admission['connections'], admission['connections_shed'], admission['requests_shed'],
+            admission['requests_queued'], format_seconds(admission['queued_seconds'])
+        ))
+        for uid, shed in sorted(admission['shed_by_uid'].items()):
+            print("  uid {0}: {1} connections open, {2} shed".format(
+                uid, admission['connections_by_uid'].get(uid, 0), shed
+            ))
+    group_commit = stats.get('group_commit')
+    if group_commit is not None and group_commit['batches']:
+        print("{0} writes group committed in {1} transactions, {2:.1f} on average and at most {3}".format(
+            group_commit['operations'], group_commit['batches'], group_commit['mean_batch_operations'],
+            group_commit['largest_batch_operations']
+        ))
@@ -0,0 +1,213 @@
+"""
+Admission control for the agent RPC server: peers are told apart by the uid the kernel reports for them
+(SO_PEERCRED on connections, SCM_CREDENTIALS on datagrams), so that one user's runaway jobs cannot take every
+connection and all the request throughput from everybody else's.
+"""
+import collections
+import logging
+import socket
+import struct
+import threading
+import time
+
+from cron_tools.common.config import ConfigurationException
+
+admission_logger = logging.getLogger(__name__)
+
+monotonic = getattr(time, 'monotonic', time.time)
+
+# struct ucred: pid, uid and gid of the process on the other end.
+UCRED = struct.Struct('3i')
+SO_PEERCRED = getattr(socket, 'SO_PEERCRED', None)
+SO_PASSCRED = getattr(socket, 'SO_PASSCRED', None)
+SCM_CREDENTIALS = getattr(socket, 'SCM_CREDENTIALS', None)
+
+PeerCredentials = collections.namedtuple('PeerCredentials', ('pid', 'uid', 'gid'))
+
+# A peer shed again within this many seconds is not logged about again.
+SHED_LOG_INTERVAL_SECONDS = 60.0
+
+
+def peer_credentials(sock):
+    """
+    The credentials of the process connected to a unix socket, or None where the platform cannot tell.
+    """
+    if SO_PEERCRED is None:
+        return None
+    try:
+        return PeerCredentials(*UCRED.unpack(sock.getsockopt(socket.SOL_SOCKET, SO_PEERCRED, UCRED.size)))
+    except (socket.error, OSError, struct.error):
+        return None
+
+
+def peer_uid(credentials):
+    return credentials.uid if credentials is not None else None
+
+
+def enable_datagram_credentials(sock):
+    """
+    Have the kernel attach the sender's credentials to every datagram received on sock (see receive_datagram).
+    """
+    if SO_PASSCRED is not None and hasattr(sock, 'recvmsg'):
+        sock.setsockopt(socket.SOL_SOCKET, SO_PASSCRED, 1)
+
+
+def receive_datagram(sock, size):
+    """
+    Receive one datagram of up to size bytes, returning it along with the credentials of its sender (None if the
+    platform cannot tell).
+    """
+    if SCM_CREDENTIALS is None or not hasattr(sock, 'recvmsg'):
+        return sock.recv(size), None
+    data, ancillary_data, _, _ = sock.recvmsg(size, socket.CMSG_SPACE(UCRED.size))
+    for level, message_type, message_data in ancillary_data:
+        if level == socket.SOL_SOCKET and message_type == SCM_CREDENTIALS and len(message_data) >= UCRED.size:
+            return data, PeerCredentials(*UCRED.unpack(message_data[:UCRED.size]))
+    return data, None
+
+
+class TokenBucket(object):
+    """
+    Allows rate requests per second on average and bursts of up to capacity. A request may take a token that has not
+    been refilled yet, which puts the bucket in debt and tells the request how long to wait until it is paid off.
+    Not thread safe, AdmissionController locks around it.
+    """
+
+    def __init__(self, rate, capacity, now):
+        self.rate = float(rate)
+        self.capacity = max(1.0, float(capacity))
+        self.tokens = self.capacity
+        self.updated = now
+
+    def reserve(self, now):
+        self.tokens = min(self.capacity, self.tokens + max(0.0, now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return max(0.0, -self.tokens / self.rate)
+
+    def cancel(self):
+        self.tokens += 1
+
+
+class AdmissionController(object):
+    """
+    Enforces limits on concurrent connections and request rates, each of them global and per peer uid; a limit of
+    None is no limit. A request over the rate limit is queued (held back) if its token comes within
+    max_queue_seconds, otherwise it is shed, as are all requests on a connection over the connection limits.
+    Rates allow bursts of burst_seconds worth of requests.
+    """
+
+    LIMITS = (
+        'max_connections', 'max_connections_per_uid', 'requests_per_second', 'requests_per_second_per_uid',
+        'burst_seconds', 'max_queue_seconds'
+    )
+
+    def __init__(self, max_connections=None, max_connections_per_uid=None, requests_per_second=None,
+                 requests_per_second_per_uid=None, burst_seconds=1.0, max_queue_seconds=0.5):
+        self.max_connections = max_connections
+        self.max_connections_per_uid = max_connections_per_uid
+        self.requests_per_second = requests_per_second
+        self.requests_per_second_per_uid = requests_per_second_per_uid
+        self.burst_seconds = burst_seconds
+        self.max_queue_seconds = max_queue_seconds
+        self._lock = threading.Lock()
+        self._connections = 0
+        self._connections_by_uid = {}
+        self._bucket = None
+        self._buckets_by_uid = {}
+        self._last_shed_times = {}
+        self.connections_shed = 0
+        self.requests_queued = 0
+        self.requests_shed = 0
+        self.queued_seconds = 0.0
+        self._shed_by_uid = {}
+
+    @classmethod
+    def from_config(cls, admission_control):
+        unknown = sorted(set(admission_control) - set(cls.LIMITS))
+        if unknown:
+            raise ConfigurationException("Unknown admission_control settings: {0}".format(", ".join(unknown)))
+        return cls(**admission_control)
+
+    @property
+    def limits_requests(self):
+        return self.requests_per_second is not None or self.requests_per_second_per_uid is not None
+
+    def _shed(self, uid, what, now):
+        self._shed_by_uid[uid] = self._shed_by_uid.get(uid, 0) + 1
+        last_shed_time = self._last_shed_times.get(uid)
+        self._last_shed_times[uid] = now
+        if last_shed_time is None or now - last_shed_time > SHED_LOG_INTERVAL_SECONDS:
+            admission_logger.warning("Shedding {0} from uid {1}, it is over the agent's limits.".format(what, uid))
+
+    def connection_opened(self, uid):
+        """
+        Count a new connection from uid, returning False (and counting nothing) if it is over the limits.
+        """
+        with self._lock:
+            uid_connections = self._connections_by_uid.get(uid, 0)
+            if (self.max_connections is not None and self._connections >= self.max_connections) or \
+                    (self.max_connections_per_uid is not None and uid_connections >= self.max_connections_per_uid):
+                self.connections_shed += 1
+                self._shed(uid, "a connection", monotonic())
+                return False
+            self._connections += 1
+            self._connections_by_uid[uid] = uid_connections + 1
+            return True
+
+    def connection_closed(self, uid):
+        with self._lock:
+            self._connections -= 1
+            remaining = self._connections_by_uid.get(uid, 1) - 1
+            if remaining > 0:
+                self._connections_by_uid[uid] = remaining
+            else:
+                self._connections_by_uid.pop(uid, None)
+
+    def request_delay(self, uid, queue=True):
+        """
+        The seconds a request from uid should be held back before it is handled, or None if it is to be shed.
+        Without queue, any request that would have to wait is shed.
+        """
+        if not self.limits_requests:
+            return 0.0
+        now = monotonic()
+        max_delay = self.max_queue_seconds if queue else 0.0
+        with self._lock:
+            buckets = []
+            if self.requests_per_second is not None:
+                if self._bucket is None:
+                    self._bucket = TokenBucket(
+                        self.requests_per_second, self.requests_per_second * self.burst_seconds, now
+                    )
+                buckets.append(self._bucket)
+            if self.requests_per_second_per_uid is not None:
+                bucket = self._buckets_by_uid.get(uid)
+                if bucket is None:
+                    bucket = self._buckets_by_uid[uid] = TokenBucket(
+                        self.requests_per_second_per_uid, self.requests_per_second_per_uid * self.burst_seconds, now
+                    )
+                buckets.append(bucket)
+            delay = max([bucket.reserve(now) for bucket in buckets])
+            if delay > max_delay:
+                for bucket in buckets:
+                    bucket.cancel()
+                self.requests_shed += 1
+                self._shed(uid, "requests", now)
+                return None
+            if delay > 0:
+                self.requests_queued += 1
+                self.queued_seconds += delay
+            return delay
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'connections': self._connections,
+                'connections_by_uid': dict((str(uid), count) for uid, count in self._connections_by_uid.items()),
+                'connections_shed': self.connections_shed,
+                'requests_queued': self.requests_queued,
+                'queued_seconds': self.queued_seconds,
+                'requests_shed': self.requests_shed,
+                'shed_by_uid': dict((str(uid), count) for uid, count in self._shed_by_uid.items())
+            }
@@ -1,18 +1,95 @@
 import argparse
+import socket
+import sys
 import time
 import signal
+import logging
 from threading import Thread, Event
 
+from cron_tools.agent.admission import AdmissionController
 from cron_tools.agent.config import AgentConfiguration
+from cron_tools.common.config import ConfigurationException
 from cron_tools.agent.rpc_server import AgentUnixStreamRPCServer, attach_agent_functions
+from cron_tools.agent.group_commit import GroupCommitWriter, run_write
+from cron_tools.agent.heartbeats import HeartbeatCoalescer
+from cron_tools.agent.stagger import StartSlotAllocator
+from cron_tools.agent.storage import storage_pragmas, checkpoint_wal
 from cron_tools.agent.queries import SimpleConnectionPool, write_schema, remove_old_jobs, get_key_value_pair, \
-    immediate_transaction_manager
+    immediate_transaction_manager, apply_journal_events
+from cron_tools.common.journal import EventJournal
+from cron_tools.common.output import remove_old_spool_files
 
 agent_argument_parser = argparse.ArgumentParser()
 agent_argument_parser.add_argument(
     "-f", "--config-file", type=str, default=None, help="JSON Configuration file for the agent."
 )
 
+agent_logger = logging.getLogger(__name__)
+
+
+def ingest_journal(connection_pool, journal, writer=None):
+    """
+    Apply every event in the wrapper fallback journal in a single transaction (through the group commit writer, if
+    given), then truncate the journal. Each event is applied in a savepoint of its own; one that fails is rolled back
+    and quarantined, the rest still go in.
+    """
+    def apply_events(t):
+        quarantined = 0
+        for event in events:
+            try:
+                with immediate_transaction_manager(t) as savepoint:
+                    apply_journal_events(savepoint, [event])
+            except Exception:
+                agent_logger.exception("Unable to apply an event from the journal {0}".format(journal.path))
+                journal.quarantine(event)
+                quarantined += 1
+        return quarantined
+
+    with journal.drain() as events:
+        quarantined = run_write(writer, connection_pool, apply_events) if events else 0
+    return len(events) - quarantined
+
+
+def remove_expired_jobs(transaction, clean_up_policy):
+    last_replicated_sequence_number = get_key_value_pair(
+        transaction, 'REPLICATION_LAST_SUCCESSFUL_SEQ_NUMBER', -1
+    )
+    remove_old_jobs(transaction, clean_up_policy['replicated']['min_age_hours'], last_replicated_sequence_number)
+    remove_old_jobs(transaction, clean_up_policy['unreplicated']['min_age_hours'])
+
+
+RPC_SERVER_MODE_AUTO = 'auto'
+RPC_SERVER_MODE_THREADING = 'threading'
+RPC_SERVER_MODE_ASYNCIO = 'asyncio'
+
+
+def build_rpc_server(config):
+    """
+    The asyncio server multiplexes every connection on one event loop; the threading server, which runs a thread per
+    connection, remains for Python 2.7 (and older Python 3 releases).
+    """
+    mode = config.rpc_server_mode
+    if mode == RPC_SERVER_MODE_AUTO:
+        mode = RPC_SERVER_MODE_ASYNCIO if sys.version_info >= (3, 7) else RPC_SERVER_MODE_THREADING
+    admission = AdmissionController.from_config(dict(
+        AgentConfiguration.OPTIONAL_PARAMETERS['admission_control'], **(config.admission_control or {})
+    ))
+    if mode == RPC_SERVER_MODE_ASYNCIO:
+        from cron_tools.agent.async_rpc_server import AsyncioUnixStreamRPCServer
+        server = AsyncioUnixStreamRPCServer(
+            config.listen_socket_path, config.rpc_executor_workers, admission=admission
+        )
+    elif mode == RPC_SERVER_MODE_THREADING:
+        server = AgentUnixStreamRPCServer(config.listen_socket_path, admission=admission)
+    else:
+        raise ConfigurationException("Unknown rpc_server_mode: {0}".format(mode))
+    # The seqpacket and datagram transports, for wrappers configured to use them, are served next to the stream one.
+    if config.seqpacket_socket_path:
+        server.add_listener(socket.SOCK_SEQPACKET, config.seqpacket_socket_path)
+    if config.datagram_socket_path:
+        server.add_listener(socket.SOCK_DGRAM, config.datagram_socket_path)
+    return server
+
 
 def build_app(args=None, config=None):
     args = args or agent_argument_parser.parse_args()
@@ -23,38 +100,91 @@ def build_app(args=None, config=None):
     else:
         config = AgentConfiguration.default()
 
-    server = AgentUnixStreamRPCServer(config.listen_socket_path)
-    pool = SimpleConnectionPool(config.sqlite_database_path)
+    server = build_rpc_server(config)
+    pool = SimpleConnectionPool(
+        config.sqlite_database_path, pragmas=storage_pragmas(config.storage_profile, config.storage_pragmas)
+    )
+    wal_checkpoint = dict(AgentConfiguration.OPTIONAL_PARAMETERS['wal_checkpoint'], **(config.wal_checkpoint or {}))
     write_schema(pool.get())
     pool.close()
-    attach_agent_functions(
-        server, pool
-    )
+    heartbeats = HeartbeatCoalescer()
+    group_commit = dict(AgentConfiguration.OPTIONAL_PARAMETERS['group_commit'], **(config.group_commit or {}))
+    writer = GroupCommitWriter.from_config(pool, group_commit) if group_commit['enabled'] else None
+    start_slots = StartSlotAllocator(config.stagger_slot_seconds, config.stagger_max_window_seconds)
+    attach_agent_functions(server, pool, config.output_retention, heartbeats, start_slots, writer)
     server_thread = Thread(target=server.serve_forever)
     shutdown_event = Event()
-    last_cleanup_time = 0
+    last_cleanup_time = [0]
+    journal = EventJournal(config.journal_path, mode=int(config.journal_mode, 8))
+    try:
+        journal.prepare(config.journal_group)
+    except (OSError, KeyError):
+        agent_logger.exception("Unable to create the journal {0}".format(journal.path))
+    last_journal_ingest_time = [0]
+
+    def run_journal_ingest():
+        try:
+            ingested = ingest_journal(pool, journal, writer)
+            if ingested:
+                agent_logger.info("Ingested {0} events from the journal {1}".format(ingested, journal.path))
+        except Exception:
+            agent_logger.exception("Unable to ingest the journal {0}".format(journal.path))
+        last_journal_ingest_time[0] = time.time()
+
+    last_heartbeat_flush_time = [time.time()]
+
+    def run_heartbeat_flush():
+        try:
+            run_write(writer, pool, heartbeats.flush)
+        except Exception:
+            agent_logger.exception("Unable to flush job heartbeats")
+        last_heartbeat_flush_time[0] = time.time()
+
+    last_wal_checkpoint_time = [time.time()]
+
+    def run_wal_checkpoint():
+        try:
+            mode, result = checkpoint_wal(
+                pool.get(), config.sqlite_database_path, wal_checkpoint['passive_bytes'],
+                wal_checkpoint['truncate_bytes']
+            )
+            if mode is not None:
+                agent_logger.info("Ran a {0} WAL checkpoint: {1}".format(mode, result))
+        except Exception:
+            agent_logger.exception("Unable to checkpoint the WAL of {0}".format(config.sqlite_database_path))
+        last_wal_checkpoint_time[0] = time.time()
 
     def run():
+        if writer is not None:
+            writer.start()
+        run_journal_ingest()
         server_thread.start()
         while not shutdown_event.is_set():
             time.sleep(3)
             current_time = time.time()
+            if current_time - last_journal_ingest_time[0] > config.journal_ingest_interval_seconds:
+                run_journal_ingest()
+            if current_time - last_heartbeat_flush_time[0] > config.heartbeat_flush_interval_seconds:
+                run_heartbeat_flush()
+            if wal_checkpoint['enabled'] \
+                    and current_time - last_wal_checkpoint_time[0] > wal_checkpoint['check_interval_seconds']:
+                run_wal_checkpoint()
             if config.clean_up_policy['enabled'] \
-                    and (current_time - last_cleanup_time) > config.clean_up_policy['check_interval_minutes']*60:
-                conn = pool.get()
-                with immediate_transaction_manager(conn) as t:
-                    last_replicated_sequence_number = get_key_value_pair(
-                        pool.get(), 'REPLICATION_LAST_SUCCESSFUL_SEQ_NUMBER', -1
-                    )
-                    remove_old_jobs(
-                        t, config.clean_up_policy['replicated']['min_age_hours'], last_replicated_sequence_number
-                    )
-                    remove_old_jobs(
-                        t, config.clean_up_policy['unreplicated']['min_age_hours']
-                    )
+                    and (current_time - last_cleanup_time[0]) > config.clean_up_policy['check_interval_minutes']*60:
+                run_write(writer, pool, lambda t: remove_expired_jobs(t, config.clean_up_policy))
+                output_spool = config.clean_up_policy.get(
+                    'output_spool', AgentConfiguration.OPTIONAL_PARAMETERS['clean_up_policy']['output_spool']
+                )
+                removed = remove_old_spool_files(config.output_spool_directory, output_spool['min_age_hours'])
+                if removed:
+                    agent_logger.info("Removed {0} old output spool files".format(removed))
+                last_cleanup_time[0] = current_time
 
         server.shutdown()
         server.server_close()
+        run_heartbeat_flush()
+        if writer is not None:
+            writer.close()
 
     def shutdown():
         shutdown_event.set()
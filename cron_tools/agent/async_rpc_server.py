@@ -0,0 +1,294 @@
+"""
+asyncio based agent RPC server (Python 3 only): every connection is served by one event loop, with the requests
+themselves (which mostly mean SQLite work) dispatched to a small fixed pool of threads. Thousands of idle or
+waiting wrapper connections then cost a coroutine and a socket each, instead of an OS thread and, once it touches
+the database, a SQLite connection each.
+"""
+import asyncio
+import errno
+import os
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from cron_tools.agent.admission import AdmissionController, peer_credentials, peer_uid, \
+    enable_datagram_credentials, receive_datagram
+from cron_tools.agent.rpc_server import handle_message, shed_message, shed_response, too_large_response, \
+    unlink_socket
+from cron_tools.common.rpc import BaseRPCServerHandler
+from cron_tools.common.rpc_client import FRAME_HEADER, MAX_MESSAGE_BYTES
+from cron_tools.common.rpc_codecs import codec_for_magic_byte
+
+DEFAULT_EXECUTOR_WORKERS = 16
+# Pipelined read requests of one connection running at once; reading more of its requests waits beyond that.
+DEFAULT_MAX_IN_FLIGHT = 32
+MAX_DATAGRAMS_PER_BATCH = 256
+
+
+class AsyncioUnixStreamRPCServer(object):
+    """
+    Drop-in replacement for AgentUnixStreamRPCServer: the listening socket is bound on construction, serve_forever()
+    runs the event loop in the calling thread until shutdown() is called from another one, and server_close()
+    releases the socket and the executor.
+    """
+
+    def __init__(self, socket_addr, executor_workers=DEFAULT_EXECUTOR_WORKERS, backlog=socket.SOMAXCONN,
+                 max_in_flight=DEFAULT_MAX_IN_FLIGHT, admission=None):
+        self.socket_addr = socket_addr
+        self.admission = admission if admission is not None else AdmissionController()
+        self.max_in_flight = max_in_flight
+        self.backlog = backlog
+        self.handler = BaseRPCServerHandler()
+        self.executor = ThreadPoolExecutor(max_workers=executor_workers)
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.socket.bind(socket_addr)
+            self.socket.listen(backlog)
+        except BaseException:
+            self.socket.close()
+            raise
+        # (socket type, socket address, socket) of the seqpacket and datagram transport listeners.
+        self.listeners = []
+        self.loop = None
+        self.connection_count = 0
+        self._shutdown_requested = threading.Event()
+        self._serving_stopped = threading.Event()
+
+    def register_function(self, name, function, write=False):
+        return self.handler.register_function(name, function, write=write)
+
+    def set_batch_transaction(self, batch_transaction):
+        self.handler.batch_transaction = batch_transaction
+
+    def add_listener(self, socket_type, socket_addr):
+        """
+        Also serve the registered functions on a SOCK_SEQPACKET or SOCK_DGRAM socket at socket_addr.
+        """
+        sock = socket.socket(socket.AF_UNIX, socket_type)
+        try:
+            sock.bind(socket_addr)
+            if socket_type == socket.SOCK_SEQPACKET:
+                sock.listen(self.backlog)
+            else:
+                enable_datagram_credentials(sock)
+            sock.setblocking(False)
+        except BaseException:
+            sock.close()
+            raise
+        self.listeners.append((socket_type, socket_addr, sock))
+
+    async def send_message(self, connection, codec, raw_response):
+        # A seqpacket send is all or nothing, so sock_sendall sends exactly one message.
+        if len(raw_response) + 1 > MAX_MESSAGE_BYTES:
+            raw_response = too_large_response(codec)
+        try:
+            await self.loop.sock_sendall(connection, codec.magic_byte + raw_response)
+        except OSError as e:
+            if e.errno != errno.EMSGSIZE:
+                raise
+            await self.loop.sock_sendall(connection, codec.magic_byte + too_large_response(codec))
+
+    async def admit_request(self, uid, admitted):
+        """
+        Whether to handle the next request of a connection, after holding it back for as long as admission control
+        says to. Holding it back also holds back reading anything more from the connection.
+        """
+        if not admitted:
+            return False
+        delay = self.admission.request_delay(uid)
+        if delay is None:
+            return False
+        if delay:
+            await asyncio.sleep(delay)
+        return True
+
+    async def handle_seqpacket_connection(self, connection):
+        """
+        Requests on a seqpacket connection are answered one after another, the way wrappers make them. Like every
+        connection, one over the admission limits gets its first request shed and is closed.
+        """
+        self.connection_count += 1
+        uid = peer_uid(peer_credentials(connection))
+        admitted = self.admission.connection_opened(uid)
+        # One byte to spare, so that a message filling all of it was one too long and got truncated.
+        buffer = bytearray(MAX_MESSAGE_BYTES + 1)
+        try:
+            while True:
+                received = await self.loop.sock_recv_into(connection, buffer)
+                if not received or received > MAX_MESSAGE_BYTES:
+                    return
+                if await self.admit_request(uid, admitted):
+                    answer = await self.loop.run_in_executor(
+                        self.executor, handle_message, self.handler, memoryview(buffer)[:received]
+                    )
+                else:
+                    answer = shed_message(self.handler, memoryview(buffer)[:received])
+                if answer is not None:
+                    await self.send_message(connection, *answer)
+                if not admitted:
+                    return
+        except ConnectionError:
+            pass
+        finally:
+            if admitted:
+                self.admission.connection_closed(uid)
+            self.connection_count -= 1
+            connection.close()
+
+    async def serve_seqpacket(self, sock):
+        while True:
+            connection, _ = await self.loop.sock_accept(sock)
+            connection.setblocking(False)
+            self.loop.create_task(self.handle_seqpacket_connection(connection))
+
+    def handle_datagrams(self, messages):
+        for message, credentials in messages:
+            if len(message) > MAX_MESSAGE_BYTES:
+                continue
+            # Holding one back would hold back every sender's, so any datagram over the rate limits is dropped.
+            if self.admission.request_delay(peer_uid(credentials), queue=False) is None:
+                continue
+            handle_message(self.handler, memoryview(message))
+
+    async def wait_readable(self, sock):
+        readable = self.loop.create_future()
+        self.loop.add_reader(sock.fileno(), lambda: readable.done() or readable.set_result(None))
+        try:
+            await readable
+        finally:
+            self.loop.remove_reader(sock.fileno())
+
+    async def serve_datagrams(self, sock):
+        """
+        Datagrams are handled in the order they arrive, so that the notifications of a wrapper are applied in the
+        order they were sent; nobody is waiting for an answer. Everything already queued goes to the executor in one
+        go rather than a datagram at a time.
+        """
+        while True:
+            await self.wait_readable(sock)
+            messages = []
+            while len(messages) < MAX_DATAGRAMS_PER_BATCH:
+                try:
+                    messages.append(receive_datagram(sock, MAX_MESSAGE_BYTES + 1))
+                except BlockingIOError:
+                    break
+            if messages:
+                await self.loop.run_in_executor(self.executor, self.handle_datagrams, messages)
+
+    async def run_request(self, writer, drain_lock, codec, parsed, request_bytes):
+        raw_response = await self.loop.run_in_executor(
+            self.executor, self.handler.handle_decoded_request, parsed, codec, request_bytes
+        )
+        if raw_response is None:
+            return
+        try:
+            writer.writelines([FRAME_HEADER.pack(codec.magic_byte, len(raw_response)), raw_response])
+            async with drain_lock:
+                await writer.drain()
+        except ConnectionError:
+            pass
+
+    async def handle_connection(self, reader, writer):
+        """
+        Requests on one connection may be pipelined. Reads run side by side and are answered as they complete,
+        each response carrying the id of its request; a request containing a write waits for everything before it
+        and holds back everything after it, so a connection sees its own writes in the order it sent them.
+        """
+        self.connection_count += 1
+        uid = peer_uid(peer_credentials(writer.get_extra_info('socket')))
+        admitted = self.admission.connection_opened(uid)
+        drain_lock = asyncio.Lock()
+        in_flight = set()
+        try:
+            while True:
+                try:
+                    header = await reader.readexactly(FRAME_HEADER.size)
+                except asyncio.IncompleteReadError:
+                    # The client is done sending, but may still be waiting for the answers.
+                    if in_flight:
+                        await asyncio.wait(in_flight)
+                    return
+                magic_byte, length = FRAME_HEADER.unpack(header)
+                # The magic byte names the codec of the payload; the response goes back in the same one.
+                codec = codec_for_magic_byte(magic_byte)
+                if codec is None:
+                    return
+                raw_payload = await reader.readexactly(length)
+                if not await self.admit_request(uid, admitted):
+                    raw_response = shed_response(self.handler, raw_payload, codec)
+                    if raw_response is not None:
+                        writer.writelines([FRAME_HEADER.pack(codec.magic_byte, len(raw_response)), raw_response])
+                    if admitted:
+                        continue
+                    await writer.drain()
+                    return
+                try:
+                    parsed = codec.decode(raw_payload)
+                except ValueError:
+                    raw_response = self.handler.handle_request(raw_payload, codec)
+                    writer.writelines([FRAME_HEADER.pack(codec.magic_byte, len(raw_response)), raw_response])
+                    continue
+                if self.handler.is_write_payload(parsed):
+                    if in_flight:
+                        await asyncio.wait(in_flight)
+                    await self.run_request(writer, drain_lock, codec, parsed, length)
+                    continue
+                if len(in_flight) >= self.max_in_flight:
+                    await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                task = self.loop.create_task(self.run_request(writer, drain_lock, codec, parsed, length))
+                in_flight.add(task)
+                task.add_done_callback(in_flight.discard)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            for task in in_flight:
+                task.cancel()
+            if admitted:
+                self.admission.connection_closed(uid)
+            self.connection_count -= 1
+            writer.close()
+
+    def serve_forever(self):
+        self.loop = loop = asyncio.new_event_loop()
+        try:
+            asyncio.set_event_loop(loop)
+            server = loop.run_until_complete(asyncio.start_unix_server(
+                self.handle_connection, sock=self.socket, backlog=self.backlog
+            ))
+            for socket_type, _, sock in self.listeners:
+                if socket_type == socket.SOCK_SEQPACKET:
+                    loop.create_task(self.serve_seqpacket(sock))
+                else:
+                    loop.create_task(self.serve_datagrams(sock))
+            if not self._shutdown_requested.is_set():
+                loop.run_forever()
+            server.close()
+            tasks = [task for task in asyncio.all_tasks(loop) if not task.done()]
+            for task in tasks:
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        finally:
+            loop.close()
+            self._serving_stopped.set()
+
+    def shutdown(self):
+        self._shutdown_requested.set()
+        loop = self.loop
+        if loop is not None:
+            try:
+                loop.call_soon_threadsafe(loop.stop)
+            except RuntimeError:
+                # The loop has already been closed.
+                pass
+            self._serving_stopped.wait()
+
+    def server_close(self):
+        self.socket.close()
+        for _, socket_addr, sock in self.listeners:
+            sock.close()
+            unlink_socket(socket_addr)
+        self.executor.shutdown(wait=False)
+        try:
+            os.unlink(self.socket_addr)
+        except OSError:
+            pass
@@ -6,10 +6,63 @@ from cron_tools.common.config import ConfigurationException, JSONSourcedConfigur
 class AgentConfiguration(JSONSourcedConfiguration):
     DEFAULT_LISTEN_SOCKET_PATH = "/var/run/cron-tools/agent.sock"
     DEFAULT_DATABASE_PATH = '/var/lib/cron-tools/agent.db'
+    DEFAULT_JOURNAL_PATH = '/var/lib/cron-tools/journal'
+    DEFAULT_OUTPUT_SPOOL_DIRECTORY = '/var/lib/cron-tools/output'
 
     OPTIONAL_PARAMETERS = {
         'sqlite_database_path': DEFAULT_DATABASE_PATH,
         'listen_socket_path': DEFAULT_LISTEN_SOCKET_PATH,
+        'journal_path': DEFAULT_JOURNAL_PATH,
+        # The agent creates the journal with this mode (an octal string) and group, so that wrappers running as any
+        # user can append to it; see cron_tools.common.journal.
+        'journal_mode': '0622',
+        'journal_group': None,
+        'journal_ingest_interval_seconds': 30,
+        'heartbeat_flush_interval_seconds': 60,
+        'stagger_slot_seconds': 1.0,
+        # Longer stagger windows asked for by wrappers are cut down to this.
+        'stagger_max_window_seconds': 3600.0,
+        'rpc_server_mode': 'auto',
+        'seqpacket_socket_path': None,
+        'datagram_socket_path': None,
+        # Writes wait for their group commit on an executor thread, so this also bounds how many share a commit.
+        'rpc_executor_workers': 16,
+        # Limits on connections and requests, in total and per peer uid; None is no limit. Requests over the rate
+        # limits wait up to max_queue_seconds, beyond that they are shed with a "Server Overloaded" error.
+        'admission_control': {
+            'max_connections': None,
+            'max_connections_per_uid': None,
+            'requests_per_second': None,
+            'requests_per_second_per_uid': None,
+            'burst_seconds': 1.0,
+            'max_queue_seconds': 0.5
+        },
+        # The SQLite pragmas of the spool, see cron_tools.agent.storage.STORAGE_PROFILES; storage_pragmas overrides
+        # single ones of the profile. Every profile switches the spool to WAL for good, so there is none by default
+        # and an existing spool keeps its rollback journal until one is configured.
+        'storage_profile': None,
+        'storage_pragmas': {},
+        # The WAL is checkpointed once it grows past passive_bytes, and truncated back to nothing past truncate_bytes.
+        'wal_checkpoint': {
+            'enabled': True,
+            'check_interval_seconds': 30,
+            'passive_bytes': 4 * 1024 * 1024,
+            'truncate_bytes': 64 * 1024 * 1024
+        },
+        # Writes made through RPC are run on one thread and committed together once max_batch_operations or
+        # max_batch_bytes of them have queued up, or max_delay_seconds after the first.
+        'group_commit': {
+            'enabled': True,
+            'max_batch_operations': 128,
+            'max_batch_bytes': 4 * 1024 * 1024,
+            'max_delay_seconds': 0.002
+        },
+        # Where wrappers spool captured output, see clean_up_policy['output_spool'].
+        'output_spool_directory': DEFAULT_OUTPUT_SPOOL_DIRECTORY,
+        'output_retention': {
+            'head_bytes': 1024 * 1024,
+            'tail_bytes': 1024 * 1024
+        },
         'logging_config': {
             'version': 1,
             'formatters': {
@@ -38,6 +91,9 @@ class AgentConfiguration(JSONSourcedConfiguration):
             },
             'unreplicated': {
                 'min_age_hours': 24*7
+            },
+            'output_spool': {
+                'min_age_hours': 24*3
             }
         }
     }
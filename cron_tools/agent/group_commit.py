@@ -0,0 +1,171 @@
+"""
+Group commit of the agent's writes: one thread and connection runs every write, committing whatever has queued up
+together in one transaction, so that concurrent wrappers share a commit (and its fsync) instead of queueing for one
+each. RPC writes and batches, journal ingest, heartbeat flushes and the periodic cleanup all go through run_write();
+the only writes made elsewhere are the schema, before the writer starts, and VACUUM (cleanup_database), which cannot
+run inside a transaction.
+"""
+import logging
+import threading
+import time
+from six.moves import queue
+
+from cron_tools.agent.queries import immediate_transaction_manager
+
+group_commit_logger = logging.getLogger(__name__)
+
+monotonic = getattr(time, 'monotonic', time.time)
+
+
+def run_write(writer, connection_pool, operation, size=0):
+    """
+    Run operation(transaction) through the group commit writer and return its result. Without a writer it runs in a
+    transaction of its own on the calling thread's connection instead. On the writer's own thread (in an RPC batch
+    it is running) it runs right away, in a savepoint of the writer's transaction.
+    """
+    if writer is None or writer.on_writer_thread():
+        with immediate_transaction_manager(connection_pool.get()) as t:
+            return operation(t)
+    return writer.submit(operation, size)
+
+
+class PendingWrite(object):
+    def __init__(self, operation, size):
+        self.operation = operation
+        self.size = size
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class GroupCommitWriter(object):
+    """
+    Runs write operations submitted from any thread on its own thread, with its own connection from connection_pool.
+    A batch takes everything queued, waiting up to max_delay_seconds for more to arrive, until it has
+    max_batch_operations operations or max_batch_bytes of them (as submitted). Each operation runs in a savepoint,
+    so one failing only rolls back its own writes; submit() returns only once the batch has committed.
+    """
+
+    def __init__(self, connection_pool, max_batch_operations=128, max_batch_bytes=4 * 1024 * 1024,
+                 max_delay_seconds=0.002):
+        self.connection_pool = connection_pool
+        self.max_batch_operations = max_batch_operations
+        self.max_batch_bytes = max_batch_bytes
+        self.max_delay_seconds = max_delay_seconds
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._closed = False
+        self._thread = None
+        self.batches = 0
+        self.operations = 0
+        self.largest_batch = 0
+
+    @classmethod
+    def from_config(cls, connection_pool, group_commit):
+        return cls(
+            connection_pool, group_commit['max_batch_operations'], group_commit['max_batch_bytes'],
+            group_commit['max_delay_seconds']
+        )
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="group-commit-writer")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def on_writer_thread(self):
+        return self._thread is not None and self._thread is threading.current_thread()
+
+    def close(self):
+        """
+        Commit what has been submitted so far and stop the writer thread; submitting anything more fails.
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(None)
+        if self._thread is not None:
+            self._thread.join()
+
+    def submit(self, operation, size=0):
+        """
+        Run operation(connection) in the next batch and return its result once the batch has committed. If the
+        operation raises, its exception is raised here instead.
+        """
+        pending = PendingWrite(operation, size)
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("The group commit writer is closed.")
+            self._queue.put(pending)
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def _next_batch(self):
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        size = first.size
+        deadline = monotonic() + self.max_delay_seconds
+        while len(batch) < self.max_batch_operations and size < self.max_batch_bytes:
+            try:
+                pending = self._queue.get_nowait()
+            except queue.Empty:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    pending = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            if pending is None:
+                # Closed; this batch is the last, the next _next_batch() sees the end again.
+                self._queue.put(None)
+                break
+            batch.append(pending)
+            size += pending.size
+        return batch
+
+    def _commit(self, connection, batch):
+        try:
+            with immediate_transaction_manager(connection):
+                for pending in batch:
+                    try:
+                        with immediate_transaction_manager(connection) as t:
+                            pending.result = pending.operation(t)
+                    except Exception as e:
+                        pending.error = e
+        except Exception as e:
+            group_commit_logger.exception("Unable to commit a batch of {0} writes.".format(len(batch)))
+            if getattr(connection, 'in_transaction', False):
+                connection.execute("ROLLBACK")
+            for pending in batch:
+                if pending.error is None:
+                    pending.error = e
+        finally:
+            self.batches += 1
+            self.operations += len(batch)
+            self.largest_batch = max(self.largest_batch, len(batch))
+            for pending in batch:
+                pending.done.set()
+
+    def _run(self):
+        connection = self.connection_pool.get()
+        try:
+            while True:
+                batch = self._next_batch()
+                if batch is None:
+                    return
+                self._commit(connection, batch)
+        finally:
+            self.connection_pool.close()
+
+    def snapshot(self):
+        return {
+            'batches': self.batches,
+            'operations': self.operations,
+            'mean_batch_operations': self.operations / float(self.batches) if self.batches else None,
+            'largest_batch_operations': self.largest_batch
+        }
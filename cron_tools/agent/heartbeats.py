@@ -0,0 +1,47 @@
+"""
+In memory coalescing of wrapper heartbeats, so that heartbeat volume does not turn into SQLite writes.
+"""
+import threading
+
+from cron_tools.agent.queries import immediate_transaction_manager, update_job_heartbeats
+
+
+class HeartbeatCoalescer(object):
+    """
+    Keeps only the latest heartbeat time per job until flush() writes them all in a single transaction. Between
+    flushes the pending times are still visible through latest(), so active job listings are never stale.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+
+    def record(self, job_uuid, heartbeat_time):
+        with self._lock:
+            if heartbeat_time > self._pending.get(job_uuid, heartbeat_time - 1):
+                self._pending[job_uuid] = heartbeat_time
+
+    def latest(self, job_uuid):
+        with self._lock:
+            return self._pending.get(job_uuid)
+
+    def pending_count(self):
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self, connection):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        try:
+            with immediate_transaction_manager(connection) as t:
+                update_job_heartbeats(t, pending)
+        except BaseException:
+            # Put the heartbeats back (unless newer ones arrived meanwhile) so the next flush retries them.
+            with self._lock:
+                for job_uuid, heartbeat_time in pending.items():
+                    if heartbeat_time > self._pending.get(job_uuid, heartbeat_time - 1):
+                        self._pending[job_uuid] = heartbeat_time
+            raise
+        return len(pending)
@@ -10,16 +10,32 @@ from functools import wraps
 from cron_tools.common.models import AgentJob
 from cron_tools.common.time import local_now, from_any_time_to_utc_seconds
 from cron_tools.agent import SQL_DIR
+from cron_tools.agent.storage import apply_pragmas
 
 with open(os.path.join(SQL_DIR, "schema.sql")) as f:
     AGENT_SCHEMA = f.read()
 
+# Columns added to the job table after its first release, so that existing spool databases can be upgraded in place.
+JOB_TABLE_ADDED_COLUMNS = (
+    ('job_resource_usage_json', 'TEXT'),
+    ('job_lock_wait_seconds', 'REAL'),
+    ('job_last_heartbeat_utc_epoch_seconds', 'REAL'),
+    ('job_start_delay_seconds', 'REAL'),
+    ('job_scheduling_json', 'TEXT'),
+)
+
 
 @wraps(sqlite.connect)
 def create_connection(*args, **kwargs):
+    """
+    Open a connection for the agent, setting the given pragmas (see cron_tools.agent.storage) on it.
+    """
+    pragmas = kwargs.pop('pragmas', None)
     conn = sqlite.connect(*args, **kwargs)
     conn.row_factory = Row
     conn.isolation_level = None
+    if pragmas:
+        apply_pragmas(conn, pragmas)
     return conn
 
 
@@ -71,8 +87,30 @@ def transaction_manager(connection):
         connection.execute("COMMIT")
 
 
+@contextmanager
+def savepoint_manager(connection, name="nested_transaction"):
+    try:
+        connection.execute("SAVEPOINT {0}".format(name))
+        yield connection
+    except BaseException:
+        connection.execute("ROLLBACK TO {0}".format(name))
+        connection.execute("RELEASE {0}".format(name))
+        raise
+    else:
+        connection.execute("RELEASE {0}".format(name))
+
+
 @contextmanager
 def immediate_transaction_manager(connection):
+    """
+    Run the enclosed writes in an IMMEDIATE transaction. On a connection that is already in a transaction (such as
+    an RPC batch) a savepoint is used instead: the writes commit along with the enclosing transaction, but a failure
+    still only rolls back its own.
+    """
+    if getattr(connection, 'in_transaction', False):
+        with savepoint_manager(connection):
+            yield connection
+        return
     try:
         connection.execute("BEGIN IMMEDIATE TRANSACTION")
         yield connection
@@ -85,6 +123,16 @@ def immediate_transaction_manager(connection):
 
 def write_schema(connection):
     connection.executescript(AGENT_SCHEMA)
+    upgrade_job_table(connection)
+
+
+def upgrade_job_table(connection):
+    with cursor_manager(connection) as c:
+        c.execute("PRAGMA table_info(job)")
+        existing_columns = set(row[1] for row in c.fetchall())
+        for column_name, column_type in JOB_TABLE_ADDED_COLUMNS:
+            if column_name not in existing_columns:
+                c.execute("ALTER TABLE job ADD COLUMN {0} {1}".format(column_name, column_type))
 
 
 def cleanup_db(connection):
@@ -158,14 +206,14 @@ def get_all_key_value_pairs(connection):
 def get_all_jobs(connection, limit=None, offset=None, order_by=None):
     query = "SELECT * FROM job"
     params = []
+    if order_by is not None:
+        query += " ORDER BY {0} ".format(order_by)
     if limit is not None:
         query += " LIMIT ?"
         params.append(limit)
     if offset is not None:
         query += " OFFSET ?"
         params.append(offset)
-    if order_by is not None:
-        query += " ORDER BY {0} ".format(order_by)
     with cursor_manager(connection) as c:
         c.execute(
             query,
@@ -177,14 +225,14 @@ def get_all_jobs(connection, limit=None, offset=None, order_by=None):
 def get_all_active_jobs(connection, limit=None, offset=None, order_by=None):
     query = "SELECT * FROM job WHERE job_end_time_utc_epoch_seconds IS NULL "
     params = []
+    if order_by is not None:
+        query += " ORDER BY {0} ".format(order_by)
     if limit is not None:
         query += " LIMIT ?"
         params.append(limit)
     if offset is not None:
         query += " OFFSET ?"
         params.append(offset)
-    if order_by is not None:
-        query += " ORDER BY {0} ".format(order_by)
     with cursor_manager(connection) as c:
         c.execute(
             query,
@@ -203,12 +251,16 @@ def add_job(transaction, new_job_record, sequence_counter_name='REPLICATION_COUN
             "  job_uuid, job_name, job_args_json, job_user, job_host,"
             "  job_tags_json, job_status_code, job_start_time_utc_epoch_seconds, "
             "  job_end_time_utc_epoch_seconds, created_time_utc_epoch_seconds,"
-            "  last_updated_time_utc_epoch_seconds, last_updated_sequence_number"
+            "  last_updated_time_utc_epoch_seconds, last_updated_sequence_number,"
+            "  job_resource_usage_json, job_lock_wait_seconds, job_last_heartbeat_utc_epoch_seconds,"
+            "  job_start_delay_seconds, job_scheduling_json"
             ") VALUES ("
             "  :job_uuid, :job_name, :job_args_json, :job_user, :job_host,"
             "  :job_tags_json, :job_status_code, :job_start_time_utc_epoch_seconds, "
             "  :job_end_time_utc_epoch_seconds, :created_time_utc_epoch_seconds,"
-            "  :last_updated_time_utc_epoch_seconds, :last_updated_sequence_number"
+            "  :last_updated_time_utc_epoch_seconds, :last_updated_sequence_number,"
+            "  :job_resource_usage_json, :job_lock_wait_seconds, :job_last_heartbeat_utc_epoch_seconds,"
+            "  :job_start_delay_seconds, :job_scheduling_json"
             ")",
             new_job_record.to_row()
         )
@@ -229,13 +281,18 @@ def update_job(transaction, job_record, sequence_counter_name='REPLICATION_COUNT
                 job_args_json = :job_args_json,
                 job_user = :job_user,
                 job_host = :job_host,
-                job_tags_json = :job_tags,
+                job_tags_json = :job_tags_json,
                 job_status_code = :job_status_code,
                 job_start_time_utc_epoch_seconds = :job_start_time_utc_epoch_seconds,
                 job_end_time_utc_epoch_seconds = :job_end_time_utc_epoch_seconds,
                 created_time_utc_epoch_seconds = :created_time_utc_epoch_seconds,
                 last_updated_time_utc_epoch_seconds = :last_updated_time_utc_epoch_seconds,
-                last_updated_sequence_number = :last_updated_sequence_number
+                last_updated_sequence_number = :last_updated_sequence_number,
+                job_resource_usage_json = :job_resource_usage_json,
+                job_lock_wait_seconds = :job_lock_wait_seconds,
+                job_last_heartbeat_utc_epoch_seconds = :job_last_heartbeat_utc_epoch_seconds,
+                job_start_delay_seconds = :job_start_delay_seconds,
+                job_scheduling_json = :job_scheduling_json
             WHERE job_id = :job_id
             """,
             job_record.to_row()
@@ -243,7 +300,7 @@ def update_job(transaction, job_record, sequence_counter_name='REPLICATION_COUNT
     return job_record
 
 
-def update_job_end_time_and_status(transaction, job_uuid, job_end_time, job_status_code,
+def update_job_end_time_and_status(transaction, job_uuid, job_end_time, job_status_code, job_resource_usage=None,
                                    sequence_counter_name='REPLICATION_COUNTER'):
     last_updated_sequence_number = get_and_increment_counter(transaction, sequence_counter_name)
     last_updated_time = local_now()
@@ -254,7 +311,8 @@ def update_job_end_time_and_status(transaction, job_uuid, job_end_time, job_stat
             SET job_status_code=?,
                 job_end_time_utc_epoch_seconds=?,
                 last_updated_time_utc_epoch_seconds=?,
-                last_updated_sequence_number=?
+                last_updated_sequence_number=?,
+                job_resource_usage_json=?
             WHERE job_uuid=?
             """,
             (
@@ -262,6 +320,7 @@ def update_job_end_time_and_status(transaction, job_uuid, job_end_time, job_stat
                 from_any_time_to_utc_seconds(job_end_time),
                 from_any_time_to_utc_seconds(last_updated_time),
                 last_updated_sequence_number,
+                json.dumps(job_resource_usage) if job_resource_usage is not None else None,
                 job_uuid
             )
         )
@@ -270,21 +329,128 @@ def update_job_end_time_and_status(transaction, job_uuid, job_end_time, job_stat
         'job_end_time_utc_epoch_seconds': from_any_time_to_utc_seconds(job_end_time),
         'job_updated_time_utc_epoch_seconds': from_any_time_to_utc_seconds(last_updated_time),
         'job_updated_sequence_number': last_updated_sequence_number,
+        'job_resource_usage': job_resource_usage,
         'job_uuid': job_uuid
     }
 
 
+def update_job_heartbeats(transaction, heartbeats):
+    """
+    Record the latest heartbeat time of each job in one batched statement. Heartbeats are liveness information
+    only, so they do not take a replication sequence number.
+    """
+    with cursor_manager(transaction) as c:
+        c.executemany(
+            "UPDATE job SET job_last_heartbeat_utc_epoch_seconds = ? "
+            "WHERE job_uuid = ? AND (job_last_heartbeat_utc_epoch_seconds IS NULL "
+            "OR job_last_heartbeat_utc_epoch_seconds < ?)",
+            [(heartbeat_time, job_uuid, heartbeat_time) for job_uuid, heartbeat_time in heartbeats.items()]
+        )
+
+
+def job_exists(connection, job_uuid):
+    with cursor_manager(connection) as c:
+        c.execute("SELECT 1 FROM job WHERE job_uuid = ?", (job_uuid,))
+        return c.fetchone() is not None
+
+
+def apply_journal_events(transaction, events):
+    """
+    Replay wrapper events recorded in the fallback journal. Replays are idempotent, so a journal that was ingested
+    but not truncated (e.g. the agent died in between) can safely be ingested again.
+    """
+    applied = 0
+    for event in events:
+        method = event.get('method')
+        params = event.get('params') or {}
+        if method == 'add_new_job':
+            job_record = AgentJob.deserialize(params['raw_job_record'])
+            if job_exists(transaction, job_record.uuid):
+                continue
+            add_job(transaction, job_record)
+        elif method == 'update_job_end_time_and_status_code':
+            update_job_end_time_and_status(transaction, **params)
+        else:
+            continue
+        applied += 1
+    return applied
+
+
+def add_job_output_chunk(transaction, job_uuid, stream_name, sequence_number, compressed_data, raw_length,
+                         head_bytes, tail_bytes):
+    """
+    Store one compressed chunk of captured output, retaining at most head_bytes from the start and tail_bytes from
+    the end of each stream of a job (counted uncompressed, whole chunks at a time). Chunks in between are dropped,
+    so a gap in the sequence numbers marks where output was cut. Returns whether the chunk went to the head.
+    """
+    with cursor_manager(transaction) as c:
+        c.execute(
+            "SELECT COALESCE(SUM(raw_length), 0) AS head_length FROM job_output_chunk "
+            "WHERE job_uuid = ? AND stream_name = ? AND is_head = 1",
+            (job_uuid, stream_name)
+        )
+        is_head = c.fetchone()['head_length'] < head_bytes
+        c.execute(
+            "INSERT OR IGNORE INTO job_output_chunk("
+            "  job_uuid, stream_name, sequence_number, raw_length, compressed_data, is_head"
+            ") VALUES (?, ?, ?, ?, ?, ?)",
+            (job_uuid, stream_name, sequence_number, raw_length, sqlite.Binary(compressed_data), int(is_head))
+        )
+        if is_head:
+            return True
+        c.execute(
+            "SELECT sequence_number, raw_length FROM job_output_chunk "
+            "WHERE job_uuid = ? AND stream_name = ? AND is_head = 0 ORDER BY sequence_number DESC",
+            (job_uuid, stream_name)
+        )
+        retained_length = 0
+        expired = []
+        for row in c.fetchall():
+            if retained_length >= tail_bytes:
+                expired.append((job_uuid, stream_name, row['sequence_number']))
+            retained_length += row['raw_length']
+        if expired:
+            c.executemany(
+                "DELETE FROM job_output_chunk WHERE job_uuid = ? AND stream_name = ? AND sequence_number = ?",
+                expired
+            )
+    return False
+
+
+def get_job_output_chunks(connection, job_uuid, stream_name=None):
+    query = "SELECT stream_name, sequence_number, raw_length, compressed_data FROM job_output_chunk WHERE job_uuid = ?"
+    params = [job_uuid]
+    if stream_name is not None:
+        query += " AND stream_name = ?"
+        params.append(stream_name)
+    query += " ORDER BY stream_name, sequence_number"
+    with cursor_manager(connection) as c:
+        c.execute(query, params)
+        return [
+            (r['stream_name'], r['sequence_number'], r['raw_length'], bytes(r['compressed_data']))
+            for r in c.fetchall()
+        ]
+
+
 def remove_old_jobs(transaction, minimum_age_hours, maximum_sequence_number=None):
+    """
+    Delete the jobs that ended more than minimum_age_hours ago (and, if given, were last updated no later than
+    maximum_sequence_number), along with their captured output. Output of jobs not in the job table is left alone,
+    their job may still be on its way.
+    """
     min_utc_seconds = from_any_time_to_utc_seconds(local_now() - datetime.timedelta(hours=minimum_age_hours))
-    query = "DELETE FROM job " \
-            "WHERE job_end_time_utc_epoch_seconds IS NOT NULL "\
-            "AND job_end_time_utc_epoch_seconds < ? "
+    condition = "job_end_time_utc_epoch_seconds IS NOT NULL " \
+                "AND job_end_time_utc_epoch_seconds < ? "
     params = [min_utc_seconds]
     if maximum_sequence_number is not None:
-        query += "AND last_updated_sequence_number <= ?"
+        condition += "AND last_updated_sequence_number <= ?"
         params.append(maximum_sequence_number)
     with cursor_manager(transaction) as c:
         c.execute(
-            query,
+            "DELETE FROM job_output_chunk WHERE job_uuid IN (SELECT job_uuid FROM job WHERE " + condition + ")",
+            params
+        )
+        c.execute(
+            "DELETE FROM job WHERE " + condition,
             params
         )
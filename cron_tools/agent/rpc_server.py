@@ -1,28 +1,128 @@
+import errno
+import logging
+import os
 import socket
 import struct
+import threading
+import time
 from six.moves import socketserver
 
-from cron_tools.common.rpc import BaseRPCServerHandler
+from cron_tools.common.rpc import BaseRPCServerHandler, RPCErrorCodes
+from cron_tools.common.rpc_codecs import codec_for_magic_byte
+from cron_tools.common.rpc_client import send_frame, send_message, MAX_MESSAGE_BYTES, RPCMessageTooLarge
 from cron_tools.common.models import AgentJob
-from cron_tools.agent.queries import immediate_transaction_manager, add_job, update_job_end_time_and_status, \
-    get_all_jobs, cleanup_db, get_all_active_jobs
+from cron_tools.common.output import output_chunk_to_blob, blob_to_output_chunk
+from cron_tools.agent.admission import AdmissionController, peer_credentials, peer_uid, \
+    enable_datagram_credentials, receive_datagram
+from cron_tools.agent.config import AgentConfiguration
+from cron_tools.agent.group_commit import run_write as run_group_committed_write
+from cron_tools.agent.queries import add_job, update_job_end_time_and_status, \
+    get_all_jobs, cleanup_db, get_all_active_jobs, add_job_output_chunk, get_job_output_chunks
 
-MAGIC_BYTE = b'\x5A'
+rpc_server_logger = logging.getLogger(__name__)
 
 
-class AgentRPCHandler(socketserver.BaseRequestHandler):
+def handle_message(handler, message):
+    """
+    Handle one message of the seqpacket or datagram transports: the codec's magic byte, then the payload. Returns
+    the codec and the encoded response, or None if there is nothing to answer.
+    """
+    codec = codec_for_magic_byte(bytes(message[:1]))
+    if codec is None:
+        rpc_server_logger.warning("Dropped an RPC message with an unknown magic byte.")
+        return None
+    raw_response = handler.handle_request(message[1:], codec)
+    if raw_response is None:
+        return None
+    return codec, raw_response
+
+
+def shed_message(handler, message):
+    """
+    Like handle_message, for a message the agent sheds without handling it.
+    """
+    codec = codec_for_magic_byte(bytes(message[:1]))
+    if codec is None:
+        return None
+    raw_response = shed_response(handler, message[1:], codec)
+    if raw_response is None:
+        return None
+    return codec, raw_response
+
+
+def too_large_response(codec):
+    return codec.encode(BaseRPCServerHandler.error_response(
+        "The response does not fit in a message, make the call over the stream socket.",
+        RPCErrorCodes.INTERNAL_ERROR.value
+    ))
+
+
+def shed_response(handler, raw_payload, codec):
+    """
+    The encoded response to a request payload the agent sheds without handling it, or None if it only had
+    notifications in it.
+    """
+    try:
+        parsed = codec.decode(raw_payload)
+    except ValueError:
+        parsed = None
+    response = handler.error_responses(
+        parsed, "The agent is over its admission limits, try again later.", RPCErrorCodes.SERVER_OVERLOADED.value
+    )
+    return codec.encode(response) if response is not None else None
+
+
+def unlink_socket(socket_addr):
+    try:
+        os.unlink(socket_addr)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+class AgentConnectionHandler(socketserver.BaseRequestHandler):
+    """
+    Counts the connection against the admission limits of its peer's uid for as long as it is open. Every request on
+    a connection over the limits is shed, and the connection is closed after answering the first.
+    """
+
+    def setup(self):
+        self.uid = peer_uid(peer_credentials(self.request))
+        self.admitted = self.server.admission.connection_opened(self.uid)
+
+    def finish(self):
+        if self.admitted:
+            self.server.admission.connection_closed(self.uid)
+
+    def admit_request(self):
+        """
+        Whether to handle the next request, after holding it back for as long as admission control says to.
+        """
+        if not self.admitted:
+            return False
+        delay = self.server.admission.request_delay(self.uid)
+        if delay is None:
+            return False
+        if delay:
+            time.sleep(delay)
+        return True
+
+
+class AgentRPCHandler(AgentConnectionHandler):
     def recv_bytes(self, amount):
         data = bytearray()
         delta = True
         while len(data) < amount and delta:
-            delta = self.request.recv(min(8192, amount))
+            delta = self.request.recv(min(65536, amount - len(data)))
             data.extend(delta)
         return data
 
     def handle(self):
         while True:
             magic_byte = self.request.recv(1)
-            if magic_byte != MAGIC_BYTE or not magic_byte:
+            # The magic byte names the codec of the payload; the response goes back in the same one.
+            codec = codec_for_magic_byte(magic_byte) if magic_byte else None
+            if codec is None:
                 self.request.shutdown(socket.SHUT_RDWR)
                 self.request.close()
                 return
@@ -37,14 +137,106 @@ class AgentRPCHandler(socketserver.BaseRequestHandler):
                 self.request.shutdown(socket.SHUT_RDWR)
                 self.request.close()
                 return
-            raw_response = self.server.handler.handle_request(raw_payload)
-            self.request.sendall(MAGIC_BYTE + struct.pack('!L', len(raw_response)))
-            self.request.sendall(raw_response)
+            if self.admit_request():
+                raw_response = self.server.handler.handle_request(raw_payload, codec)
+            else:
+                raw_response = shed_response(self.server.handler, raw_payload, codec)
+            if raw_response is not None:
+                send_frame(self.request, codec.magic_byte, raw_response)
+            if not self.admitted:
+                self.request.close()
+                return
+
+
+class AgentSeqpacketRPCHandler(AgentConnectionHandler):
+    def handle(self):
+        # One byte to spare, so that a message filling all of it was one too long and got truncated.
+        buffer = bytearray(MAX_MESSAGE_BYTES + 1)
+        while True:
+            received = self.request.recv_into(buffer)
+            if not received or received > MAX_MESSAGE_BYTES:
+                self.request.close()
+                return
+            if self.admit_request():
+                answer = handle_message(self.server.handler, memoryview(buffer)[:received])
+            else:
+                answer = shed_message(self.server.handler, memoryview(buffer)[:received])
+            if answer is not None:
+                codec, raw_response = answer
+                try:
+                    send_message(self.request, codec.magic_byte, raw_response)
+                except RPCMessageTooLarge:
+                    send_message(self.request, codec.magic_byte, too_large_response(codec))
+            if not self.admitted:
+                self.request.close()
+                return
+
+
+class AgentDatagramRPCHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        data, _ = self.request
+        if len(data) > MAX_MESSAGE_BYTES:
+            rpc_server_logger.warning("Dropped an RPC datagram too large to have been received whole.")
+            return
+        # The client address of a datagram is the credentials of its sender. Holding one back would hold back every
+        # sender's, so any datagram over the rate limits is dropped.
+        if self.server.admission.request_delay(peer_uid(self.client_address), queue=False) is None:
+            return
+        # Nobody to answer to, datagram senders only send notifications.
+        handle_message(self.server.handler, memoryview(data))
+
+
+class AgentUnixSeqpacketRPCServer(socketserver.ThreadingUnixStreamServer):
+    socket_type = socket.SOCK_SEQPACKET
+    request_queue_size = socket.SOMAXCONN
+    # Closing the server does not wait for wrappers to hang up.
+    daemon_threads = True
+    block_on_close = False
+
+    def __init__(self, socket_addr, handler, admission):
+        self.handler = handler
+        self.admission = admission
+        socketserver.ThreadingUnixStreamServer.__init__(self, socket_addr, AgentSeqpacketRPCHandler)
+
+
+class AgentUnixDatagramRPCServer(socketserver.UnixDatagramServer):
+    """
+    Handles datagrams one at a time in the serving thread, so that the notifications of a wrapper are applied in
+    the order they were sent.
+    """
+
+    max_packet_size = MAX_MESSAGE_BYTES + 1
+
+    def __init__(self, socket_addr, handler, admission):
+        self.handler = handler
+        self.admission = admission
+        socketserver.UnixDatagramServer.__init__(self, socket_addr, AgentDatagramRPCHandler)
+
+    def server_bind(self):
+        socketserver.UnixDatagramServer.server_bind(self)
+        enable_datagram_credentials(self.socket)
+
+    def get_request(self):
+        data, credentials = receive_datagram(self.socket, self.max_packet_size)
+        return (data, self.socket), credentials
+
+
+MESSAGE_SERVER_CLASSES = {
+    socket.SOCK_SEQPACKET: AgentUnixSeqpacketRPCServer,
+    socket.SOCK_DGRAM: AgentUnixDatagramRPCServer
+}
 
 
 class AgentUnixStreamRPCServer(socketserver.ThreadingUnixStreamServer):
-    def __init__(self, socket_addr, bind_and_activate=True):
+    # Wrappers connecting with a timeout get EAGAIN rather than waiting once the listen backlog is full.
+    request_queue_size = socket.SOMAXCONN
+
+    def __init__(self, socket_addr, bind_and_activate=True, admission=None):
         self.handler = BaseRPCServerHandler()
+        self.admission = admission if admission is not None else AdmissionController()
+        # Listeners for the seqpacket and datagram transports, served alongside this one.
+        self.listeners = []
+        self._listener_threads = []
         socketserver.ThreadingUnixStreamServer.__init__(
             self,
             socket_addr,
@@ -52,11 +244,48 @@ class AgentUnixStreamRPCServer(socketserver.ThreadingUnixStreamServer):
             bind_and_activate=bind_and_activate
         )
 
-    def register_function(self, name, function):
-        return self.handler.register_function(name, function)
+    def register_function(self, name, function, write=False):
+        return self.handler.register_function(name, function, write=write)
+
+    def set_batch_transaction(self, batch_transaction):
+        self.handler.batch_transaction = batch_transaction
+
+    def add_listener(self, socket_type, socket_addr):
+        """
+        Also serve the registered functions on a SOCK_SEQPACKET or SOCK_DGRAM socket at socket_addr.
+        """
+        self.listeners.append(MESSAGE_SERVER_CLASSES[socket_type](socket_addr, self.handler, self.admission))
+
+    def serve_forever(self, poll_interval=0.5):
+        self._listener_threads = [threading.Thread(target=listener.serve_forever) for listener in self.listeners]
+        for thread in self._listener_threads:
+            thread.start()
+        try:
+            socketserver.ThreadingUnixStreamServer.serve_forever(self, poll_interval)
+        finally:
+            for listener in self.listeners:
+                listener.shutdown()
+            for thread in self._listener_threads:
+                thread.join()
 
+    def server_close(self):
+        socketserver.ThreadingUnixStreamServer.server_close(self)
+        for listener in self.listeners:
+            listener.server_close()
+            unlink_socket(listener.server_address)
+
+
+def attach_agent_functions(agent_server, connection_pool, output_retention=None, heartbeats=None,
+                           start_slots=None, writer=None):
+    output_retention = dict(AgentConfiguration.OPTIONAL_PARAMETERS['output_retention'], **(output_retention or {}))
+
+    def run_write(operation, size=0):
+        return run_group_committed_write(writer, connection_pool, operation, size)
+
+    # Batches containing writes are run whole as one write, each write method's own transaction becoming a savepoint
+    # inside it.
+    agent_server.set_batch_transaction(lambda handle_batch: run_write(lambda t: handle_batch()))
 
-def attach_agent_functions(agent_server, connection_pool):
     def ping():
         return {
             "response": "pong"
@@ -75,24 +304,71 @@ def attach_agent_functions(agent_server, connection_pool):
 
     def add_new_job(raw_job_record):
         job_record = AgentJob.deserialize(raw_job_record)
-        connection = connection_pool.get()
-        with immediate_transaction_manager(connection) as t:
-            record = add_job(t, job_record)
+        record = run_write(lambda t: add_job(t, job_record))
         return {
             'record': record.serialize()
         }
 
-    agent_server.register_function("add_new_job", add_new_job)
+    agent_server.register_function("add_new_job", add_new_job, write=True)
 
-    def update_job_end_time_and_status_code(job_uuid, job_end_time, job_status_code):
-        connection = connection_pool.get()
-        with immediate_transaction_manager(connection) as t:
-            updated_info = update_job_end_time_and_status(t, job_uuid, job_end_time, job_status_code)
+    def update_job_end_time_and_status_code(job_uuid, job_end_time, job_status_code, job_resource_usage=None):
+        updated_info = run_write(lambda t: update_job_end_time_and_status(
+            t, job_uuid, job_end_time, job_status_code, job_resource_usage
+        ))
         return {
             'updated_info': updated_info
         }
 
-    agent_server.register_function("update_job_end_time_and_status_code", update_job_end_time_and_status_code)
+    agent_server.register_function(
+        "update_job_end_time_and_status_code", update_job_end_time_and_status_code, write=True
+    )
+
+    def append_job_output(job_uuid, stream_name, sequence_number, data, raw_length):
+        blob = output_chunk_to_blob(data)
+        retained_as_head = run_write(lambda t: add_job_output_chunk(
+            t, job_uuid, stream_name, sequence_number, blob, raw_length, output_retention['head_bytes'],
+            output_retention['tail_bytes']
+        ), len(blob))
+        return {
+            'retained_as_head': retained_as_head
+        }
+
+    agent_server.register_function("append_job_output", append_job_output, write=True)
+
+    def get_job_output(job_uuid, stream_name=None):
+        connection = connection_pool.get()
+        return {
+            'chunks': [
+                {
+                    'stream_name': chunk_stream_name,
+                    'sequence_number': sequence_number,
+                    'raw_length': raw_length,
+                    'data': blob_to_output_chunk(compressed_data)
+                }
+                for chunk_stream_name, sequence_number, raw_length, compressed_data
+                in get_job_output_chunks(connection, job_uuid, stream_name)
+            ]
+        }
+
+    agent_server.register_function("get_job_output", get_job_output)
+
+    def job_heartbeat(job_uuid, heartbeat_time):
+        if heartbeats is not None:
+            heartbeats.record(job_uuid, heartbeat_time)
+        return {
+            'success': heartbeats is not None
+        }
+
+    agent_server.register_function("job_heartbeat", job_heartbeat)
+
+    def assign_start_delay(job_name, job_host, window_seconds):
+        if start_slots is None:
+            raise ValueError("Start slot assignment is not enabled on this agent.")
+        return {
+            'delay_seconds': start_slots.assign(job_host, job_name, window_seconds)
+        }
+
+    agent_server.register_function("assign_start_delay", assign_start_delay)
 
     def get_recent_jobs(limit=200, offset=None):
         connection = connection_pool.get()
@@ -108,11 +384,37 @@ def attach_agent_functions(agent_server, connection_pool):
         jobs = get_all_active_jobs(
             connection, limit=limit, offset=offset, order_by="job_start_time_utc_epoch_seconds DESC"
         )
+        now = time.time()
+        active_jobs = []
+        for job in jobs:
+            raw_job = job.serialize()
+            # Heartbeats not yet flushed to the database are newer than the stored one.
+            heartbeat_times = [
+                t for t in (
+                    raw_job['job_last_heartbeat_utc_epoch_seconds'],
+                    heartbeats.latest(job.uuid) if heartbeats is not None else None
+                ) if t is not None
+            ]
+            last_heartbeat = max(heartbeat_times) if heartbeat_times else None
+            raw_job['job_last_heartbeat_utc_epoch_seconds'] = last_heartbeat
+            raw_job['job_last_heartbeat_age_seconds'] = now - last_heartbeat if last_heartbeat is not None else None
+            active_jobs.append(raw_job)
         return {
-            'active_jobs': [j.serialize() for j in jobs]
+            'active_jobs': active_jobs
         }
     agent_server.register_function("get_active_jobs", get_active_jobs)
 
+    def get_rpc_stats():
+        stats = agent_server.handler.stats.snapshot()
+        admission = getattr(agent_server, 'admission', None)
+        if admission is not None:
+            stats['admission'] = admission.snapshot()
+        if writer is not None:
+            stats['group_commit'] = writer.snapshot()
+        return stats
+
+    agent_server.register_function("get_rpc_stats", get_rpc_stats)
+
     def send_job_alert(job_uuid, alert_message):
         pass  # TODO: Implement this.
 
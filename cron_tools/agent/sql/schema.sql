@@ -11,7 +11,12 @@ CREATE TABLE IF NOT EXISTS job(
     job_end_time_utc_epoch_seconds REAL,
     created_time_utc_epoch_seconds REAL NOT NULL,
     last_updated_time_utc_epoch_seconds REAL NOT NULL,
-    last_updated_sequence_number INTEGER NOT NULL
+    last_updated_sequence_number INTEGER NOT NULL,
+    job_resource_usage_json TEXT,
+    job_lock_wait_seconds REAL,
+    job_last_heartbeat_utc_epoch_seconds REAL,
+    job_start_delay_seconds REAL,
+    job_scheduling_json TEXT
 );
 
 CREATE TABLE IF NOT EXISTS counter(
@@ -22,4 +27,14 @@ CREATE TABLE IF NOT EXISTS counter(
 CREATE TABLE IF NOT EXISTS key_value_store(
     key_name TEXT PRIMARY KEY,
     value_json TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS job_output_chunk(
+    job_uuid TEXT NOT NULL,
+    stream_name TEXT NOT NULL,
+    sequence_number INTEGER NOT NULL,
+    raw_length INTEGER NOT NULL,
+    compressed_data BLOB NOT NULL,
+    is_head INTEGER NOT NULL,
+    PRIMARY KEY (job_uuid, stream_name, sequence_number)
 );
\ No newline at end of file
@@ -0,0 +1,48 @@
+"""
+Agent assigned start slots for staggered wrapper starts.
+"""
+import math
+import numbers
+import threading
+import time
+
+from cron_tools.common.stagger import hashed_start_fraction
+
+
+class StartSlotAllocator(object):
+    """
+    Hands out start delays so that jobs asking within the same window are spread evenly over it. The window is cut
+    into slot_seconds wide slots and each job gets the least used one, starting from the slot its hash points at, so
+    that a job without competition keeps the same start offset every run.
+
+    Windows come from the wrappers, so they are capped at max_window_seconds: the slots of a window are scanned
+    under the lock.
+    """
+
+    def __init__(self, slot_seconds=1.0, max_window_seconds=3600.0):
+        self.slot_seconds = slot_seconds
+        self.max_window_seconds = max_window_seconds
+        self._lock = threading.Lock()
+        self._slot_usage = {}
+
+    def assign(self, job_host, job_name, window_seconds, now=None):
+        if isinstance(window_seconds, bool) or not isinstance(window_seconds, numbers.Real) \
+                or not window_seconds > 0:
+            raise ValueError("The stagger window must be a positive number of seconds, not {0!r}.".format(
+                window_seconds
+            ))
+        window_seconds = min(window_seconds, self.max_window_seconds)
+        now = time.time() if now is None else now
+        first_slot = int(math.ceil(now / self.slot_seconds))
+        slot_count = max(1, int(window_seconds // self.slot_seconds))
+        preferred = int(hashed_start_fraction(job_host, job_name) * slot_count)
+        with self._lock:
+            for slot in [s for s in self._slot_usage if s < first_slot]:
+                del self._slot_usage[slot]
+            offset = min(
+                range(slot_count),
+                key=lambda i: (self._slot_usage.get(first_slot + (preferred + i) % slot_count, 0), i)
+            )
+            slot = first_slot + (preferred + offset) % slot_count
+            self._slot_usage[slot] = self._slot_usage.get(slot, 0) + 1
+        return max(0.0, slot * self.slot_seconds - now)
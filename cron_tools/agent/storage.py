@@ -0,0 +1,96 @@
+"""
+Storage profiles for the agent's SQLite spool: the pragmas set on every connection, trading durability on power loss
+for write throughput, and WAL checkpointing.
+"""
+import os
+
+from cron_tools.common.config import ConfigurationException
+
+# Pragmas a profile sets, in the order they are applied: busy_timeout first, so that switching the journal mode
+# waits out other connections rather than failing on them.
+STORAGE_PRAGMAS = ('busy_timeout', 'journal_mode', 'synchronous', 'mmap_size', 'cache_size', 'temp_store')
+
+STORAGE_PROFILE_DURABLE = 'durable'
+STORAGE_PROFILE_BALANCED = 'balanced'
+STORAGE_PROFILE_FAST = 'fast'
+
+# All use WAL, so that readers and the writer no longer block each other.
+#  durable: fsyncs every commit, as the rollback journal did. Nothing committed is lost on power loss.
+#  balanced: fsyncs at checkpoints only. Still never corrupts, but the last commits can be lost on power loss.
+#  fast: never fsyncs. An OS crash or power loss can corrupt the spool; an agent crash loses nothing.
+STORAGE_PROFILES = {
+    STORAGE_PROFILE_DURABLE: {
+        'busy_timeout': 5000,
+        'journal_mode': 'WAL',
+        'synchronous': 'FULL',
+        'mmap_size': 0,
+        'cache_size': -2000,
+        'temp_store': 'DEFAULT'
+    },
+    STORAGE_PROFILE_BALANCED: {
+        'busy_timeout': 5000,
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'mmap_size': 64 * 1024 * 1024,
+        'cache_size': -16000,
+        'temp_store': 'MEMORY'
+    },
+    STORAGE_PROFILE_FAST: {
+        'busy_timeout': 10000,
+        'journal_mode': 'WAL',
+        'synchronous': 'OFF',
+        'mmap_size': 256 * 1024 * 1024,
+        'cache_size': -64000,
+        'temp_store': 'MEMORY'
+    }
+}
+
+WAL_CHECKPOINT_PASSIVE = 'PASSIVE'
+WAL_CHECKPOINT_TRUNCATE = 'TRUNCATE'
+
+
+def storage_pragmas(profile, overrides=None):
+    """
+    The pragmas of a named profile, with any of them overridden. Without a profile only the overrides are set, and
+    the database keeps whatever journal mode it already has.
+    """
+    if profile is not None and profile not in STORAGE_PROFILES:
+        raise ConfigurationException("Unknown storage_profile: {0}".format(profile))
+    pragmas = dict(STORAGE_PROFILES[profile]) if profile is not None else {}
+    for name, value in (overrides or {}).items():
+        if name not in STORAGE_PRAGMAS:
+            raise ConfigurationException("Unsupported storage pragma: {0}".format(name))
+        # Pragma values cannot be bound as parameters, so only plain numbers and keywords are let through.
+        if not isinstance(value, int) and not str(value).isalnum():
+            raise ConfigurationException("Bad value for storage pragma {0}: {1!r}".format(name, value))
+        pragmas[name] = value
+    return pragmas
+
+
+def apply_pragmas(connection, pragmas):
+    ordered = [name for name in STORAGE_PRAGMAS if name in pragmas]
+    for name in ordered + sorted(set(pragmas) - set(ordered)):
+        connection.execute("PRAGMA {0} = {1}".format(name, pragmas[name])).fetchall()
+
+
+def wal_size(database_path):
+    try:
+        return os.path.getsize(database_path + '-wal')
+    except OSError:
+        return 0
+
+
+def checkpoint_wal(connection, database_path, passive_bytes, truncate_bytes):
+    """
+    Checkpoint the WAL of database_path once it has grown past passive_bytes. Past truncate_bytes the checkpoint
+    waits for readers and writers and truncates the file, which otherwise never shrinks. Returns the checkpoint mode
+    run (None if none was) and the result row: whether it was blocked, the WAL frames and the frames checkpointed.
+    """
+    size = wal_size(database_path)
+    if size >= truncate_bytes:
+        mode = WAL_CHECKPOINT_TRUNCATE
+    elif size >= passive_bytes:
+        mode = WAL_CHECKPOINT_PASSIVE
+    else:
+        return None, None
+    return mode, tuple(connection.execute("PRAGMA wal_checkpoint({0})".format(mode)).fetchone())
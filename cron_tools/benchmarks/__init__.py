@@ -0,0 +1,4 @@
+"""
+Benchmarks for cron-tools components, each runnable as a module (python -m cron_tools.benchmarks.<name>)
+or through the ct-benchmark console script (ct-benchmark <name>).
+"""
@@ -0,0 +1,113 @@
+"""
+Agent connection load test. Starts the agent as a separate process in each RPC server mode and opens wrapper-like
+connections to it in steps up to a few thousand, all kept open. At every step each open connection sends an
+add_new_job at once (pipelined, the way wrappers pile up at the top of the hour), and the time until every response
+is in is recorded along with the agent's resident memory and thread count.
+"""
+import argparse
+import json
+import shutil
+import socket
+import sys
+import tempfile
+import time
+
+from cron_tools.common.rpc import BaseRPCClientHandler
+from cron_tools.common.rpc_client import send_frame, FRAME_HEADER, MAGIC_BYTE
+from cron_tools.benchmarks.common import sample_job, start_agent_process, read_process_status, \
+    raise_open_file_limit
+
+SERVER_MODES = ('threading', 'asyncio')
+
+load_argument_parser = argparse.ArgumentParser(description="Load test the agent RPC server with many connections.")
+load_argument_parser.add_argument(
+    "--steps", type=int, nargs="+", default=[10, 100, 500, 1000, 2000], help="Open connection counts to measure at."
+)
+load_argument_parser.add_argument(
+    "--modes", choices=SERVER_MODES, nargs="+", default=list(SERVER_MODES), help="RPC server modes to test."
+)
+load_argument_parser.add_argument("--python", type=str, default=sys.executable, help="Interpreter to run the agent.")
+load_argument_parser.add_argument("-j", "--json-output", action="store_true", help="Format output as JSON.")
+
+
+def recv_exactly(sock, amount):
+    data = bytearray()
+    while len(data) < amount:
+        received = sock.recv(amount - len(data))
+        if not received:
+            raise IOError("The agent closed the connection.")
+        data.extend(received)
+    return bytes(data)
+
+
+def add_jobs_on_every_connection(connections, client_handler):
+    started = time.time()
+    for sock in connections:
+        send_frame(sock, MAGIC_BYTE, client_handler.marshal_request("add_new_job", {'raw_job_record': sample_job(0)}))
+    errors = 0
+    for sock in connections:
+        _, length = FRAME_HEADER.unpack(recv_exactly(sock, FRAME_HEADER.size))
+        try:
+            client_handler.unmarshal_response(recv_exactly(sock, length))
+        except Exception:
+            errors += 1
+    return time.time() - started, errors
+
+
+def run_mode(python, mode, steps):
+    tempdir = tempfile.mkdtemp()
+    agent = None
+    connections = []
+    results = []
+    try:
+        agent, socket_path = start_agent_process(python, tempdir, mode)
+        client_handler = BaseRPCClientHandler()
+        idle_status = read_process_status(agent.pid)
+        for step in sorted(steps):
+            while len(connections) < step:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                sock.connect(socket_path)
+                connections.append(sock)
+            elapsed, errors = add_jobs_on_every_connection(connections, client_handler)
+            result = {
+                'connections': step,
+                'all_responses_seconds': elapsed,
+                'errors': errors
+            }
+            result.update(read_process_status(agent.pid))
+            results.append(result)
+    finally:
+        for sock in connections:
+            sock.close()
+        if agent is not None:
+            agent.terminate()
+            agent.wait()
+        shutil.rmtree(tempdir)
+    return {'idle': idle_status, 'steps': results}
+
+
+def run_benchmark(python=sys.executable, modes=SERVER_MODES, steps=(10, 100, 500, 1000, 2000)):
+    raise_open_file_limit(max(steps) + 256)
+    return dict((mode, run_mode(python, mode, steps)) for mode in modes)
+
+
+def main(args=None):
+    args = args or load_argument_parser.parse_args()
+    results = run_benchmark(args.python, args.modes, args.steps)
+    if args.json_output:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        for mode in args.modes:
+            idle = results[mode]['idle']
+            print("{0}: idle {1:.1f}MB RSS, {2} threads".format(mode, idle['rss_mb'], idle['threads']))
+            for step in results[mode]['steps']:
+                print("  {0:>6} connections: {1:7.3f}s for all responses, {2:7.1f}MB RSS, {3:>5} threads, "
+                      "{4} errors".format(
+                          step['connections'], step['all_responses_seconds'], step['rss_mb'], step['threads'],
+                          step['errors']
+                      ))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
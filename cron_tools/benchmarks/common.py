@@ -0,0 +1,122 @@
+"""
+Helpers shared by the benchmarks (and the tests built on them): sample job records, summary statistics and running a
+throwaway agent, in process or as its own process.
+"""
+import json
+import os
+import resource
+import subprocess
+import threading
+import time
+
+from cron_tools.common.models import AgentJob, generate_job_uuid
+
+
+def median(values):
+    ordered = sorted(values)
+    middle = len(ordered) // 2
+    if len(ordered) % 2:
+        return ordered[middle]
+    return (ordered[middle - 1] + ordered[middle]) / 2.0
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def peak_concurrency(intervals):
+    events = sorted([(start, 1) for start, _ in intervals] + [(end, -1) for _, end in intervals])
+    running = peak = 0
+    for _, change in events:
+        running += change
+        peak = max(peak, running)
+    return peak
+
+
+def sample_job(index, finished=True):
+    now = time.time()
+    return AgentJob(
+        job_id=index if finished else None,
+        uuid=generate_job_uuid(),
+        name="nightly-backup-{0}".format(index % 50),
+        args=["/usr/local/bin/backup", "--target", "/srv/data", "--verbose"],
+        user="backup",
+        host="worker-17.example.com",
+        tags=["nightly", "batch:" + generate_job_uuid()],
+        status_code=0 if finished else None,
+        start_time=now - 3600,
+        end_time=now - 3000 if finished else None,
+        created_time=now - 3600,
+        last_updated_time=now - 3000,
+        last_updated_sequence_number=index * 2 if finished else None,
+        resource_usage={
+            'user_cpu_seconds': 12.5, 'system_cpu_seconds': 3.25, 'max_rss_kb': 81234,
+            'block_input_operations': 1024, 'block_output_operations': 20480,
+            'voluntary_context_switches': 5000, 'involuntary_context_switches': 120
+        } if finished else None,
+        lock_wait_seconds=0.0015,
+        start_delay_seconds=1.25
+    ).serialize()
+
+
+def read_process_status(pid):
+    status = {}
+    with open('/proc/{0}/status'.format(pid), 'rb') as f:
+        for line in f:
+            if line.startswith(b'VmRSS:'):
+                status['rss_mb'] = int(line.split()[1]) / 1024.0
+            elif line.startswith(b'Threads:'):
+                status['threads'] = int(line.split()[1])
+    return status
+
+
+def raise_open_file_limit(needed):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != resource.RLIM_INFINITY and soft < needed:
+        new_soft = needed if hard == resource.RLIM_INFINITY else min(needed, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (new_soft, hard))
+
+
+def start_agent(tempdir, extra_config=None):
+    from cron_tools.agent.app import build_app, agent_argument_parser
+    from cron_tools.agent.config import AgentConfiguration
+
+    socket_path = os.path.join(tempdir, 'agent.sock')
+    raw_config = {
+        'sqlite_database_path': os.path.join(tempdir, 'agent.db'),
+        'listen_socket_path': socket_path,
+        'journal_path': os.path.join(tempdir, 'journal'),
+        'logging_config': {'version': 1, 'incremental': True}
+    }
+    raw_config.update(extra_config or {})
+    config = AgentConfiguration.load(raw_config)
+    run, shutdown = build_app(args=agent_argument_parser.parse_args(args=[]), config=config)
+    agent_thread = threading.Thread(target=run)
+    agent_thread.daemon = True
+    agent_thread.start()
+    while not os.path.exists(socket_path):
+        time.sleep(0.01)
+    return socket_path, shutdown, agent_thread
+
+
+def start_agent_process(python, tempdir, mode, extra_config=None):
+    socket_path = os.path.join(tempdir, 'agent.sock')
+    config_path = os.path.join(tempdir, 'agent.json')
+    raw_config = {
+        'sqlite_database_path': os.path.join(tempdir, 'agent.db'),
+        'listen_socket_path': socket_path,
+        'journal_path': os.path.join(tempdir, 'journal'),
+        'rpc_server_mode': mode,
+        'logging_config': {'version': 1, 'incremental': True}
+    }
+    raw_config.update(extra_config or {})
+    with open(config_path, 'w') as f:
+        json.dump(raw_config, f)
+    agent = subprocess.Popen([python, '-c', 'from cron_tools.agent.app import main; main()', '-f', config_path])
+    while not os.path.exists(socket_path):
+        if agent.poll() is not None:
+            raise RuntimeError("The agent exited with status {0}".format(agent.returncode))
+        time.sleep(0.01)
+    return agent, socket_path
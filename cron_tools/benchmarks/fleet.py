@@ -0,0 +1,267 @@
+"""
+Fleet load benchmark: how many wrapped jobs per second one agent absorbs. Starts the agent (cron_tools.agent.app, as
+its own process against a throwaway SQLite database) and drives it with N concurrent simulated wrappers for a fixed
+time. Each one loops like a real wrapper would: connect, add_new_job, now and then get_active_jobs (as a monitor or
+ct-agent-admin would), let the job "run" for a random while, update_job_end_time_and_status_code, hang up.
+
+Reports jobs and calls per second, p50/p99/p999 latency and errors per method, the agent's peak RSS and thread count
+and the size of its database. The JSON output (-j, or --output FILE) can be handed back as --baseline to a later run,
+which then fails if throughput or any p99 got worse by more than --tolerance.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from cron_tools.common.rpc_client import RPCClient
+from cron_tools.benchmarks.common import percentile, sample_job, start_agent_process, read_process_status, \
+    raise_open_file_limit
+
+FLEET_METHODS = ('add_new_job', 'get_active_jobs', 'update_job_end_time_and_status_code')
+
+fleet_argument_parser = argparse.ArgumentParser(description="Load the agent with a fleet of simulated wrappers.")
+fleet_argument_parser.add_argument(
+    "-w", "--wrappers", type=int, nargs="+", default=[50], help="Concurrent simulated wrappers, one run per count."
+)
+fleet_argument_parser.add_argument("-d", "--duration", type=float, default=10.0, help="Seconds each run lasts.")
+fleet_argument_parser.add_argument(
+    "--job-seconds", type=float, default=0.05, help="Mean simulated job run time between start and end reports."
+)
+fleet_argument_parser.add_argument(
+    "--active-jobs-ratio", type=float, default=0.1, help="Fraction of jobs during which get_active_jobs is called."
+)
+fleet_argument_parser.add_argument(
+    "--server-mode", choices=('auto', 'threading', 'asyncio'), default='auto', help="The agent's rpc_server_mode."
+)
+fleet_argument_parser.add_argument("--codec", type=str, default='json', help="RPC codec the wrappers use.")
+fleet_argument_parser.add_argument(
+    "--storage-profile", type=str, default=None, help="The agent's storage_profile, its default if not given."
+)
+fleet_argument_parser.add_argument(
+    "--agent-config", type=json.loads, default=None, help="JSON object of further agent configuration settings."
+)
+fleet_argument_parser.add_argument("--python", type=str, default=sys.executable, help="Interpreter to run the agent.")
+fleet_argument_parser.add_argument("-o", "--output", type=str, default=None, help="Also write JSON results here.")
+fleet_argument_parser.add_argument(
+    "--baseline", type=str, default=None, help="JSON results of an earlier run to compare against."
+)
+fleet_argument_parser.add_argument(
+    "--tolerance", type=float, default=0.2, help="Fail when worse than the baseline by more than this fraction."
+)
+fleet_argument_parser.add_argument("-j", "--json-output", action="store_true", help="Format output as JSON.")
+
+
+def simulated_wrapper(socket_path, codec, deadline, job_seconds, active_jobs_ratio, seed, latencies, outcome):
+    """
+    Runs jobs back to back until the deadline, recording the latency of every call in latencies (method -> list of
+    milliseconds) and the jobs completed and calls failed in outcome.
+    """
+    rng = random.Random(seed)
+
+    def timed_call(client, method, params):
+        started = time.time()
+        try:
+            return client.handle_rpc_call(method, params)
+        except Exception:
+            outcome['errors'][method] += 1
+            raise
+        finally:
+            latencies[method].append((time.time() - started) * 1000.0)
+
+    index = 0
+    while time.time() < deadline:
+        client = RPCClient(socket_path, timeout=60, codec=codec, reconnect_attempts=3)
+        try:
+            record = timed_call(client, "add_new_job", {'raw_job_record': sample_job(index, finished=False)})
+            if rng.random() < active_jobs_ratio:
+                timed_call(client, "get_active_jobs", {'limit': 100})
+            if job_seconds:
+                time.sleep(rng.uniform(0, 2 * job_seconds))
+            timed_call(client, "update_job_end_time_and_status_code", {
+                'job_uuid': record['record']['job_uuid'],
+                'job_end_time': time.time(),
+                'job_status_code': 0 if rng.random() < 0.95 else 1,
+                'job_resource_usage': {'user_cpu_seconds': 0.5, 'system_cpu_seconds': 0.1, 'max_rss_kb': 20480}
+            })
+            outcome['jobs'] += 1
+        except Exception:
+            pass
+        finally:
+            client.disconnect()
+        index += 1
+
+
+def watch_agent(pid, stop, peaks):
+    while not stop.is_set():
+        try:
+            status = read_process_status(pid)
+        except (IOError, OSError):
+            return
+        for key in ('rss_mb', 'threads'):
+            peaks[key] = max(peaks.get(key, 0), status.get(key, 0))
+        stop.wait(0.2)
+
+
+def database_size_mb(database_path):
+    return sum(
+        os.path.getsize(path) for path in (database_path, database_path + '-wal', database_path + '-shm')
+        if os.path.exists(path)
+    ) / (1024.0 * 1024.0)
+
+
+def run_fleet(wrappers, duration=10.0, job_seconds=0.05, active_jobs_ratio=0.1, server_mode='auto', codec='json',
+              python=sys.executable, agent_config=None):
+    tempdir = tempfile.mkdtemp()
+    agent = None
+    stop_watching = threading.Event()
+    peaks = {}
+    try:
+        agent, socket_path = start_agent_process(python, tempdir, server_mode, agent_config)
+        watcher = threading.Thread(target=watch_agent, args=(agent.pid, stop_watching, peaks))
+        watcher.daemon = True
+        watcher.start()
+        per_wrapper = [
+            (dict((method, []) for method in FLEET_METHODS),
+             {'jobs': 0, 'errors': dict((method, 0) for method in FLEET_METHODS)})
+            for _ in range(wrappers)
+        ]
+        started = time.time()
+        deadline = started + duration
+        threads = [
+            threading.Thread(target=simulated_wrapper, args=(
+                socket_path, codec, deadline, job_seconds, active_jobs_ratio, seed, latencies, outcome
+            ))
+            for seed, (latencies, outcome) in enumerate(per_wrapper)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - started
+        stop_watching.set()
+        watcher.join()
+        final_status = read_process_status(agent.pid)
+    finally:
+        stop_watching.set()
+        if agent is not None:
+            agent.terminate()
+            agent.wait()
+    try:
+        db_size_mb = database_size_mb(os.path.join(tempdir, 'agent.db'))
+    finally:
+        shutil.rmtree(tempdir)
+
+    methods = {}
+    for method in FLEET_METHODS:
+        ordered = sorted(latency for latencies, _ in per_wrapper for latency in latencies[method])
+        methods[method] = {
+            'calls': len(ordered),
+            'errors': sum(outcome['errors'][method] for _, outcome in per_wrapper),
+            'p50_ms': percentile(ordered, 0.5),
+            'p99_ms': percentile(ordered, 0.99),
+            'p999_ms': percentile(ordered, 0.999)
+        }
+    jobs = sum(outcome['jobs'] for _, outcome in per_wrapper)
+    return {
+        'wrappers': wrappers,
+        'seconds': elapsed,
+        'jobs': jobs,
+        'jobs_per_second': jobs / elapsed,
+        'calls_per_second': sum(m['calls'] for m in methods.values()) / elapsed,
+        'methods': methods,
+        'agent_peak_rss_mb': max(peaks.get('rss_mb', 0), final_status.get('rss_mb', 0)),
+        'agent_peak_threads': max(peaks.get('threads', 0), final_status.get('threads', 0)),
+        'database_mb': db_size_mb
+    }
+
+
+def run_benchmark(wrapper_counts=(50,), duration=10.0, job_seconds=0.05, active_jobs_ratio=0.1, server_mode='auto',
+                  codec='json', python=sys.executable, agent_config=None):
+    raise_open_file_limit(max(wrapper_counts) * 2 + 256)
+    return {
+        'parameters': {
+            'duration': duration, 'job_seconds': job_seconds, 'active_jobs_ratio': active_jobs_ratio,
+            'server_mode': server_mode, 'codec': codec, 'agent_config': agent_config
+        },
+        'environment': {
+            'python': platform.python_version(), 'platform': platform.platform(),
+            'cpus': os.sysconf('SC_NPROCESSORS_ONLN')
+        },
+        'runs': [
+            run_fleet(wrappers, duration, job_seconds, active_jobs_ratio, server_mode, codec, python, agent_config)
+            for wrappers in wrapper_counts
+        ]
+    }
+
+
+def regressions(results, baseline, tolerance):
+    """
+    Descriptions of every run (matched by wrapper count) whose throughput or per-method p99 is worse than the
+    baseline's by more than tolerance.
+    """
+    found = []
+    baseline_runs = dict((run['wrappers'], run) for run in baseline.get('runs', []))
+    for run in results['runs']:
+        before = baseline_runs.get(run['wrappers'])
+        if before is None:
+            continue
+        if run['jobs_per_second'] < before['jobs_per_second'] * (1 - tolerance):
+            found.append("{0} wrappers: {1:.1f} jobs/s, baseline {2:.1f}".format(
+                run['wrappers'], run['jobs_per_second'], before['jobs_per_second']
+            ))
+        for method, stats in sorted(run['methods'].items()):
+            before_p99 = before['methods'].get(method, {}).get('p99_ms')
+            if stats['p99_ms'] is not None and before_p99 and stats['p99_ms'] > before_p99 * (1 + tolerance):
+                found.append("{0} wrappers: {1} p99 {2:.2f}ms, baseline {3:.2f}ms".format(
+                    run['wrappers'], method, stats['p99_ms'], before_p99
+                ))
+    return found
+
+
+def format_ms(value):
+    return "{0:9.2f}".format(value) if value is not None else "{0:>9}".format("-")
+
+
+def main(args=None):
+    args = args or fleet_argument_parser.parse_args()
+    agent_config = dict(args.agent_config or {})
+    if args.storage_profile:
+        agent_config['storage_profile'] = args.storage_profile
+    results = run_benchmark(
+        args.wrappers, args.duration, args.job_seconds, args.active_jobs_ratio, args.server_mode, args.codec,
+        args.python, agent_config
+    )
+    if args.baseline:
+        with open(args.baseline) as f:
+            results['regressions'] = regressions(results, json.load(f), args.tolerance)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.json_output:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        for run in results['runs']:
+            print("{0} wrappers: {1:.1f} jobs/s, {2:.1f} calls/s, agent peak {3:.1f}MB RSS and {4} threads, "
+                  "database {5:.1f}MB".format(
+                      run['wrappers'], run['jobs_per_second'], run['calls_per_second'], run['agent_peak_rss_mb'],
+                      run['agent_peak_threads'], run['database_mb']
+                  ))
+            for method in FLEET_METHODS:
+                stats = run['methods'][method]
+                print("  {0:>36}: {1:>7} calls, {2:>5} errors, p50 {3}ms, p99 {4}ms, p999 {5}ms".format(
+                    method, stats['calls'], stats['errors'], format_ms(stats['p50_ms']), format_ms(stats['p99_ms']),
+                    format_ms(stats['p999_ms'])
+                ))
+        for regression in results.get('regressions', []):
+            print("REGRESSION: " + regression)
+    return 1 if results.get('regressions') else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
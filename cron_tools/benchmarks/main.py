@@ -0,0 +1,40 @@
+"""
+ct-benchmark: runs any of the benchmarks by name, e.g. ct-benchmark fleet --wrappers 10 100 -j.
+"""
+import argparse
+import importlib
+import sys
+
+# Benchmark name -> (module, name of its argument parser in that module).
+BENCHMARKS = {
+    'agent_load': ('cron_tools.benchmarks.agent_load', 'load_argument_parser'),
+    'fleet': ('cron_tools.benchmarks.fleet', 'fleet_argument_parser'),
+    'output_streaming': ('cron_tools.benchmarks.output_streaming', 'streaming_argument_parser'),
+    'rpc_client': ('cron_tools.benchmarks.rpc_client', 'client_argument_parser'),
+    'rpc_codecs': ('cron_tools.benchmarks.rpc_codecs', 'codec_argument_parser'),
+    'spawn_latency': ('cron_tools.benchmarks.spawn_latency', 'spawn_argument_parser'),
+    'stagger': ('cron_tools.benchmarks.stagger', 'stagger_argument_parser'),
+    'storage_profiles': ('cron_tools.benchmarks.storage_profiles', 'storage_argument_parser'),
+    'transports': ('cron_tools.benchmarks.transports', 'transport_argument_parser'),
+    'wrapper_startup': ('cron_tools.benchmarks.wrapper_startup', 'startup_argument_parser')
+}
+
+benchmark_argument_parser = argparse.ArgumentParser(description="Run a cron-tools benchmark.")
+benchmark_argument_parser.add_argument("benchmark", choices=sorted(BENCHMARKS), help="The benchmark to run.")
+benchmark_argument_parser.add_argument(
+    "arguments", nargs=argparse.REMAINDER, help="Arguments for the benchmark (see ct-benchmark <benchmark> -h)."
+)
+
+
+def main(args=None):
+    args = args or benchmark_argument_parser.parse_args()
+    module_name, parser_name = BENCHMARKS[args.benchmark]
+    # Imported only once chosen, since some benchmarks need Python 3 or optional codecs.
+    module = importlib.import_module(module_name)
+    parser = getattr(module, parser_name)
+    parser.prog = "ct-benchmark {0}".format(args.benchmark)
+    return module.main(parser.parse_args(args.arguments))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
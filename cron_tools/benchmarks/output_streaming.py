@@ -0,0 +1,144 @@
+"""
+Output streaming benchmark. Pushes a fixed amount of log-like output through ct-wrapper with --stream-output into a
+throwaway agent and fails when the wrapper's own CPU time per GB or its peak RSS leaves the allowed envelope.
+
+The wrapper runs as a separate process and is reaped with wait4, so its CPU time is the reaped total minus the job's
+own usage (which the wrapper reports to the agent). Its peak RSS is polled from VmHWM in /proc while it runs, since
+ru_maxrss carries over the RSS of whichever process forked it.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from cron_tools.common.rpc_client import RPCClient
+from cron_tools.benchmarks.common import start_agent
+
+GIGABYTE = 1024 * 1024 * 1024
+LOG_LINE = "2026-10-18T00:00:00.000Z INFO [worker:42] processed batch of items, nothing out of the ordinary to report"
+
+streaming_argument_parser = argparse.ArgumentParser(description="Benchmark ct-wrapper output streaming.")
+streaming_argument_parser.add_argument(
+    "--bytes", type=int, default=GIGABYTE, help="Amount of output the job writes to stdout."
+)
+streaming_argument_parser.add_argument(
+    "--report-mode", choices=('call', 'notify'), default='call', help="How the wrapper sends chunks to the agent."
+)
+streaming_argument_parser.add_argument(
+    "--max-cpu-seconds-per-gb", type=float, default=6.0, help="Fail if the wrapper uses more CPU time than this."
+)
+streaming_argument_parser.add_argument(
+    "--max-rss-mb", type=float, default=64.0, help="Fail if the wrapper's peak RSS exceeds this."
+)
+streaming_argument_parser.add_argument("--python", type=str, default=sys.executable, help="Interpreter to measure.")
+streaming_argument_parser.add_argument("-j", "--json-output", action="store_true", help="Format output as JSON.")
+
+
+def read_peak_rss_kb(pid):
+    try:
+        with open('/proc/{0}/status'.format(pid), 'rb') as f:
+            for line in f:
+                if line.startswith(b'VmHWM:'):
+                    return int(line.split()[1])
+    except (IOError, OSError):
+        pass
+    return 0
+
+
+def wait_measuring_peak_rss(pid, poll_interval=0.05):
+    peak_rss_kb = 0
+    while True:
+        waited_pid, status, rusage = os.wait4(pid, os.WNOHANG)
+        if waited_pid:
+            return status, rusage, peak_rss_kb
+        peak_rss_kb = max(peak_rss_kb, read_peak_rss_kb(pid))
+        time.sleep(poll_interval)
+
+
+def run_benchmark(python=sys.executable, output_bytes=GIGABYTE, report_mode='call'):
+    tempdir = tempfile.mkdtemp()
+    shutdown = agent_thread = None
+    try:
+        socket_path, shutdown, agent_thread = start_agent(tempdir)
+        config_path = os.path.join(tempdir, 'wrapper.json')
+        with open(config_path, 'w') as f:
+            json.dump({
+                'agent_socket_path': socket_path,
+                'journal_path': os.path.join(tempdir, 'journal'),
+                'journal_fsync': 'never'
+            }, f)
+        started = time.time()
+        wrapper = subprocess.Popen([
+            python, '-c', 'from cron_tools.wrapper.main import main; main()',
+            '--job-name', 'output-streaming-benchmark', '--report-mode', report_mode, '-f', config_path,
+            '--no-config-cache', '--capture-stdout', '--stream-output', '--no-output-spool', '--',
+            'sh', '-c', 'yes "{0}" | head -c {1}'.format(LOG_LINE, output_bytes)
+        ])
+        status, rusage, peak_rss_kb = wait_measuring_peak_rss(wrapper.pid)
+        wrapper.returncode = status
+        elapsed = time.time() - started
+
+        client = RPCClient(socket_path)
+        try:
+            job = client.handle_rpc_call("get_recent_jobs", {"limit": 1, "offset": None})["recent_jobs"][0]
+            chunks = client.handle_rpc_call("get_job_output", {"job_uuid": job["job_uuid"]})["chunks"]
+        finally:
+            client.disconnect()
+    finally:
+        if shutdown is not None:
+            shutdown()
+            agent_thread.join(5)
+        shutil.rmtree(tempdir)
+
+    job_usage = job["job_resource_usage"] or {}
+    wrapper_cpu_seconds = (rusage.ru_utime + rusage.ru_stime) \
+        - job_usage.get('user_cpu_seconds', 0) - job_usage.get('system_cpu_seconds', 0)
+    return {
+        'output_bytes': output_bytes,
+        'report_mode': report_mode,
+        'elapsed_seconds': elapsed,
+        'throughput_mb_per_second': output_bytes / 1024.0 / 1024.0 / elapsed,
+        'wrapper_cpu_seconds': wrapper_cpu_seconds,
+        'wrapper_cpu_seconds_per_gb': wrapper_cpu_seconds * GIGABYTE / output_bytes,
+        'wrapper_max_rss_mb': peak_rss_kb / 1024.0,
+        'retained_chunks': len(chunks),
+        'last_sequence_number': max(c['sequence_number'] for c in chunks) if chunks else None,
+        'retained_raw_bytes': sum(c['raw_length'] for c in chunks)
+    }
+
+
+def main(args=None):
+    args = args or streaming_argument_parser.parse_args()
+    results = run_benchmark(args.python, args.bytes, args.report_mode)
+    failures = []
+    if results['wrapper_cpu_seconds_per_gb'] > args.max_cpu_seconds_per_gb:
+        failures.append("wrapper CPU time {0:.2f}s/GB exceeds {1:.2f}s/GB".format(
+            results['wrapper_cpu_seconds_per_gb'], args.max_cpu_seconds_per_gb
+        ))
+    if results['wrapper_max_rss_mb'] > args.max_rss_mb:
+        failures.append("wrapper peak RSS {0:.1f}MB exceeds {1:.1f}MB".format(
+            results['wrapper_max_rss_mb'], args.max_rss_mb
+        ))
+    results['failures'] = failures
+
+    if args.json_output:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        print("streamed {0} bytes in {1:.2f}s ({2:.1f}MB/s)".format(
+            results['output_bytes'], results['elapsed_seconds'], results['throughput_mb_per_second']
+        ))
+        print("wrapper CPU: {0:.2f}s ({1:.2f}s/GB), peak RSS {2:.1f}MB".format(
+            results['wrapper_cpu_seconds'], results['wrapper_cpu_seconds_per_gb'], results['wrapper_max_rss_mb']
+        ))
+        print("agent retained {0} chunks, {1} bytes".format(results['retained_chunks'], results['retained_raw_bytes']))
+        for failure in failures:
+            print("REGRESSION: " + failure)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
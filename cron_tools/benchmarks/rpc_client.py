@@ -0,0 +1,143 @@
+"""
+RPC client latency benchmark. Runs a throwaway agent and times round trips of a small call (ping) and a large one
+(get_recent_jobs over a few thousand jobs) with the current RPCClient and with the client as it was before it framed
+requests with sendmsg and read responses with recv_into, also counting the socket calls each makes per request.
+"""
+import argparse
+import json
+import shutil
+import struct
+import sys
+import tempfile
+import time
+
+from cron_tools.common.rpc_client import RPCClient, MAGIC_BYTE
+from cron_tools.benchmarks.common import median, sample_job, start_agent
+
+client_argument_parser = argparse.ArgumentParser(description="Benchmark RPC client round trip latency.")
+client_argument_parser.add_argument("-n", "--repeat", type=int, default=2000, help="Number of ping round trips.")
+client_argument_parser.add_argument(
+    "--large-repeat", type=int, default=20, help="Number of get_recent_jobs round trips."
+)
+client_argument_parser.add_argument("--jobs", type=int, default=5000, help="Jobs returned by get_recent_jobs.")
+client_argument_parser.add_argument("-j", "--json-output", action="store_true", help="Format output as JSON.")
+
+
+class LegacyRPCClient(RPCClient):
+    """
+    The request/response exchange as the client did it before: header and payload in three sends, then a recv per
+    piece of the response, each copied onto the end of a growing bytearray.
+    """
+
+    def exchange(self, request):
+        self.connect()
+        self.socket.send(MAGIC_BYTE)
+        self.socket.send(struct.pack('!L', len(request)))
+        self.socket.sendall(request)
+        if self.socket.recv(1) != MAGIC_BYTE:
+            raise Exception("Bad RPC magic byte on response.")
+        length, = struct.unpack("!L", self.legacy_recv_bytes(struct.calcsize("!L")))
+        return self.legacy_recv_bytes(length)
+
+    def legacy_recv_bytes(self, amount):
+        data = bytearray()
+        while len(data) < amount:
+            delta = self.socket.recv(amount - len(data))
+            if not delta:
+                break
+            data.extend(delta)
+        return bytes(data)
+
+
+class CountingSocket(object):
+    COUNTED = ('send', 'sendall', 'sendmsg', 'recv', 'recv_into')
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.calls = 0
+
+    def __getattr__(self, item):
+        attribute = getattr(self.sock, item)
+        if item not in self.COUNTED:
+            return attribute
+
+        def counted(*args, **kwargs):
+            self.calls += 1
+            return attribute(*args, **kwargs)
+        return counted
+
+
+def socket_calls_per_request(client, name, params, repeat=10):
+    client.connect()
+    counting = client.socket = CountingSocket(client.socket)
+    try:
+        for _ in range(repeat):
+            client.handle_rpc_call(name, params)
+    finally:
+        client.socket = counting.sock
+    return counting.calls / float(repeat)
+
+
+def measure(client, name, params, repeat):
+    latencies = []
+    for _ in range(repeat):
+        started = time.time()
+        client.handle_rpc_call(name, params)
+        latencies.append((time.time() - started) * 1000000.0)
+    latencies.sort()
+    return {
+        'median_us': median(latencies),
+        'p99_us': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))],
+        'socket_calls_per_request': socket_calls_per_request(client, name, params)
+    }
+
+
+def run_benchmark(repeat=2000, large_repeat=20, jobs=5000):
+    tempdir = tempfile.mkdtemp()
+    shutdown = agent_thread = None
+    try:
+        socket_path, shutdown, agent_thread = start_agent(tempdir)
+        loader = RPCClient(socket_path)
+        for start in range(0, jobs, 500):
+            loader.handle_rpc_batch([
+                ("add_new_job", {'raw_job_record': sample_job(i)}) for i in range(start, min(jobs, start + 500))
+            ])
+        loader.disconnect()
+
+        results = {}
+        for client_name, client_class in (('legacy', LegacyRPCClient), ('current', RPCClient)):
+            client = client_class(socket_path)
+            try:
+                results[client_name] = {
+                    'ping': measure(client, "ping", {}, repeat),
+                    'get_recent_jobs': measure(
+                        client, "get_recent_jobs", {"limit": jobs, "offset": None}, large_repeat
+                    )
+                }
+            finally:
+                client.disconnect()
+    finally:
+        if shutdown is not None:
+            shutdown()
+            agent_thread.join(5)
+        shutil.rmtree(tempdir)
+    return results
+
+
+def main(args=None):
+    args = args or client_argument_parser.parse_args()
+    results = run_benchmark(args.repeat, args.large_repeat, args.jobs)
+    if args.json_output:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        for client_name in ('legacy', 'current'):
+            for call_name in ('ping', 'get_recent_jobs'):
+                result = results[client_name][call_name]
+                print("{0:>8} {1:>15}: median {2:10.0f}us, p99 {3:10.0f}us, {4:6.1f} socket calls/request".format(
+                    client_name, call_name, result['median_us'], result['p99_us'], result['socket_calls_per_request']
+                ))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
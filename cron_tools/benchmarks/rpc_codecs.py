@@ -0,0 +1,107 @@
+"""
+RPC codec micro-benchmark. Encodes and decodes representative agent RPC payloads with every available codec, reporting
+the time per encode and decode and the encoded size: an add_new_job request, a get_recent_jobs(limit=5000) response
+and an append_job_output request carrying a full output chunk. Fails if any codec does not round trip a payload.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+from cron_tools.common.models import generate_job_uuid
+from cron_tools.common.output import encode_output_chunk
+from cron_tools.common.rpc_codecs import CODECS
+from cron_tools.benchmarks.common import median, sample_job
+
+codec_argument_parser = argparse.ArgumentParser(description="Benchmark the agent RPC payload codecs.")
+codec_argument_parser.add_argument("-n", "--repeat", type=int, default=5, help="Measurements per payload and codec.")
+codec_argument_parser.add_argument(
+    "--recent-jobs", type=int, default=5000, help="Number of jobs in the get_recent_jobs response."
+)
+codec_argument_parser.add_argument(
+    "--chunk-kb", type=int, default=256, help="Raw size of the output chunk in the append_job_output request."
+)
+codec_argument_parser.add_argument("-j", "--json-output", action="store_true", help="Format output as JSON.")
+
+
+def sample_output_chunk(raw_size):
+    line = b"2024-01-01T00:00:00 INFO processed batch of records, checksum ok\n"
+    raw = (line * (raw_size // len(line) + 1))[:raw_size]
+    # Some incompressible bytes, as real output has ids and timings in it.
+    raw = raw[:raw_size // 2] + os.urandom(raw_size // 16) + raw[raw_size // 2 + raw_size // 16:]
+    return encode_output_chunk(raw), len(raw)
+
+
+def sample_payloads(recent_jobs=5000, chunk_kb=256):
+    data, raw_length = sample_output_chunk(chunk_kb * 1024)
+    return [
+        ('add_new_job', {
+            "json-rpc": "2.0", "id": 1, "method": "add_new_job",
+            "params": {'raw_job_record': sample_job(0, finished=False)}
+        }),
+        ('get_recent_jobs', {
+            "result": {'recent_jobs': [sample_job(i) for i in range(recent_jobs)]}
+        }),
+        ('append_job_output', {
+            "json-rpc": "2.0", "id": 2, "method": "append_job_output",
+            "params": {
+                'job_uuid': generate_job_uuid(), 'stream_name': 'stdout', 'sequence_number': 3, 'data': data,
+                'raw_length': raw_length
+            }
+        })
+    ]
+
+
+def measure(codec, payload, repeat):
+    encode_times = []
+    decode_times = []
+    for _ in range(repeat):
+        started = time.time()
+        encoded = codec.encode(payload)
+        encoded_time = time.time()
+        decoded = codec.decode(encoded)
+        decode_times.append((time.time() - encoded_time) * 1000.0)
+        encode_times.append((encoded_time - started) * 1000.0)
+    return {
+        'encode_ms_median': median(encode_times),
+        'decode_ms_median': median(decode_times),
+        'encoded_bytes': len(encoded),
+        'round_trips': decoded == payload
+    }
+
+
+def run_benchmark(repeat=5, recent_jobs=5000, chunk_kb=256):
+    results = {}
+    for payload_name, payload in sample_payloads(recent_jobs, chunk_kb):
+        results[payload_name] = dict(
+            (codec.name, measure(codec, payload, repeat)) for codec in CODECS if codec.available()
+        )
+    return results
+
+
+def main(args=None):
+    args = args or codec_argument_parser.parse_args()
+    results = run_benchmark(args.repeat, args.recent_jobs, args.chunk_kb)
+    failures = [
+        "{0} does not round trip {1}".format(codec_name, payload_name)
+        for payload_name, by_codec in sorted(results.items())
+        for codec_name, result in sorted(by_codec.items())
+        if not result['round_trips']
+    ]
+    if args.json_output:
+        print(json.dumps(dict(results, failures=failures), indent=2, sort_keys=True))
+    else:
+        for payload_name, by_codec in sorted(results.items()):
+            for codec_name, result in sorted(by_codec.items()):
+                print("{0:>17} {1:>8}: encode {2:9.3f}ms, decode {3:9.3f}ms, {4:>9} bytes".format(
+                    payload_name, codec_name, result['encode_ms_median'], result['decode_ms_median'],
+                    result['encoded_bytes']
+                ))
+        for failure in failures:
+            print("FAILURE: " + failure)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,83 @@
+"""
+Child launch micro-benchmark. Compares the wrapper's posix_spawn launch path with subprocess.Popen, with and without
+a preexec function (which forces Popen onto a full fork of the interpreter), measuring how long the launch call takes
+and the complete launch to reaped exit round trip of `true`. A ballast allocation makes the parent look like a
+wrapper that has been running for a while, since fork cost grows with the parent's memory.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+from cron_tools.wrapper.spawn import posix_spawn_child, popen_child, HAS_POSIX_SPAWN
+from cron_tools.benchmarks.common import median
+
+spawn_argument_parser = argparse.ArgumentParser(description="Benchmark ct-wrapper child launch latency.")
+spawn_argument_parser.add_argument("-n", "--repeat", type=int, default=200, help="Launches per path.")
+spawn_argument_parser.add_argument(
+    "--ballast-mb", type=int, default=64, help="Memory to allocate (and touch) in the parent before measuring."
+)
+spawn_argument_parser.add_argument("-j", "--json-output", action="store_true", help="Format output as JSON.")
+
+
+def noop_preexec():
+    pass
+
+
+LAUNCH_PATHS = (
+    ('posix_spawn', lambda argv: posix_spawn_child(argv)),
+    ('popen', lambda argv: popen_child(argv)),
+    ('popen_preexec', lambda argv: popen_child(argv, preexec_fn=noop_preexec)),
+)
+
+
+def measure_path(launch, repeat, argv=('true',)):
+    launch_times = []
+    round_trip_times = []
+    for _ in range(repeat):
+        started = time.time()
+        process = launch(list(argv))
+        launched = time.time()
+        os.waitpid(process.pid, 0)
+        process.returncode = 0
+        finished = time.time()
+        launch_times.append((launched - started) * 1000000.0)
+        round_trip_times.append((finished - started) * 1000000.0)
+    return {
+        'launch_us_median': median(launch_times),
+        'launch_us_min': min(launch_times),
+        'round_trip_us_median': median(round_trip_times),
+        'round_trip_us_min': min(round_trip_times)
+    }
+
+
+def run_benchmark(repeat=200, ballast_mb=64):
+    ballast = bytearray(ballast_mb * 1024 * 1024)
+    for offset in range(0, len(ballast), 4096):
+        ballast[offset] = 1
+    results = {}
+    for name, launch in LAUNCH_PATHS:
+        if name == 'posix_spawn' and not HAS_POSIX_SPAWN:
+            continue
+        results[name] = measure_path(launch, repeat)
+    del ballast
+    return results
+
+
+def main(args=None):
+    args = args or spawn_argument_parser.parse_args()
+    results = run_benchmark(args.repeat, args.ballast_mb)
+    if args.json_output:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        for name, _ in LAUNCH_PATHS:
+            if name in results:
+                print("{0:>14}: launch median {1:.0f}us, launch to reaped exit median {2:.0f}us".format(
+                    name, results[name]['launch_us_median'], results[name]['round_trip_us_median']
+                ))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
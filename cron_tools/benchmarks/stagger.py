@@ -0,0 +1,99 @@
+"""
+Start staggering benchmark. Fires a batch of wrappers in the same instant, the way cron does at the top of the minute,
+each running the same fixed amount of CPU bound work against the shared host, and compares the peak number of jobs
+running at once and the job run time percentiles without staggering, with hashed offsets and with agent assigned
+slots. Start delays are not part of the run time, which is measured from the end of the delay.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from cron_tools.common.rpc_client import RPCClient
+from cron_tools.benchmarks.common import percentile, peak_concurrency, start_agent
+
+WORKLOAD = "sum(range(2000000))"
+
+stagger_argument_parser = argparse.ArgumentParser(description="Benchmark ct-wrapper start staggering.")
+stagger_argument_parser.add_argument("-n", "--jobs", type=int, default=16, help="Number of jobs fired together.")
+stagger_argument_parser.add_argument(
+    "-w", "--window", type=float, default=4.0, help="Stagger window in seconds for the staggered runs."
+)
+stagger_argument_parser.add_argument("--python", type=str, default=sys.executable, help="Interpreter to measure.")
+stagger_argument_parser.add_argument("-j", "--json-output", action="store_true", help="Format output as JSON.")
+
+
+def run_batch(python, socket_path, config_path, jobs, window, mode):
+    wrappers = []
+    for i in range(jobs):
+        command = [
+            python, '-c', 'from cron_tools.wrapper.main import main; main()',
+            '--job-name', 'stagger-benchmark-{0}-{1}'.format(mode, i), '-f', config_path, '--heartbeat-interval', '0'
+        ]
+        if mode != 'none':
+            command += ['--stagger', str(window), '--stagger-mode', mode]
+        wrappers.append(subprocess.Popen(command + ['--', python, '-c', WORKLOAD]))
+    for wrapper in wrappers:
+        wrapper.wait()
+
+    client = RPCClient(socket_path)
+    try:
+        recent_jobs = client.handle_rpc_call("get_recent_jobs", {"limit": None, "offset": None})["recent_jobs"]
+    finally:
+        client.disconnect()
+    batch = [j for j in recent_jobs if j["job_name"].startswith('stagger-benchmark-{0}-'.format(mode))]
+    intervals = [
+        (j["job_start_time_utc_epoch_seconds"], j["job_end_time_utc_epoch_seconds"]) for j in batch
+    ]
+    durations = sorted(end - start for start, end in intervals)
+    return {
+        'jobs': len(batch),
+        'peak_concurrency': peak_concurrency(intervals),
+        'run_seconds_p50': percentile(durations, 0.5),
+        'run_seconds_p99': percentile(durations, 0.99),
+        'max_start_delay_seconds': max(j["job_start_delay_seconds"] or 0 for j in batch),
+        'makespan_seconds': max(end for _, end in intervals) - min(start for start, _ in intervals)
+    }
+
+
+def run_benchmark(python=sys.executable, jobs=16, window=4.0):
+    tempdir = tempfile.mkdtemp()
+    shutdown = agent_thread = None
+    try:
+        socket_path, shutdown, agent_thread = start_agent(tempdir, {'stagger_slot_seconds': window / jobs})
+        config_path = os.path.join(tempdir, 'wrapper.json')
+        with open(config_path, 'w') as f:
+            json.dump({
+                'agent_socket_path': socket_path,
+                'journal_path': os.path.join(tempdir, 'journal'),
+                'journal_fsync': 'never'
+            }, f)
+        return {
+            mode: run_batch(python, socket_path, config_path, jobs, window, mode) for mode in ('none', 'hash', 'agent')
+        }
+    finally:
+        if shutdown is not None:
+            shutdown()
+            agent_thread.join(5)
+        shutil.rmtree(tempdir)
+
+
+def main(args=None):
+    args = args or stagger_argument_parser.parse_args()
+    results = run_benchmark(args.python, args.jobs, args.window)
+    if args.json_output:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        for mode in ('none', 'hash', 'agent'):
+            print("{0:>5}: peak {1:d} concurrent, run p50 {2:.3f}s p99 {3:.3f}s, makespan {4:.2f}s".format(
+                mode, results[mode]['peak_concurrency'], results[mode]['run_seconds_p50'],
+                results[mode]['run_seconds_p99'], results[mode]['makespan_seconds']
+            ))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,138 @@
+"""
+Storage profile benchmark. Runs the agent's own queries against a throwaway spool database with each storage profile
+(and with plain connections, as the agent opened them before profiles, for comparison): writer threads each record
+jobs starting and ending in IMMEDIATE transactions, as concurrent wrappers do, while reader threads list the active
+jobs. Reports write and read throughput and latency, how large the WAL grew and what a truncating checkpoint of it
+then took.
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from cron_tools.common.models import AgentJob
+from cron_tools.agent.queries import SimpleConnectionPool, write_schema, immediate_transaction_manager, add_job, \
+    update_job_end_time_and_status, get_all_active_jobs
+from cron_tools.agent.storage import STORAGE_PROFILES, storage_pragmas, checkpoint_wal, wal_size
+from cron_tools.benchmarks.common import percentile, sample_job
+
+# The connections as the agent opened them before storage profiles: rollback journal and SQLite's defaults.
+UNTUNED_PROFILE = 'untuned'
+
+storage_argument_parser = argparse.ArgumentParser(description="Benchmark the agent spool storage profiles.")
+storage_argument_parser.add_argument(
+    "--profiles", nargs="+", choices=[UNTUNED_PROFILE] + sorted(STORAGE_PROFILES),
+    default=[UNTUNED_PROFILE] + sorted(STORAGE_PROFILES), help="Storage profiles to measure."
+)
+storage_argument_parser.add_argument("-w", "--writers", type=int, default=8, help="Concurrent writer threads.")
+storage_argument_parser.add_argument("-r", "--readers", type=int, default=2, help="Concurrent reader threads.")
+storage_argument_parser.add_argument("-d", "--duration", type=float, default=5.0, help="Seconds per profile.")
+storage_argument_parser.add_argument(
+    "--directory", type=str, default=None, help="Where to put the database, the file system matters a lot."
+)
+storage_argument_parser.add_argument("-j", "--json-output", action="store_true", help="Format output as JSON.")
+
+
+def write_jobs(pool, deadline, latencies, errors):
+    index = 0
+    while time.time() < deadline:
+        job = AgentJob.deserialize(sample_job(index, finished=False))
+        started = time.time()
+        try:
+            with immediate_transaction_manager(pool.get()) as t:
+                add_job(t, job)
+            with immediate_transaction_manager(pool.get()) as t:
+                update_job_end_time_and_status(t, job.uuid, time.time(), 0)
+        except Exception:
+            errors.append(1)
+        latencies.append((time.time() - started) * 1000.0 / 2)
+        index += 1
+
+
+def read_active_jobs(pool, deadline, latencies, errors):
+    while time.time() < deadline:
+        started = time.time()
+        try:
+            get_all_active_jobs(pool.get(), limit=100, order_by="job_start_time_utc_epoch_seconds DESC")
+        except Exception:
+            errors.append(1)
+        latencies.append((time.time() - started) * 1000.0)
+
+
+def latency_summary(latencies, elapsed):
+    ordered = sorted(latencies)
+    return {
+        'per_second': len(ordered) / elapsed,
+        'p50_ms': percentile(ordered, 0.5),
+        'p99_ms': percentile(ordered, 0.99)
+    }
+
+
+def run_profile(profile, writers, readers, duration, directory=None):
+    tempdir = tempfile.mkdtemp(dir=directory)
+    database_path = os.path.join(tempdir, 'agent.db')
+    pragmas = storage_pragmas(profile) if profile != UNTUNED_PROFILE else None
+    # Closed from this thread once the workers are done with them.
+    pool = SimpleConnectionPool(database_path, check_same_thread=False, pragmas=pragmas)
+    try:
+        write_schema(pool.get())
+        write_latencies, read_latencies, errors = [], [], []
+        deadline = time.time() + duration
+        threads = [
+            threading.Thread(target=write_jobs, args=(pool, deadline, write_latencies, errors))
+            for _ in range(writers)
+        ] + [
+            threading.Thread(target=read_active_jobs, args=(pool, deadline, read_latencies, errors))
+            for _ in range(readers)
+        ]
+        started = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - started
+        result = {
+            'writes': latency_summary(write_latencies, elapsed),
+            'reads': latency_summary(read_latencies, elapsed),
+            'errors': len(errors),
+            'wal_mb': wal_size(database_path) / (1024.0 * 1024.0)
+        }
+        checkpoint_started = time.time()
+        checkpoint_wal(pool.get(), database_path, 0, 0)
+        result['checkpoint_ms'] = (time.time() - checkpoint_started) * 1000.0 if pragmas else None
+        return result
+    finally:
+        pool.close_all()
+        shutil.rmtree(tempdir)
+
+
+def run_benchmark(profiles=None, writers=8, readers=2, duration=5.0, directory=None):
+    profiles = profiles or [UNTUNED_PROFILE] + sorted(STORAGE_PROFILES)
+    return dict((profile, run_profile(profile, writers, readers, duration, directory)) for profile in profiles)
+
+
+def main(args=None):
+    args = args or storage_argument_parser.parse_args()
+    results = run_benchmark(args.profiles, args.writers, args.readers, args.duration, args.directory)
+    if args.json_output:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        for profile in args.profiles:
+            result = results[profile]
+            print("{0:>8}: {1:8.0f} writes/s (p50 {2:7.2f}ms, p99 {3:7.2f}ms), {4:8.0f} reads/s (p50 {5:7.2f}ms, "
+                  "p99 {6:7.2f}ms), {7} errors, WAL {8:.1f}MB{9}".format(
+                      profile, result['writes']['per_second'], result['writes']['p50_ms'] or 0,
+                      result['writes']['p99_ms'] or 0, result['reads']['per_second'], result['reads']['p50_ms'] or 0,
+                      result['reads']['p99_ms'] or 0, result['errors'], result['wal_mb'],
+                      ", truncated in {0:.1f}ms".format(result['checkpoint_ms'])
+                      if result['checkpoint_ms'] is not None else ""
+                  ))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,114 @@
+"""
+Agent transport benchmark. Runs a throwaway agent listening on all three transports and replays wrapper-like
+traffic: each simulated wrapper connects, sends two small events (job heartbeats, which the agent keeps in memory, so
+that the transport rather than SQLite is measured) and hangs up. Calls, waiting for every answer, are compared over
+the stream and seqpacket transports, notifications over all three, reporting events per second and the median and
+99th percentile time per event (for notifications, the time to hand the event over; the events per second only
+count once the agent has processed them all).
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from cron_tools.common.rpc_client import RPCClient, SeqpacketRPCClient, DatagramRPCClient
+from cron_tools.benchmarks.common import median, start_agent
+
+SERVER_MODES = ('asyncio', 'threading')
+TRANSPORT_CLIENTS = (('stream', RPCClient), ('seqpacket', SeqpacketRPCClient), ('datagram', DatagramRPCClient))
+
+transport_argument_parser = argparse.ArgumentParser(description="Benchmark the agent RPC transports.")
+transport_argument_parser.add_argument("-n", "--wrappers", type=int, default=2000, help="Simulated wrappers per run.")
+transport_argument_parser.add_argument(
+    "--modes", choices=SERVER_MODES, nargs="+", default=list(SERVER_MODES), help="RPC server modes to test."
+)
+transport_argument_parser.add_argument("-j", "--json-output", action="store_true", help="Format output as JSON.")
+
+
+def processed_heartbeats(stats_client):
+    stats = stats_client.handle_rpc_call("get_rpc_stats", {})
+    return stats['methods'].get('job_heartbeat', {}).get('calls', 0)
+
+
+def run_wrappers(client_class, socket_path, wrappers, notify, stats_client):
+    already_processed = processed_heartbeats(stats_client)
+    latencies = []
+    started = time.time()
+    for i in range(wrappers):
+        client = client_class(socket_path, timeout=5)
+        for _ in range(2):
+            event_started = time.time()
+            params = {'job_uuid': 'job-{0}'.format(i), 'heartbeat_time': event_started}
+            if notify:
+                client.send_notification("job_heartbeat", params)
+            else:
+                client.handle_rpc_call("job_heartbeat", params)
+            latencies.append((time.time() - event_started) * 1000000.0)
+        client.disconnect()
+    # Notifications only count once the agent has got to them.
+    while processed_heartbeats(stats_client) - already_processed < 2 * wrappers:
+        time.sleep(0.001)
+    elapsed = time.time() - started
+    latencies.sort()
+    return {
+        'events_per_second': 2 * wrappers / elapsed,
+        'median_us': median(latencies),
+        'p99_us': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    }
+
+
+def run_mode(mode, wrappers):
+    tempdir = tempfile.mkdtemp()
+    shutdown = agent_thread = stats_client = None
+    results = {}
+    try:
+        socket_paths = {
+            'seqpacket': os.path.join(tempdir, 'agent.seqpacket.sock'),
+            'datagram': os.path.join(tempdir, 'agent.datagram.sock')
+        }
+        socket_paths['stream'], shutdown, agent_thread = start_agent(tempdir, {
+            'rpc_server_mode': mode,
+            'seqpacket_socket_path': socket_paths['seqpacket'],
+            'datagram_socket_path': socket_paths['datagram']
+        })
+        stats_client = RPCClient(socket_paths['stream'])
+        for transport, client_class in TRANSPORT_CLIENTS:
+            for notify in (False, True):
+                if client_class is DatagramRPCClient and not notify:
+                    continue
+                results["{0} {1}".format(transport, "notify" if notify else "call")] = run_wrappers(
+                    client_class, socket_paths[transport], wrappers, notify, stats_client
+                )
+    finally:
+        if stats_client is not None:
+            stats_client.disconnect()
+        if shutdown is not None:
+            shutdown()
+            agent_thread.join(5)
+        shutil.rmtree(tempdir)
+    return results
+
+
+def run_benchmark(wrappers=2000, modes=SERVER_MODES):
+    return dict((mode, run_mode(mode, wrappers)) for mode in modes)
+
+
+def main(args=None):
+    args = args or transport_argument_parser.parse_args()
+    results = run_benchmark(args.wrappers, args.modes)
+    if args.json_output:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        for mode in args.modes:
+            for name, result in sorted(results[mode].items()):
+                print("{0:>9} {1:>16}: {2:9.0f} events/s, median {3:7.0f}us, p99 {4:7.0f}us per event".format(
+                    mode, name, result['events_per_second'], result['median_us'], result['p99_us']
+                ))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,123 @@
+"""
+Wrapper start up benchmark. Measures the import cost of the wrapper entry point with `python -X importtime` and the
+wall clock time of a complete (journal mode) wrapper run, failing when either regresses past its threshold or when a
+module that is supposed to be deferred shows up on the hot path.
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from cron_tools.benchmarks.common import median
+
+WRAPPER_MODULE = 'cron_tools.wrapper.main'
+
+# Modules that the wrapper must not import on its hot path.
+DEFERRED_MODULES = ('dateutil', 'six', 'logging.config', 'inspect', 'uuid', 'signalfd', 'cffi', 'subprocess', 'ctypes')
+
+startup_argument_parser = argparse.ArgumentParser(description="Benchmark ct-wrapper start up.")
+startup_argument_parser.add_argument("-n", "--repeat", type=int, default=10, help="Number of measurements to take.")
+startup_argument_parser.add_argument(
+    "--max-import-ms", type=float, default=50.0, help="Fail if the median wrapper import time exceeds this."
+)
+startup_argument_parser.add_argument(
+    "--max-run-ms", type=float, default=150.0, help="Fail if the median complete wrapper run exceeds this."
+)
+startup_argument_parser.add_argument("--python", type=str, default=sys.executable, help="Interpreter to measure.")
+startup_argument_parser.add_argument("-j", "--json-output", action="store_true", help="Format output as JSON.")
+
+
+def measure_import_microseconds(python=sys.executable, module=WRAPPER_MODULE):
+    output = subprocess.check_output(
+        [python, '-X', 'importtime', '-c', 'import ' + module], stderr=subprocess.STDOUT
+    ).decode('utf-8', 'replace')
+    for line in output.splitlines():
+        parts = line.split('|')
+        if len(parts) == 3 and parts[2].strip() == module:
+            return int(parts[1])
+    raise ValueError("No import time reported for {0}".format(module))
+
+
+def newly_loaded_modules(python=sys.executable, module=WRAPPER_MODULE):
+    output = subprocess.check_output([
+        python, '-c',
+        "import sys, json; before = set(sys.modules); import {0}; "
+        "print(json.dumps(sorted(set(sys.modules) - before)))".format(module)
+    ])
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def deferred_modules_loaded(loaded_modules):
+    return sorted(
+        m for m in loaded_modules if any(m == d or m.startswith(d + '.') for d in DEFERRED_MODULES)
+    )
+
+
+def measure_wrapper_run_seconds(python, config_path):
+    started = time.time()
+    subprocess.check_call([
+        python, '-c', 'import sys; from {0} import main; main()'.format(WRAPPER_MODULE),
+        '--report-mode', 'journal', '-f', config_path, '--', 'true'
+    ])
+    return time.time() - started
+
+
+def run_benchmark(python=sys.executable, repeat=10):
+    tempdir = tempfile.mkdtemp()
+    try:
+        config_path = os.path.join(tempdir, 'wrapper.json')
+        with open(config_path, 'w') as f:
+            json.dump({
+                'agent_socket_path': os.path.join(tempdir, 'agent.sock'),
+                'journal_path': os.path.join(tempdir, 'journal'),
+                'journal_fsync': 'never'
+            }, f)
+        import_times = [measure_import_microseconds(python) / 1000.0 for _ in range(repeat)]
+        run_times = [measure_wrapper_run_seconds(python, config_path) * 1000.0 for _ in range(repeat)]
+    finally:
+        shutil.rmtree(tempdir)
+    return {
+        'import_ms_median': median(import_times),
+        'import_ms_min': min(import_times),
+        'run_ms_median': median(run_times),
+        'run_ms_min': min(run_times),
+        'deferred_modules_loaded': deferred_modules_loaded(newly_loaded_modules(python))
+    }
+
+
+def main(args=None):
+    args = args or startup_argument_parser.parse_args()
+    results = run_benchmark(args.python, args.repeat)
+    failures = []
+    if results['import_ms_median'] > args.max_import_ms:
+        failures.append("median import time {0:.1f}ms exceeds {1:.1f}ms".format(
+            results['import_ms_median'], args.max_import_ms
+        ))
+    if results['run_ms_median'] > args.max_run_ms:
+        failures.append("median run time {0:.1f}ms exceeds {1:.1f}ms".format(
+            results['run_ms_median'], args.max_run_ms
+        ))
+    if results['deferred_modules_loaded']:
+        failures.append("deferred modules loaded: {0}".format(", ".join(results['deferred_modules_loaded'])))
+    results['failures'] = failures
+
+    if args.json_output:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    else:
+        print("wrapper import: median {0:.1f}ms, min {1:.1f}ms".format(
+            results['import_ms_median'], results['import_ms_min']
+        ))
+        print("wrapper run:    median {0:.1f}ms, min {1:.1f}ms".format(
+            results['run_ms_median'], results['run_ms_min']
+        ))
+        for failure in failures:
+            print("REGRESSION: " + failure)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,4 +1,6 @@
 import json
+import marshal
+import os
 
 
 class ConfigurationException(Exception):
@@ -43,3 +45,44 @@ class JSONSourcedConfiguration(object):
     def from_file(cls, filename):
         with open(filename, 'r') as f:
             return cls.load(json.load(f))
+
+    @classmethod
+    def from_file_cached(cls, filename, cache_directory):
+        """
+        Like from_file, but keeps the validated configuration (with defaults applied) in a marshal file keyed on the
+        configuration file's path, mtime and size, so that JSON parsing and validation are skipped until the
+        configuration file changes. Any problem with the cache falls back to loading the file normally.
+        """
+        filename = os.path.abspath(filename)
+        stat = os.stat(filename)
+        # The defaults are part of the key so that an upgrade changing them invalidates the cache.
+        key = (
+            filename, getattr(stat, 'st_mtime_ns', stat.st_mtime), stat.st_size,
+            marshal.dumps(cls.OPTIONAL_PARAMETERS)
+        )
+        cache_path = os.path.join(
+            cache_directory, "{0}{1}.marshal".format(cls.__name__, filename.replace(os.sep, '%'))
+        )
+        try:
+            with open(cache_path, 'rb') as f:
+                cached_key, kwargs = marshal.load(f)
+            if tuple(cached_key) == key:
+                return cls(**kwargs)
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            pass
+
+        with open(filename, 'r') as f:
+            raw_config = json.load(f)
+        cls.validate(raw_config)
+        kwargs = dict(cls.OPTIONAL_PARAMETERS)
+        kwargs.update(raw_config)
+        try:
+            if not os.path.isdir(cache_directory):
+                os.makedirs(cache_directory, 0o700)
+            temporary_path = "{0}.{1}".format(cache_path, os.getpid())
+            with open(temporary_path, 'wb') as f:
+                marshal.dump((key, kwargs), f)
+            os.rename(temporary_path, cache_path)
+        except (IOError, OSError, ValueError):
+            pass
+        return cls(**kwargs)
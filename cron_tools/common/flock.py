@@ -1,18 +1,29 @@
 import fcntl
 import os
-import signal
+import time
 import errno
 
+monotonic = getattr(time, 'monotonic', time.time)
+
 
 class FlockTimeout(Exception):
     pass
 
 
 class FlockLock(object):
+    """
+    flock(2) based lock. Timeouts are implemented by polling with LOCK_NB and an exponential backoff, so they can be
+    fractional and do not touch any signal handlers. The time spent waiting for the lock is kept in wait_time.
+    """
+
+    INITIAL_BACKOFF_SECONDS = 0.001
+    MAX_BACKOFF_SECONDS = 0.05
+
     def __init__(self, fd, timeout=None, flock_mode=fcntl.LOCK_EX):
         self.fd = fd
         self.timeout = timeout
         self.flock_mode = flock_mode
+        self.wait_time = None
 
     def close(self):
         if self.fd is not None:
@@ -23,25 +34,33 @@ class FlockLock(object):
         self.close()
 
     @classmethod
-    def from_file(cls, filename, timeout=None):
-        return cls(os.open(filename, os.O_RDWR | os.O_CREAT), timeout=timeout)
+    def from_file(cls, filename, timeout=None, flock_mode=fcntl.LOCK_EX):
+        return cls(os.open(filename, os.O_RDWR | os.O_CREAT), timeout=timeout, flock_mode=flock_mode)
+
+    def try_acquire(self):
+        try:
+            fcntl.flock(self.fd, self.flock_mode | fcntl.LOCK_NB)
+        except (IOError, OSError) as e:
+            if e.errno not in (errno.EWOULDBLOCK, errno.EAGAIN, errno.EACCES):
+                raise
+            return False
+        return True
 
     def acquire(self):
+        started = monotonic()
         if self.timeout is None:
             fcntl.flock(self.fd, self.flock_mode)
         else:
-            original_handler = signal.signal(signal.SIGALRM, lambda *args, **kwargs: None)
-            try:
-                signal.alarm(self.timeout)
-                fcntl.flock(self.fd, self.flock_mode)
-            except IOError as e:
-                if e.errno != errno.EINTR:
-                    raise e
-                else:
+            deadline = started + self.timeout
+            backoff = self.INITIAL_BACKOFF_SECONDS
+            while not self.try_acquire():
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    self.wait_time = monotonic() - started
                     raise FlockTimeout("Timed out attempting to acquire flock.")
-            finally:
-                signal.alarm(0)
-                signal.signal(signal.SIGALRM, original_handler)
+                time.sleep(min(backoff, remaining))
+                backoff = min(backoff * 2, self.MAX_BACKOFF_SECONDS)
+        self.wait_time = monotonic() - started
 
     def release(self):
         fcntl.flock(self.fd, fcntl.LOCK_UN)
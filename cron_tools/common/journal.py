@@ -0,0 +1,192 @@
+"""
+Append-only journal of agent RPC events, written by wrappers when the agent cannot be reached and ingested by the agent.
+
+Each record is a big endian unsigned 32 bit length followed by the serialized event. Writers append whole records with
+a single write while holding a shared flock; the agent takes the exclusive flock to read and truncate the journal.
+
+The journal is shared by the wrappers of every user, so its mode is set explicitly rather than left to the umask of
+whichever process created it: by default anybody may append to it, only its owner (the agent) may read it.
+
+Records that cannot be decoded or applied are moved to a quarantine file next to the journal (its path with
+".quarantine" appended), in the same format, rather than holding up every record behind them forever.
+"""
+import fcntl
+import os
+import errno
+import struct
+import logging
+from contextlib import contextmanager
+
+from cron_tools.common.flock import FlockLock
+from cron_tools.common.rpc import serialize, deserialize
+
+RECORD_HEADER = struct.Struct('!L')
+
+FSYNC_ALWAYS = 'always'
+FSYNC_NEVER = 'never'
+FSYNC_POLICIES = (FSYNC_ALWAYS, FSYNC_NEVER)
+
+DEFAULT_JOURNAL_MODE = 0o622
+
+journal_logger = logging.getLogger(__name__)
+
+
+def encode_record(method, params):
+    payload = serialize({'method': method, 'params': params})
+    return RECORD_HEADER.pack(len(payload)) + payload
+
+
+def split_records(data):
+    """
+    Returns the payloads of the complete records and the number of bytes they occupied; a trailing partial record is
+    not consumed.
+    """
+    payloads = []
+    offset = 0
+    while offset + RECORD_HEADER.size <= len(data):
+        length, = RECORD_HEADER.unpack_from(data, offset)
+        end = offset + RECORD_HEADER.size + length
+        if end > len(data):
+            break
+        payloads.append(bytes(data[offset + RECORD_HEADER.size:end]))
+        offset = end
+    return payloads, offset
+
+
+def decode_records(data):
+    """
+    Returns the decoded events and the number of bytes they occupied; a trailing partial record is not consumed.
+    """
+    payloads, consumed = split_records(data)
+    return [deserialize(payload) for payload in payloads], consumed
+
+
+def resolve_group(group):
+    """
+    The gid of a group given by name or gid.
+    """
+    if group is None or isinstance(group, int):
+        return group
+    import grp
+    return grp.getgrnam(group).gr_gid
+
+
+class EventJournal(object):
+    def __init__(self, path, fsync_policy=FSYNC_ALWAYS, mode=DEFAULT_JOURNAL_MODE):
+        if fsync_policy not in FSYNC_POLICIES:
+            raise ValueError("Unknown journal fsync policy: {0}".format(fsync_policy))
+        self.path = path
+        self.quarantine_path = path + '.quarantine'
+        self.fsync_policy = fsync_policy
+        self.mode = mode
+        self._quarantined = None
+
+    def _open_for_append(self):
+        while True:
+            try:
+                return os.open(self.path, os.O_WRONLY | os.O_APPEND)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            try:
+                fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_EXCL, self.mode)
+            except OSError as e:
+                # Created by somebody else in the meantime, open theirs.
+                if e.errno != errno.EEXIST:
+                    raise
+                continue
+            os.fchmod(fd, self.mode)
+            return fd
+
+    def prepare(self, group=None):
+        """
+        Create the journal if it does not exist yet and set its mode (and group, given by name or gid), so that
+        wrappers running as any user can append to it. The agent does this when it starts.
+        """
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, self.mode)
+        try:
+            gid = resolve_group(group)
+            if gid is not None:
+                os.fchown(fd, -1, gid)
+            os.fchmod(fd, self.mode)
+        finally:
+            os.close(fd)
+
+    def append(self, method, params):
+        record = encode_record(method, params)
+        lock = FlockLock(self._open_for_append(), flock_mode=fcntl.LOCK_SH)
+        try:
+            with lock:
+                os.write(lock.fd, record)
+                if self.fsync_policy == FSYNC_ALWAYS:
+                    os.fsync(lock.fd)
+        finally:
+            lock.close()
+
+    def quarantine(self, event):
+        """
+        Move an event yielded by drain() to the quarantine file instead of dropping it along with the rest of the
+        journal, e.g. because applying it failed.
+        """
+        if self._quarantined is None:
+            raise RuntimeError("Events can only be quarantined while the journal is being drained.")
+        self._quarantined.append(serialize(event))
+
+    def _write_quarantine(self, payloads):
+        fd = os.open(self.quarantine_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            os.write(fd, b"".join(RECORD_HEADER.pack(len(payload)) + payload for payload in payloads))
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        journal_logger.warning(
+            "Moved {0} journal records from {1} to {2}".format(len(payloads), self.path, self.quarantine_path)
+        )
+
+    @contextmanager
+    def drain(self):
+        """
+        Yields every complete event in the journal while holding the exclusive lock. If the body of the with block
+        succeeds, the records that could not be decoded and the events passed to quarantine() go to the quarantine
+        file, and the journal is truncated.
+        """
+        try:
+            fd = os.open(self.path, os.O_RDWR)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            yield []
+            return
+        lock = FlockLock(fd, flock_mode=fcntl.LOCK_EX)
+        try:
+            with lock:
+                chunks = []
+                chunk = os.read(fd, 1024 * 1024)
+                while chunk:
+                    chunks.append(chunk)
+                    chunk = os.read(fd, 1024 * 1024)
+                data = b"".join(chunks)
+                payloads, consumed = split_records(data)
+                if consumed != len(data):
+                    # Writers hold the shared lock for the whole write, so this is a write that never completed.
+                    journal_logger.warning(
+                        "Discarding {0} bytes of incomplete journal record in {1}".format(
+                            len(data) - consumed, self.path
+                        )
+                    )
+                events = []
+                self._quarantined = []
+                for payload in payloads:
+                    try:
+                        events.append(deserialize(payload))
+                    except ValueError:
+                        journal_logger.warning("Unable to decode a journal record in {0}".format(self.path))
+                        self._quarantined.append(payload)
+                yield events
+                if self._quarantined:
+                    self._write_quarantine(self._quarantined)
+                os.ftruncate(fd, 0)
+                os.fsync(fd)
+        finally:
+            self._quarantined = None
+            lock.close()
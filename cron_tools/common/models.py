@@ -1,16 +1,30 @@
 """
 Common record types for both the agent and aggregator.
 """
-import uuid
+import binascii
 import json
+import os
 
 from cron_tools.common.time import from_any_time_to_utc_seconds, from_utc_seconds_to_datetime, \
     from_any_time_to_datetime
 
 
+def generate_job_uuid():
+    """
+    A random (version 4) UUID string, built directly from os.urandom instead of importing the uuid module.
+    """
+    raw = bytearray(os.urandom(16))
+    raw[6] = (raw[6] & 0x0f) | 0x40
+    raw[8] = (raw[8] & 0x3f) | 0x80
+    h = binascii.hexlify(bytes(raw)).decode('ascii')
+    return "{0}-{1}-{2}-{3}-{4}".format(h[:8], h[8:12], h[12:16], h[16:20], h[20:])
+
+
 class AgentJob(object):
     def __init__(self, job_id, uuid, name, args, user, host, tags, status_code, start_time, end_time,
-                 created_time, last_updated_time, last_updated_sequence_number):
+                 created_time, last_updated_time, last_updated_sequence_number, resource_usage=None,
+                 lock_wait_seconds=None, last_heartbeat_time=None, start_delay_seconds=None,
+                 scheduling=None):
         self.job_id = job_id
         self.uuid = uuid
         self.name = name
@@ -24,6 +38,11 @@ class AgentJob(object):
         self.created_time = created_time
         self.last_updated_time = last_updated_time
         self.last_updated_sequence_number = last_updated_sequence_number
+        self.resource_usage = resource_usage
+        self.lock_wait_seconds = lock_wait_seconds
+        self.last_heartbeat_time = last_heartbeat_time
+        self.start_delay_seconds = start_delay_seconds
+        self.scheduling = scheduling
 
     def to_row(self):
         return {
@@ -39,7 +58,12 @@ class AgentJob(object):
             'job_end_time_utc_epoch_seconds': from_any_time_to_utc_seconds(self.end_time),
             'created_time_utc_epoch_seconds': from_any_time_to_utc_seconds(self.created_time),
             'last_updated_time_utc_epoch_seconds': from_any_time_to_utc_seconds(self.last_updated_time),
-            'last_updated_sequence_number': self.last_updated_sequence_number
+            'last_updated_sequence_number': self.last_updated_sequence_number,
+            'job_resource_usage_json': json.dumps(self.resource_usage) if self.resource_usage is not None else None,
+            'job_lock_wait_seconds': self.lock_wait_seconds,
+            'job_last_heartbeat_utc_epoch_seconds': from_any_time_to_utc_seconds(self.last_heartbeat_time),
+            'job_start_delay_seconds': self.start_delay_seconds,
+            'job_scheduling_json': json.dumps(self.scheduling) if self.scheduling is not None else None
         }
 
     @classmethod
@@ -57,7 +81,12 @@ class AgentJob(object):
             end_time=from_utc_seconds_to_datetime(row['job_end_time_utc_epoch_seconds']),
             created_time=from_utc_seconds_to_datetime(row['created_time_utc_epoch_seconds']),
             last_updated_time=from_utc_seconds_to_datetime(row['last_updated_time_utc_epoch_seconds']),
-            last_updated_sequence_number=row['last_updated_sequence_number']
+            last_updated_sequence_number=row['last_updated_sequence_number'],
+            resource_usage=json.loads(row['job_resource_usage_json']) if row['job_resource_usage_json'] else None,
+            lock_wait_seconds=row['job_lock_wait_seconds'],
+            last_heartbeat_time=from_utc_seconds_to_datetime(row['job_last_heartbeat_utc_epoch_seconds']),
+            start_delay_seconds=row['job_start_delay_seconds'],
+            scheduling=json.loads(row['job_scheduling_json']) if row['job_scheduling_json'] else None
         )
 
     def serialize(self):
@@ -74,7 +103,12 @@ class AgentJob(object):
             'job_end_time_utc_epoch_seconds': from_any_time_to_utc_seconds(self.end_time),
             'created_time_utc_epoch_seconds': from_any_time_to_utc_seconds(self.created_time),
             'last_updated_time_utc_epoch_seconds': from_any_time_to_utc_seconds(self.last_updated_time),
-            'last_updated_sequence_number': self.last_updated_sequence_number
+            'last_updated_sequence_number': self.last_updated_sequence_number,
+            'job_resource_usage': self.resource_usage,
+            'job_lock_wait_seconds': self.lock_wait_seconds,
+            'job_last_heartbeat_utc_epoch_seconds': from_any_time_to_utc_seconds(self.last_heartbeat_time),
+            'job_start_delay_seconds': self.start_delay_seconds,
+            'job_scheduling': self.scheduling
         }
 
     @classmethod
@@ -94,7 +128,12 @@ class AgentJob(object):
             end_time=from_any_time_to_datetime(raw_agent_job['job_end_time_utc_epoch_seconds']),
             created_time=from_any_time_to_datetime(raw_agent_job['created_time_utc_epoch_seconds']),
             last_updated_time=from_any_time_to_datetime(raw_agent_job['last_updated_time_utc_epoch_seconds']),
-            last_updated_sequence_number=raw_agent_job['last_updated_sequence_number']
+            last_updated_sequence_number=raw_agent_job['last_updated_sequence_number'],
+            resource_usage=raw_agent_job.get('job_resource_usage'),
+            lock_wait_seconds=raw_agent_job.get('job_lock_wait_seconds'),
+            last_heartbeat_time=from_any_time_to_datetime(raw_agent_job.get('job_last_heartbeat_utc_epoch_seconds')),
+            start_delay_seconds=raw_agent_job.get('job_start_delay_seconds'),
+            scheduling=raw_agent_job.get('job_scheduling')
         )
 
 class AggregatorJob(object):
@@ -0,0 +1,56 @@
+"""
+Encoding of captured job output chunks as they travel from the wrapper to the agent: zlib compressed, then base64
+encoded so they fit in a JSON-RPC message. The agent stores the compressed bytes as they are, and cleans up the
+wrapper's per-job spool files once they are old.
+"""
+import base64
+import os
+import re
+import time
+import zlib
+
+DEFAULT_COMPRESSION_LEVEL = 1
+
+# <job uuid>.<stream>, as the wrapper names its spool files.
+SPOOL_FILE_NAME_PATTERN = re.compile(r'^[0-9a-fA-F-]{32,36}\.(stdout|stderr)$')
+
+
+def encode_output_chunk(raw, compression_level=DEFAULT_COMPRESSION_LEVEL):
+    return base64.b64encode(zlib.compress(raw, compression_level)).decode('ascii')
+
+
+def output_chunk_to_blob(data):
+    return base64.b64decode(data)
+
+
+def blob_to_output_chunk(blob):
+    return base64.b64encode(bytes(blob)).decode('ascii')
+
+
+def decode_output_chunk(data):
+    return zlib.decompress(output_chunk_to_blob(data))
+
+
+def remove_old_spool_files(spool_directory, min_age_hours, now=None):
+    """
+    Remove the per-job output spool files in spool_directory last written to over min_age_hours ago, leaving any
+    other file alone. Returns the number removed.
+    """
+    now = time.time() if now is None else now
+    try:
+        names = os.listdir(spool_directory)
+    except OSError:
+        return 0
+    removed = 0
+    for name in names:
+        if not SPOOL_FILE_NAME_PATTERN.match(name):
+            continue
+        path = os.path.join(spool_directory, name)
+        try:
+            if now - os.path.getmtime(path) > min_age_hours * 3600:
+                os.remove(path)
+                removed += 1
+        except OSError:
+            # Removed by somebody else in the meantime, or not ours to remove.
+            pass
+    return removed
@@ -2,14 +2,31 @@
 Common Remote Procedure Call (rpc) library, both client and server, based loosely off of the JSON-RPC 2.0 standard.
 """
 import json
-import inspect
 import collections
-import six
+import math
+import sys
 import threading
+import time
 import traceback
+import logging
+
+from cron_tools.common.rpc_codecs import JSON_CODEC
+
+logger = logging.getLogger(__name__)
 
 RPCErrorCode = collections.namedtuple('RPCErrorCode', ('value', 'message', 'description'))
 
+monotonic = getattr(time, 'monotonic', time.time)
+
+# Latency histogram buckets grow geometrically, LATENCY_BUCKETS_PER_DOUBLING to each doubling, so that percentiles
+# read off them are within about 19% of the truth at any scale. The first bucket holds everything up to
+# LATENCY_HISTOGRAM_MIN_SECONDS and the last everything beyond the others (about 168 seconds).
+LATENCY_HISTOGRAM_MIN_SECONDS = 0.00001
+LATENCY_BUCKETS_PER_DOUBLING = 4
+LATENCY_HISTOGRAM_BUCKETS = 24 * LATENCY_BUCKETS_PER_DOUBLING + 2
+# Payload sizes of batches are recorded under this name, the time and outcome of each request in them under its method.
+BATCH_STATS_NAME = "(batch)"
+
 
 # Taken from the JSON-RPC 2.0 specification
 # https://www.jsonrpc.org/specification
@@ -34,6 +51,11 @@ class RPCErrorCodes(object):
         -32603, "Internal Error",
         "Internal JSON-RPC Error"
     )
+    # -32000 to -32099 are left by the specification for implementation defined server errors.
+    SERVER_OVERLOADED = RPCErrorCode(
+        -32001, "Server Overloaded",
+        "The server shed the request to protect itself, try again later."
+    )
 
 
 class RPCException(Exception):
@@ -51,9 +73,10 @@ def deserialize(i):
 
 
 class BaseRPCClientHandler(object):
-    def __init__(self):
+    def __init__(self, codec=JSON_CODEC):
         self._counter = 1
         self._lock = threading.Lock()
+        self.codec = codec
 
     @property
     def current_id(self):
@@ -62,21 +85,49 @@ class BaseRPCClientHandler(object):
             self._counter += 1
             return value
 
-    def marshal_request(self, name, params):
-        return serialize({
+    def marshal_request(self, name, params, request_id=None):
+        return self.codec.encode({
             "json-rpc": "2.0",
-            "id": self.current_id,
+            "id": request_id if request_id is not None else self.current_id,
             "method": name,
             "params": params
         })
 
-    def unmarshal_response(self, raw_response):
+    def marshal_notification(self, name, params):
+        """
+        A notification is a request without an id; the server executes it but never sends a response.
+        """
+        return self.codec.encode({
+            "json-rpc": "2.0",
+            "method": name,
+            "params": params
+        })
+
+    def marshal_batch(self, calls):
+        """
+        Marshal (name, params) pairs into a single batch request, returning it with the ids of its requests.
+        """
+        ids = [self.current_id for _ in calls]
+        return self.codec.encode([
+            {
+                "json-rpc": "2.0",
+                "id": request_id,
+                "method": name,
+                "params": params
+            }
+            for request_id, (name, params) in zip(ids, calls)
+        ]), ids
+
+    def decode_response(self, raw_response):
         try:
-            response = deserialize(raw_response)
+            return self.codec.decode(raw_response)
         except ValueError:
             raise RPCException(
                 "Malformed response from server", None
             )
+
+    @staticmethod
+    def response_result(response):
         if not isinstance(response, dict):
             raise RPCException(
                 "Incorrectly structured JSON payload from server", None
@@ -93,20 +144,49 @@ class BaseRPCClientHandler(object):
                 "Incorrectly structured JSON payload from server", None
             )
 
+    def unmarshal_response(self, raw_response):
+        return self.response_result(self.decode_response(raw_response))
+
+    def unmarshal_batch_response(self, raw_response, ids):
+        """
+        Returns the results of a batch in the order of its requests, with an RPCException in place of the result of
+        each request that failed. An error for the batch as a whole is raised.
+        """
+        return self.batch_results(self.decode_response(raw_response), ids)
+
+    def batch_results(self, responses, ids):
+        if not isinstance(responses, list):
+            self.response_result(responses)
+            raise RPCException(
+                "Incorrectly structured JSON payload from server", None
+            )
+        responses_by_id = dict((r.get("id"), r) for r in responses if isinstance(r, dict))
+        results = []
+        for request_id in ids:
+            try:
+                results.append(self.response_result(responses_by_id.get(request_id)))
+            except RPCException as e:
+                results.append(e)
+        return results
+
 
 class RPCMethod(object):
-    def __init__(self, func):
+    def __init__(self, func, write=False):
         self.func = func
+        self.write = write
 
+    # inspect is only needed by servers describing their methods, so clients do not import it.
     @property
     def params(self):
-        if six.PY2:
+        import inspect
+        if sys.version_info[0] == 2:
             return inspect.getargspec(self.func)[0]
         else:
             return inspect.signature(self.func).parameters.keys()
 
     @property
     def documentation(self):
+        import inspect
         return inspect.getdoc(self.func)
 
     def handle(self, raw_params):
@@ -115,58 +195,256 @@ class RPCMethod(object):
         )
 
 
-class BaseRPCServerHandler(object):
+def latency_bucket(seconds):
+    if seconds <= LATENCY_HISTOGRAM_MIN_SECONDS:
+        return 0
+    index = int(math.ceil(math.log(seconds / LATENCY_HISTOGRAM_MIN_SECONDS, 2) * LATENCY_BUCKETS_PER_DOUBLING))
+    return min(index, LATENCY_HISTOGRAM_BUCKETS - 1)
+
+
+def latency_bucket_upper_bound(index):
+    return LATENCY_HISTOGRAM_MIN_SECONDS * 2 ** (float(index) / LATENCY_BUCKETS_PER_DOUBLING)
+
+
+class RPCMethodStats(object):
     def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.request_bytes = 0
+        self.response_bytes = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.latency_counts = [0] * LATENCY_HISTOGRAM_BUCKETS
+
+    def percentile(self, fraction):
+        """
+        The upper bound of the histogram bucket the given fraction of calls finished within, capped at the slowest.
+        """
+        completed = sum(self.latency_counts)
+        if not completed:
+            return None
+        threshold = fraction * completed
+        seen = 0
+        for index, count in enumerate(self.latency_counts):
+            seen += count
+            if count and seen >= threshold:
+                return min(latency_bucket_upper_bound(index), self.max_seconds)
+        return self.max_seconds
+
+    def snapshot(self):
+        completed = sum(self.latency_counts)
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'in_flight': self.in_flight,
+            'request_bytes': self.request_bytes,
+            'response_bytes': self.response_bytes,
+            'mean_seconds': self.total_seconds / completed if completed else None,
+            'max_seconds': self.max_seconds if completed else None,
+            'p50_seconds': self.percentile(0.5),
+            'p90_seconds': self.percentile(0.9),
+            'p99_seconds': self.percentile(0.99),
+            # [bucket upper bound in seconds, count] for the buckets with any calls, so histograms can be merged.
+            'latency_histogram': [
+                [latency_bucket_upper_bound(index), count] for index, count in enumerate(self.latency_counts) if count
+            ]
+        }
+
+
+class RPCStats(object):
+    """
+    Per-method call counts, error counts, in-flight gauges, payload sizes and latency histograms of an RPC server.
+    Recording a call costs a lock and a few additions, the percentiles are only worked out by snapshot().
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.methods = {}
+        self.started_time = time.time()
+
+    def _method(self, name):
+        stats = self.methods.get(name)
+        if stats is None:
+            stats = self.methods[name] = RPCMethodStats()
+        return stats
+
+    def call_started(self, name):
+        with self._lock:
+            stats = self._method(name)
+            stats.calls += 1
+            stats.in_flight += 1
+        return monotonic()
+
+    def call_finished(self, name, started, failed=False):
+        seconds = max(0.0, monotonic() - started)
+        with self._lock:
+            stats = self._method(name)
+            stats.in_flight -= 1
+            stats.total_seconds += seconds
+            stats.latency_counts[latency_bucket(seconds)] += 1
+            if seconds > stats.max_seconds:
+                stats.max_seconds = seconds
+            if failed:
+                stats.errors += 1
+
+    def record_payload(self, name, request_bytes, response_bytes):
+        with self._lock:
+            stats = self._method(name)
+            stats.request_bytes += request_bytes
+            stats.response_bytes += response_bytes
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'uptime_seconds': time.time() - self.started_time,
+                'methods': dict((name, stats.snapshot()) for name, stats in self.methods.items())
+            }
+
+
+class BaseRPCServerHandler(object):
+    """
+    Executes JSON-RPC 2.0 requests, notifications and batches of them. batch_transaction, if set, is a callable
+    that calls the function it is given inside a transaction and returns its result. A batch containing any write
+    method (see register_function) is handled through it, so that the whole batch commits at once.
+    """
+
+    def __init__(self, batch_transaction=None, stats=None):
         self.registered_functions = {}
+        self.batch_transaction = batch_transaction
+        self.stats = stats if stats is not None else RPCStats()
 
-    def register_function(self, name, function):
+    def register_function(self, name, function, write=False):
         if not callable(function):
             raise ValueError("register_function requires a callable for the function parameter!")
         self.registered_functions[name] = RPCMethod(
-            function
+            function, write=write
         )
 
-    def handle_request(self, raw_request):
+    @staticmethod
+    def error_response(message, code, request_id=None):
+        response = {
+            "json-rpc": "2.0",
+            "error": {
+                "message": message,
+                "code": code
+            }
+        }
+        if request_id is not None:
+            response["id"] = request_id
+        return response
+
+    def error_responses(self, parsed, message, code):
+        """
+        The response failing every request of a decoded request or batch with the same error, each under its own
+        id; None if there are only notifications to fail.
+        """
+        if isinstance(parsed, list):
+            return [
+                self.error_response(message, code, request.get("id"))
+                for request in parsed if isinstance(request, dict) and "id" in request
+            ] or None
+        if isinstance(parsed, dict) and "method" in parsed and "id" not in parsed:
+            return None
+        return self.error_response(message, code, parsed.get("id") if isinstance(parsed, dict) else None)
+
+    def handle_request(self, raw_request, codec=JSON_CODEC):
+        """
+        Handle one request payload, a single request or a batch, and return the encoded response, or None when
+        there is nothing to answer (notifications). Responses are encoded with the codec the request was.
+        """
         try:
-            parsed = deserialize(raw_request)
+            parsed = codec.decode(raw_request)
         except ValueError as e:
-            return serialize({
-                "json-rpc": "2.0",
-                "error": {
-                    "message": repr(e),
-                    "code": RPCErrorCodes.PARSE_ERROR.value
-                }
-            })
+            return codec.encode(self.error_response(repr(e), RPCErrorCodes.PARSE_ERROR.value))
+        return self.handle_decoded_request(parsed, codec, len(raw_request))
+
+    def handle_decoded_request(self, parsed, codec=JSON_CODEC, request_bytes=0):
+        if isinstance(parsed, list):
+            response = self.handle_batch(parsed)
+            stats_name = BATCH_STATS_NAME
+        else:
+            response = self.handle_parsed_request(parsed)
+            stats_name = parsed.get('method') if isinstance(parsed, dict) else None
+        raw_response = codec.encode(response) if response is not None else None
+        # Only registered methods get stats, so clients calling made up names cannot grow them without bound.
+        if stats_name == BATCH_STATS_NAME or self.is_registered(stats_name):
+            self.stats.record_payload(
+                stats_name, request_bytes, len(raw_response) if raw_response is not None else 0
+            )
+        return raw_response
+
+    def is_registered(self, name):
+        try:
+            return name in self.registered_functions
+        except TypeError:
+            return False
+
+    def is_write_request(self, parsed):
+        try:
+            return self.registered_functions[parsed['method']].write
+        except (KeyError, TypeError):
+            return False
+
+    def is_write_payload(self, parsed):
+        """
+        Whether a decoded request, or any request of a decoded batch, calls a write method.
+        """
+        if isinstance(parsed, list):
+            return any(self.is_write_request(request) for request in parsed)
+        return self.is_write_request(parsed)
+
+    def handle_batch(self, batch):
+        if not batch:
+            return self.error_response(RPCErrorCodes.INVALID_REQUEST.message, RPCErrorCodes.INVALID_REQUEST.value)
+        if self.batch_transaction is not None and self.is_write_payload(batch):
+            try:
+                responses = self.batch_transaction(lambda: [self.handle_parsed_request(parsed) for parsed in batch])
+            except Exception as e:
+                logger.exception("RPC batch transaction failed.")
+                # Every request of the batch was rolled back, so each gets the error under its own id.
+                return self.error_responses(
+                    batch, repr(e) + "\n" + traceback.format_exc(), RPCErrorCodes.INTERNAL_ERROR.value
+                )
+        else:
+            responses = [self.handle_parsed_request(parsed) for parsed in batch]
+        # A batch of only notifications gets no response at all.
+        return [response for response in responses if response is not None] or None
+
+    def handle_parsed_request(self, parsed):
         if not (isinstance(parsed, dict) and "method" in parsed and "params" in parsed):
-            return serialize({
-                "json-rpc": "2.0",
-                "error": {
-                    "message": RPCErrorCodes.INVALID_REQUEST.message,
-                    "code": RPCErrorCodes.INVALID_REQUEST.value
-                }
-            })
+            return self.error_response(
+                RPCErrorCodes.INVALID_REQUEST.message, RPCErrorCodes.INVALID_REQUEST.value,
+                parsed.get("id") if isinstance(parsed, dict) else None
+            )
         method = parsed['method']
         params = parsed['params']
+        is_notification = "id" not in parsed
+        request_id = parsed.get("id")
         if method not in self.registered_functions:
-            return serialize({
-                "json-rpc": "2.0",
-                "error": {
-                    "message": RPCErrorCodes.METHOD_NOT_FOUND.message,
-                    "code": RPCErrorCodes.METHOD_NOT_FOUND.value
-                }
-            })
+            if is_notification:
+                return None
+            return self.error_response(
+                RPCErrorCodes.METHOD_NOT_FOUND.message, RPCErrorCodes.METHOD_NOT_FOUND.value, request_id
+            )
+        started = self.stats.call_started(method)
         try:
             result = self.registered_functions[method].handle(params)
             response = {
                 "result": result
             }
         except Exception as e:
-            return serialize({
-                "json-rpc": "2.0",
-                "error": {
-                    "message": repr(e) + "\n" + traceback.format_exc(),
-                    "code": RPCErrorCodes.INTERNAL_ERROR.value
-                }
-            })
+            self.stats.call_finished(method, started, failed=True)
+            if is_notification:
+                logger.exception("Notification {0} failed.".format(method))
+                return None
+            return self.error_response(
+                repr(e) + "\n" + traceback.format_exc(), RPCErrorCodes.INTERNAL_ERROR.value, request_id
+            )
         else:
-            return serialize(response)
+            self.stats.call_finished(method, started)
+            if is_notification:
+                return None
+            if request_id is not None:
+                response["id"] = request_id
+            return response
@@ -1,43 +1,593 @@
-from cron_tools.common.rpc import BaseRPCClientHandler
+from cron_tools.common.rpc import BaseRPCClientHandler, RPCException
+from cron_tools.common.rpc_codecs import get_codec, CODEC_JSON, JSON_CODEC
+from contextlib import contextmanager
+import abc
+import errno
 import socket
 import struct
+import threading
+import time
 
 
-MAGIC_BYTE = b'\x5A'
+MAGIC_BYTE = JSON_CODEC.magic_byte
+# Every frame: the codec's magic byte, then the payload length.
+FRAME_HEADER = struct.Struct('!cL')
 
+DEFAULT_RECEIVE_BUFFER_SIZE = 64 * 1024
+# Responses larger than this are read into a buffer of their own rather than growing the reusable one for good.
+MAX_RETAINED_BUFFER_SIZE = 4 * 1024 * 1024
 
-class RPCClient(object):
-    def __init__(self, socket_addr, socket_family=socket.AF_UNIX):
+HAS_SENDMSG = hasattr(socket.socket, 'sendmsg')
+
+# Errors of a write to a connection the agent has already closed, e.g. because it restarted since the last call.
+STALE_CONNECTION_ERRNOS = (errno.EPIPE, errno.ECONNRESET, errno.ENOTCONN, errno.ECONNABORTED)
+
+# Largest message of the seqpacket and datagram transports, magic byte included. The kernel's own limit, the socket
+# send buffer size (about 208KB by default), is normally lower.
+MAX_MESSAGE_BYTES = 256 * 1024
+
+
+AbstractBase = abc.ABCMeta('AbstractBase', (object,), {'__slots__': ()})
+
+
+class RPCConnectionError(IOError):
+    pass
+
+
+class RPCMessageTooLarge(RPCConnectionError):
+    """
+    A request does not fit in a single message of the seqpacket or datagram transport; nothing of it was sent.
+    """
+    pass
+
+
+def send_frame(sock, magic_byte, payload):
+    """
+    Send a frame with as few system calls as possible: a single sendmsg of header and payload, unless the socket
+    takes less than all of it.
+    """
+    header = FRAME_HEADER.pack(magic_byte, len(payload))
+    if not HAS_SENDMSG:
+        sock.sendall(header + payload)
+        return
+    sent = sock.sendmsg([header, payload])
+    if sent < len(header):
+        sock.sendall(header[sent:])
+        sock.sendall(payload)
+    elif sent < len(header) + len(payload):
+        sock.sendall(memoryview(payload)[sent - len(header):])
+
+
+def send_message(sock, magic_byte, payload):
+    """
+    Send a payload as one message of a SOCK_SEQPACKET or SOCK_DGRAM socket, the message boundary standing in for the
+    frame length.
+    """
+    if len(payload) + 1 > MAX_MESSAGE_BYTES:
+        raise RPCMessageTooLarge("A {0} byte payload does not fit in a message.".format(len(payload)))
+    try:
+        if HAS_SENDMSG:
+            sock.sendmsg([magic_byte, payload])
+        else:
+            sock.send(magic_byte + bytes(payload))
+    except (IOError, OSError) as e:
+        if getattr(e, 'errno', None) == errno.EMSGSIZE:
+            raise RPCMessageTooLarge("A {0} byte payload does not fit in a message.".format(len(payload)))
+        raise
+
+
+class BaseRPCClient(AbstractBase):
+    """
+    Connection handling shared by the agent RPC clients: connecting with retries, sending a request with the
+    codec's framing (write_request, defined by each transport) and notifications, which need no answer. The codec
+    (see cron_tools.common.rpc_codecs) is chosen by name; the agent answers in whatever codec the request used, but
+    agents predating codec support only understand JSON.
+
+    timeout bounds every send and receive, and connect_timeout (defaulting to timeout) the connection attempt.
+    Failed connection attempts, and sends on a reused connection the agent has since closed, are retried up to
+    reconnect_attempts times with exponential backoff. A request is never resent once any of it reached the agent.
+    """
+
+    socket_type = None
+
+    # Errors of a write to a connection the agent has already closed.
+    stale_connection_errnos = STALE_CONNECTION_ERRNOS
+
+    def __init__(self, socket_addr, socket_family=socket.AF_UNIX, timeout=None, codec=CODEC_JSON,
+                 connect_timeout=None, reconnect_attempts=0, reconnect_backoff=0.05, max_reconnect_backoff=1.0):
         self.socket_addr = socket_addr
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout if connect_timeout is not None else timeout
+        self.reconnect_attempts = reconnect_attempts
+        self.reconnect_backoff = reconnect_backoff
+        self.max_reconnect_backoff = max_reconnect_backoff
         self.socket_family = socket_family
-        self.socket_type = socket.SOCK_STREAM
-        self.client_handler = BaseRPCClientHandler()
+        self.codec = get_codec(codec)
+        self.client_handler = BaseRPCClientHandler(self.codec)
         self.socket = None
 
+    def _connect_once(self):
+        sock = socket.socket(self.socket_family, self.socket_type)
+        try:
+            sock.settimeout(self.connect_timeout)
+            sock.connect(self.socket_addr)
+            sock.settimeout(self.timeout)
+        except BaseException:
+            sock.close()
+            raise
+        self.socket = sock
+
+    def backoff_seconds(self, attempt):
+        return min(self.reconnect_backoff * (2 ** attempt), self.max_reconnect_backoff)
+
     def connect(self):
-        if self.socket is None:
-            self.socket = socket.socket(self.socket_family, self.socket_type)
-            self.socket.connect(self.socket_addr)
+        if self.socket is not None:
+            return
+        attempt = 0
+        while True:
+            try:
+                self._connect_once()
+                return
+            except (IOError, OSError):
+                if attempt >= self.reconnect_attempts:
+                    raise
+            time.sleep(self.backoff_seconds(attempt))
+            attempt += 1
 
     def disconnect(self):
         if self.socket is not None:
-            self.socket.shutdown(socket.SHUT_RDWR)
-            self.socket.close()
-            self.socket = None
+            sock, self.socket = self.socket, None
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except (IOError, OSError):
+                pass
+            finally:
+                sock.close()
 
-    def handle_rpc_call(self, name, parameters):
-        if not self.socket:
+    @abc.abstractmethod
+    def write_request(self, payload):
+        """
+        Send one encoded request in the transport's framing.
+        """
+
+    def send_request(self, payload):
+        """
+        Send a request, reconnecting first if the connection turns out to have been closed by the agent before any
+        of it was written.
+        """
+        reused = self.socket is not None
+        self.connect()
+        try:
+            self.write_request(payload)
+        except RPCMessageTooLarge:
+            raise
+        except (IOError, OSError) as e:
+            self.disconnect()
+            if not (reused and self.reconnect_attempts and getattr(e, 'errno', None) in self.stale_connection_errnos):
+                raise
             self.connect()
+            self.write_request(payload)
+
+    def send_notification(self, name, parameters):
+        self.send_request(self.client_handler.marshal_notification(name, parameters))
+
+
+class BaseCallingRPCClient(BaseRPCClient):
+    """
+    A client of a connection oriented transport, which can also make calls: each request is answered with a
+    response, read by receive_frame (defined by each transport).
+    """
+
+    @abc.abstractmethod
+    def receive_frame(self):
+        """
+        Receive the next encoded response.
+        """
+
+    def exchange(self, request):
+        """
+        Send one encoded request and return the encoded response.
+        """
+        self.send_request(request)
+        try:
+            return self.receive_frame()
+        except socket.timeout:
+            # The response may still arrive later and would be taken for the answer to the next request.
+            self.disconnect()
+            raise
+
+    def handle_rpc_call(self, name, parameters):
         request = self.client_handler.marshal_request(name, parameters)
-        self.socket.send(MAGIC_BYTE)
-        self.socket.send(struct.pack('!L', len(request)))
-        self.socket.send(request)
+        return self.client_handler.unmarshal_response(self.exchange(request))
+
+    def handle_rpc_batch(self, calls):
+        """
+        Make several calls, given as (name, parameters) pairs, in one JSON-RPC batch round trip. The agent runs a
+        batch containing writes in a single transaction. Returns the results in order, with an RPCException in
+        place of each call that failed.
+        """
+        if not calls:
+            return []
+        request, ids = self.client_handler.marshal_batch(calls)
+        return self.client_handler.unmarshal_batch_response(self.exchange(request), ids)
+
+
+class RPCClient(BaseCallingRPCClient):
+    """
+    Client for the agent RPC protocol over its stream socket. Each request goes out in a single sendmsg (or sendall)
+    of header and payload, and responses are read with recv_into into a reusable buffer until the frame is
+    complete, however the kernel splits it up.
+
+    A client is not thread safe, see RPCClientPool for sharing connections between threads.
+    """
+
+    socket_type = socket.SOCK_STREAM
+
+    def __init__(self, socket_addr, **kwargs):
+        super(RPCClient, self).__init__(socket_addr, **kwargs)
+        self._buffer = bytearray(DEFAULT_RECEIVE_BUFFER_SIZE)
+        # Received but not yet consumed bytes are self._buffer[self._start:self._end].
+        self._start = self._end = 0
+
+    def disconnect(self):
+        self._start = self._end = 0
+        super(RPCClient, self).disconnect()
+
+    def write_request(self, payload):
+        send_frame(self.socket, self.codec.magic_byte, payload)
+
+    def _fill(self, amount):
+        """
+        Receive until at least amount bytes are pending in the buffer, reading as much as the socket has each time.
+        """
+        pending = self._end - self._start
+        if pending >= amount:
+            return
+        if self._start + amount > len(self._buffer):
+            if amount > len(self._buffer) or (pending == 0 and len(self._buffer) > MAX_RETAINED_BUFFER_SIZE):
+                buffer = bytearray(max(amount, DEFAULT_RECEIVE_BUFFER_SIZE))
+                buffer[:pending] = self._buffer[self._start:self._end]
+                self._buffer = buffer
+            else:
+                self._buffer[:pending] = self._buffer[self._start:self._end]
+            self._start, self._end = 0, pending
+        view = memoryview(self._buffer)
+        while self._end - self._start < amount:
+            received = self.socket.recv_into(view[self._end:])
+            if not received:
+                self.disconnect()
+                raise RPCConnectionError("The agent closed the connection mid-frame.")
+            self._end += received
+
+    def receive_frame(self):
+        """
+        Returns the payload of the next frame as a memoryview, valid until the next call.
+        """
+        self._fill(FRAME_HEADER.size)
+        magic_byte, length = FRAME_HEADER.unpack_from(self._buffer, self._start)
+        if magic_byte != self.codec.magic_byte:
+            self.disconnect()
+            raise RPCConnectionError("Bad RPC magic byte on response.")
+        self._start += FRAME_HEADER.size
+        self._fill(length)
+        view = memoryview(self._buffer)[self._start:self._start + length]
+        self._start += length
+        return view
+
+    def recv_bytes(self, amount):
+        self._fill(amount)
+        data = bytes(self._buffer[self._start:self._start + amount])
+        self._start += amount
+        return data
+
+
+class SeqpacketRPCClient(BaseCallingRPCClient):
+    """
+    Client over a SOCK_SEQPACKET socket (see the agent's seqpacket_socket_path): connection oriented like the
+    stream transport, but every request and response is a single message, the codec's magic byte followed by the
+    payload, so a request is one send and a response one receive. Requests and responses must fit in a message,
+    see RPCMessageTooLarge.
+    """
+
+    socket_type = socket.SOCK_SEQPACKET
+
+    def __init__(self, socket_addr, **kwargs):
+        super(SeqpacketRPCClient, self).__init__(socket_addr, **kwargs)
+        self._buffer = None
 
-        resp_magic_byte = self.socket.recv(1)
-        if resp_magic_byte != MAGIC_BYTE:
+    def write_request(self, payload):
+        send_message(self.socket, self.codec.magic_byte, payload)
+
+    def receive_frame(self):
+        if self._buffer is None:
+            # One byte to spare, so that a message filling all of it was one too long and got truncated.
+            self._buffer = bytearray(MAX_MESSAGE_BYTES + 1)
+        received = self.socket.recv_into(self._buffer)
+        if not received:
+            self.disconnect()
+            raise RPCConnectionError("The agent closed the connection.")
+        if received > MAX_MESSAGE_BYTES or self._buffer[:1] != self.codec.magic_byte:
             self.disconnect()
-            raise Exception("Bad RPC magic byte on response.")
-        raw_length = self.socket.recv(struct.calcsize("!L"))
-        length, = struct.unpack("!L", raw_length)
-        raw_response = self.socket.recv(length)
-        return self.client_handler.unmarshal_response(raw_response)
+            raise RPCConnectionError("Bad RPC message from the agent.")
+        return memoryview(self._buffer)[1:received]
+
+
+class DatagramRPCClient(BaseRPCClient):
+    """
+    Sends notifications as SOCK_DGRAM messages to the agent's datagram_socket_path. There is no way to answer a
+    datagram, so this client only has send_notification. Messages from one client arrive in the order they were
+    sent, and a full agent queue makes sending block (up to timeout).
+    """
+
+    socket_type = socket.SOCK_DGRAM
+
+    # The agent's socket was recreated since this one connected to it.
+    stale_connection_errnos = STALE_CONNECTION_ERRNOS + (errno.ECONNREFUSED,)
+
+    def write_request(self, payload):
+        send_message(self.socket, self.codec.magic_byte, payload)
+
+
+class RPCClientPool(object):
+    """
+    A small thread safe pool of RPCClient connections to one agent. At most size connections are open at once;
+    threads wanting one beyond that wait for another thread to give one back. A connection that failed in use is
+    closed instead of being returned to the pool.
+    """
+
+    def __init__(self, socket_addr, size=4, **client_kwargs):
+        self.socket_addr = socket_addr
+        self.size = size
+        self.client_kwargs = client_kwargs
+        self._available = threading.Semaphore(size)
+        self._lock = threading.Lock()
+        self._idle = []
+
+    @contextmanager
+    def connection(self):
+        self._available.acquire()
+        try:
+            with self._lock:
+                client = self._idle.pop() if self._idle else None
+            if client is None:
+                client = RPCClient(self.socket_addr, **self.client_kwargs)
+            try:
+                yield client
+            except RPCException:
+                # The agent answered with an error, the connection itself is fine.
+                self._return(client)
+                raise
+            except BaseException:
+                client.disconnect()
+                raise
+            self._return(client)
+        finally:
+            self._available.release()
+
+    def _return(self, client):
+        with self._lock:
+            self._idle.append(client)
+
+    def handle_rpc_call(self, name, parameters):
+        with self.connection() as client:
+            return client.handle_rpc_call(name, parameters)
+
+    def handle_rpc_batch(self, calls):
+        with self.connection() as client:
+            return client.handle_rpc_batch(calls)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for client in idle:
+            client.disconnect()
+
+
+class RPCFuture(object):
+    """
+    The eventual result of a call made with MultiplexedRPCClient.
+    """
+
+    def __init__(self, ids):
+        self.ids = ids
+        self._done = threading.Event()
+        self._result = None
+        self._exception = None
+
+    def set_result(self, result):
+        self._result = result
+        self._done.set()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise socket.timeout("No response from the agent within {0} seconds.".format(timeout))
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+
+class MultiplexedConnection(object):
+    def __init__(self, client):
+        self.client = client
+        # Request id -> (future, the ids of its batch or None for a single request)
+        self.pending = {}
+
+
+class MultiplexedRPCClient(object):
+    """
+    Client making any number of overlapping calls, from any number of threads, over a single agent connection.
+    Requests are sent as soon as they are made and a reader thread hands every response to the RPCFuture of the
+    request with its id, in whatever order the agent answers them. The asyncio agent server runs the pipelined read
+    requests of a connection side by side; the threading one answers them one after another.
+
+    timeout bounds the wait for each response. A response arriving after its caller stopped waiting is dropped
+    and the connection stays in use. If the connection fails, every pending call fails with RPCConnectionError
+    and the next call opens a new connection.
+    """
+
+    def __init__(self, socket_addr, socket_family=socket.AF_UNIX, timeout=None, codec=CODEC_JSON,
+                 connect_timeout=None, reconnect_attempts=0, reconnect_backoff=0.05, max_reconnect_backoff=1.0):
+        self.socket_addr = socket_addr
+        self.timeout = timeout
+        self.reconnect_attempts = reconnect_attempts
+        self.codec = get_codec(codec)
+        self.client_handler = BaseRPCClientHandler(self.codec)
+        # The reader thread blocks on the connection for as long as it is open, so only connecting has a timeout.
+        self.connection_kwargs = dict(
+            socket_family=socket_family, codec=codec,
+            connect_timeout=connect_timeout if connect_timeout is not None else timeout,
+            reconnect_attempts=reconnect_attempts, reconnect_backoff=reconnect_backoff,
+            max_reconnect_backoff=max_reconnect_backoff
+        )
+        self._lock = threading.RLock()
+        self._send_lock = threading.Lock()
+        self._connection = None
+
+    def connect(self):
+        with self._lock:
+            if self._connection is None:
+                client = RPCClient(self.socket_addr, **self.connection_kwargs)
+                client.connect()
+                connection = self._connection = MultiplexedConnection(client)
+                reader = threading.Thread(
+                    target=self._read_responses, args=(connection,), name="rpc-response-reader"
+                )
+                reader.daemon = True
+                reader.start()
+            return self._connection
+
+    def _close(self, connection, error):
+        with self._lock:
+            if self._connection is connection:
+                self._connection = None
+            pending, connection.pending = connection.pending, {}
+            connection.client.disconnect()
+        futures = set(future for future, _ in pending.values())
+        for future in futures:
+            future.set_exception(error)
+
+    def disconnect(self):
+        with self._lock:
+            connection = self._connection
+        if connection is not None:
+            self._close(connection, RPCConnectionError("The connection to the agent was closed."))
+
+    def _register(self, connection, future, batch_ids):
+        with self._lock:
+            for request_id in future.ids:
+                connection.pending[request_id] = (future, batch_ids)
+
+    def _unregister(self, connection, future):
+        with self._lock:
+            for request_id in future.ids:
+                connection.pending.pop(request_id, None)
+
+    def _send(self, payload, future, batch_ids=None):
+        # Sending has a lock of its own, as a sender blocked on a full socket must not keep the reader thread from
+        # handing out the responses the agent is trying to get rid of.
+        with self._send_lock:
+            reused = self._connection is not None
+            connection = self.connect()
+            # Registered first, since the response may be read before sending returns.
+            self._register(connection, future, batch_ids)
+            try:
+                send_frame(connection.client.socket, self.codec.magic_byte, payload)
+            except (IOError, OSError) as e:
+                self._unregister(connection, future)
+                self._close(connection, RPCConnectionError("Sending to the agent failed: {0!r}".format(e)))
+                if not (reused and self.reconnect_attempts and getattr(e, 'errno', None) in STALE_CONNECTION_ERRNOS):
+                    raise
+                connection = self.connect()
+                self._register(connection, future, batch_ids)
+                send_frame(connection.client.socket, self.codec.magic_byte, payload)
+        return future
+
+    def _read_responses(self, connection):
+        try:
+            while True:
+                response = self.client_handler.decode_response(connection.client.receive_frame())
+                self._dispatch(connection, response)
+        except Exception as e:
+            self._close(connection, e if isinstance(e, RPCConnectionError) else RPCConnectionError(
+                "The connection to the agent failed: {0!r}".format(e)
+            ))
+
+    def _dispatch(self, connection, response):
+        if isinstance(response, list):
+            request_id = next((r.get("id") for r in response if isinstance(r, dict) and "id" in r), None)
+        else:
+            request_id = response.get("id") if isinstance(response, dict) else None
+        if request_id is None:
+            # The agent could not tell which request this answers (it failed to parse one), nor can we.
+            raise RPCConnectionError("Response without a request id from the agent: {0!r}".format(response))
+        with self._lock:
+            entry = connection.pending.get(request_id)
+            if entry is None:
+                # Its caller has stopped waiting for it.
+                return
+            future, batch_ids = entry
+            for finished_id in future.ids:
+                connection.pending.pop(finished_id, None)
+        try:
+            if batch_ids is not None:
+                result = self.client_handler.batch_results(response, batch_ids)
+            else:
+                result = self.client_handler.response_result(response)
+        except RPCException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
+
+    def call_async(self, name, parameters):
+        """
+        Send a call without waiting for its response, returning an RPCFuture of its result.
+        """
+        request_id = self.client_handler.current_id
+        return self._send(self.client_handler.marshal_request(name, parameters, request_id), RPCFuture([request_id]))
+
+    def batch_async(self, calls):
+        """
+        Send (name, parameters) pairs as one batch without waiting for it, returning an RPCFuture of the list of
+        results (see RPCClient.handle_rpc_batch).
+        """
+        payload, ids = self.client_handler.marshal_batch(calls)
+        return self._send(payload, RPCFuture(ids), batch_ids=ids)
+
+    def wait(self, future):
+        try:
+            return future.result(self.timeout)
+        except socket.timeout:
+            connection = self._connection
+            if connection is not None:
+                self._unregister(connection, future)
+            raise
+
+    def handle_rpc_call(self, name, parameters):
+        return self.wait(self.call_async(name, parameters))
+
+    def handle_rpc_batch(self, calls):
+        if not calls:
+            return []
+        return self.wait(self.batch_async(calls))
+
+    def map_rpc_calls(self, calls):
+        """
+        Make (name, parameters) calls all at once, each answered as soon as the agent gets to it, and return their
+        results in order. Unlike a batch, the calls are independent requests and a failed one raises.
+        """
+        return [self.wait(future) for future in [self.call_async(name, parameters) for name, parameters in calls]]
+
+    def send_notification(self, name, parameters):
+        with self._send_lock:
+            connection = self.connect()
+            send_frame(
+                connection.client.socket, self.codec.magic_byte,
+                self.client_handler.marshal_notification(name, parameters)
+            )
@@ -0,0 +1,245 @@
+"""
+Payload codecs for the agent RPC protocol. Every frame starts with a magic byte naming the codec its payload is
+encoded with, and the agent answers in the codec the request came in, so clients pick their codec per connection
+without any handshake. JSON is the default and the only codec older agents understand.
+"""
+import json
+import struct
+import sys
+
+if sys.version_info[0] >= 3:
+    TEXT_TYPES = (str,)
+    BINARY_TYPES = (bytes, bytearray)
+    INTEGER_TYPES = (int,)
+else:
+    TEXT_TYPES = (unicode, str)  # noqa: F821
+    BINARY_TYPES = (bytearray,)
+    INTEGER_TYPES = (int, long)  # noqa: F821
+
+CODEC_JSON = 'json'
+CODEC_MSGPACK = 'msgpack'
+CODEC_COMPACT = 'compact'
+# msgpack when it is installed, otherwise the built-in compact codec.
+CODEC_BINARY = 'binary'
+
+
+class JSONCodec(object):
+    name = CODEC_JSON
+    magic_byte = b'\x5A'
+
+    @classmethod
+    def available(cls):
+        return True
+
+    def encode(self, o):
+        return json.dumps(o).encode('utf-8')
+
+    def decode(self, raw):
+        return json.loads(bytes(raw).decode('utf-8'))
+
+
+class MsgpackCodec(object):
+    """
+    MessagePack through the optional msgpack package, imported on first use.
+    """
+    name = CODEC_MSGPACK
+    magic_byte = b'\x4D'
+
+    @classmethod
+    def available(cls):
+        try:
+            import msgpack  # noqa: F401
+        except ImportError:
+            return False
+        return True
+
+    def encode(self, o):
+        import msgpack
+        return msgpack.packb(o, use_bin_type=True)
+
+    def decode(self, raw):
+        import msgpack
+        try:
+            return msgpack.unpackb(bytes(raw), raw=False)
+        except Exception as e:
+            raise ValueError("Malformed msgpack payload: {0!r}".format(e))
+
+
+# Strings the compact codec sends as a one byte index: the JSON-RPC envelope, the AgentJob record and the parameters
+# and results of the agent's methods. Only ever append to this list, its order is part of the wire format.
+COMPACT_INTERNED_STRINGS = (
+    'json-rpc', '2.0', 'id', 'method', 'params', 'result', 'error', 'message', 'code',
+    'job_id', 'job_uuid', 'job_name', 'job_args', 'job_user', 'job_host', 'job_tags', 'job_status_code',
+    'job_start_time_utc_epoch_seconds', 'job_end_time_utc_epoch_seconds', 'created_time_utc_epoch_seconds',
+    'last_updated_time_utc_epoch_seconds', 'last_updated_sequence_number', 'job_resource_usage',
+    'job_lock_wait_seconds', 'job_last_heartbeat_utc_epoch_seconds', 'job_start_delay_seconds', 'job_scheduling',
+    'add_new_job', 'raw_job_record', 'record', 'update_job_end_time_and_status_code', 'job_end_time',
+    'updated_info', 'append_job_output', 'stream_name', 'sequence_number', 'data', 'raw_length',
+    'retained_as_head', 'get_job_output', 'chunks', 'job_heartbeat', 'heartbeat_time', 'success',
+    'assign_start_delay', 'window_seconds', 'delay_seconds', 'get_recent_jobs', 'recent_jobs',
+    'get_active_jobs', 'active_jobs', 'job_last_heartbeat_age_seconds', 'limit', 'offset', 'ping', 'response',
+    'pong', 'stdout', 'stderr',
+    'user_cpu_seconds', 'system_cpu_seconds', 'max_rss_kb', 'block_input_operations', 'block_output_operations',
+    'voluntary_context_switches', 'involuntary_context_switches', 'process_tree', 'cgroup',
+)
+COMPACT_INTERNED_INDEXES = dict((s, i) for i, s in enumerate(COMPACT_INTERNED_STRINGS))
+
+_TAGGED_SMALL_INT = struct.Struct('!cb')
+_TAGGED_INT = struct.Struct('!cq')
+_TAGGED_FLOAT = struct.Struct('!cd')
+_TAGGED_SIZE = struct.Struct('!cL')
+_TAGGED_INDEX = struct.Struct('!cB')
+_SMALL_INT = struct.Struct('!b')
+_INT = struct.Struct('!q')
+_FLOAT = struct.Struct('!d')
+_SIZE = struct.Struct('!L')
+_INDEX = struct.Struct('!B')
+
+
+def _compact_encode(o, append):
+    if o is None:
+        append(b'N')
+    elif o is True:
+        append(b'T')
+    elif o is False:
+        append(b'F')
+    elif isinstance(o, INTEGER_TYPES):
+        if -128 <= o < 128:
+            append(_TAGGED_SMALL_INT.pack(b'j', o))
+        elif -2 ** 63 <= o < 2 ** 63:
+            append(_TAGGED_INT.pack(b'i', o))
+        else:
+            raw = str(o).encode('ascii')
+            append(_TAGGED_SIZE.pack(b'I', len(raw)))
+            append(raw)
+    elif isinstance(o, float):
+        append(_TAGGED_FLOAT.pack(b'd', o))
+    elif isinstance(o, TEXT_TYPES):
+        index = COMPACT_INTERNED_INDEXES.get(o)
+        if index is not None:
+            append(_TAGGED_INDEX.pack(b'k', index))
+        else:
+            raw = o.encode('utf-8')
+            append(_TAGGED_SIZE.pack(b's', len(raw)))
+            append(raw)
+    elif isinstance(o, BINARY_TYPES):
+        append(_TAGGED_SIZE.pack(b'b', len(o)))
+        append(bytes(o))
+    elif isinstance(o, (list, tuple)):
+        append(_TAGGED_SIZE.pack(b'l', len(o)))
+        for item in o:
+            _compact_encode(item, append)
+    elif isinstance(o, dict):
+        append(_TAGGED_SIZE.pack(b'm', len(o)))
+        for key, value in o.items():
+            _compact_encode(key, append)
+            _compact_encode(value, append)
+    else:
+        raise TypeError("{0!r} can not be encoded by the compact codec".format(o))
+
+
+def _compact_decode(data, offset):
+    tag = data[offset:offset + 1]
+    offset += 1
+    if tag == b'k':
+        return COMPACT_INTERNED_STRINGS[_INDEX.unpack_from(data, offset)[0]], offset + 1
+    elif tag == b's':
+        size, = _SIZE.unpack_from(data, offset)
+        offset += 4
+        return data[offset:offset + size].decode('utf-8'), offset + size
+    elif tag == b'm':
+        size, = _SIZE.unpack_from(data, offset)
+        offset += 4
+        result = {}
+        for _ in range(size):
+            key, offset = _compact_decode(data, offset)
+            result[key], offset = _compact_decode(data, offset)
+        return result, offset
+    elif tag == b'l':
+        size, = _SIZE.unpack_from(data, offset)
+        offset += 4
+        result = []
+        for _ in range(size):
+            item, offset = _compact_decode(data, offset)
+            result.append(item)
+        return result, offset
+    elif tag == b'N':
+        return None, offset
+    elif tag == b'j':
+        return _SMALL_INT.unpack_from(data, offset)[0], offset + 1
+    elif tag == b'd':
+        return _FLOAT.unpack_from(data, offset)[0], offset + 8
+    elif tag == b'i':
+        return _INT.unpack_from(data, offset)[0], offset + 8
+    elif tag == b'T':
+        return True, offset
+    elif tag == b'F':
+        return False, offset
+    elif tag == b'b':
+        size, = _SIZE.unpack_from(data, offset)
+        offset += 4
+        if offset + size > len(data):
+            raise ValueError("Truncated bytes value")
+        return data[offset:offset + size], offset + size
+    elif tag == b'I':
+        size, = _SIZE.unpack_from(data, offset)
+        offset += 4
+        return int(data[offset:offset + size]), offset + size
+    raise ValueError("Unknown compact codec tag {0!r} at offset {1}".format(tag, offset - 1))
+
+
+class CompactCodec(object):
+    """
+    Built-in binary codec for when msgpack is not installed: type tagged values with fixed width struct packed
+    numbers and length prefixed strings, where the field names of the JSON-RPC envelope, the AgentJob record and the
+    agent's methods (COMPACT_INTERNED_STRINGS) are sent as one byte indexes.
+    """
+    name = CODEC_COMPACT
+    magic_byte = b'\x43'
+
+    @classmethod
+    def available(cls):
+        return True
+
+    def encode(self, o):
+        parts = []
+        _compact_encode(o, parts.append)
+        return b''.join(parts)
+
+    def decode(self, raw):
+        data = bytes(raw)
+        try:
+            result, offset = _compact_decode(data, 0)
+        except (struct.error, IndexError) as e:
+            raise ValueError("Malformed compact payload: {0!r}".format(e))
+        if offset != len(data):
+            raise ValueError("Trailing data after compact payload")
+        return result
+
+
+JSON_CODEC = JSONCodec()
+MSGPACK_CODEC = MsgpackCodec()
+COMPACT_CODEC = CompactCodec()
+CODECS = (JSON_CODEC, MSGPACK_CODEC, COMPACT_CODEC)
+CODEC_NAMES = tuple(c.name for c in CODECS) + (CODEC_BINARY,)
+
+
+def get_codec(name):
+    if name == CODEC_BINARY:
+        return MSGPACK_CODEC if MSGPACK_CODEC.available() else COMPACT_CODEC
+    for codec in CODECS:
+        if codec.name == name:
+            if not codec.available():
+                raise ValueError("The {0} RPC codec is not available, is its package installed?".format(name))
+            return codec
+    raise ValueError("Unknown RPC codec: {0}".format(name))
+
+
+def codec_for_magic_byte(magic_byte):
+    """
+    The codec a frame's magic byte names, or None if it names none that is available here.
+    """
+    for codec in CODECS:
+        if codec.magic_byte == magic_byte:
+            return codec if codec.available() else None
+    return None
@@ -0,0 +1,15 @@
+"""
+Deterministic spreading of job start times, shared by the wrapper and the agent.
+"""
+import struct
+
+
+def hashed_start_fraction(host, job_name):
+    """
+    A stable fraction in [0, 1) for the (host, job name) pair, so the same job always starts at the same point of
+    its window while different jobs and hosts are spread evenly across it.
+    """
+    import hashlib
+    digest = hashlib.sha1(u"{0}\0{1}".format(host, job_name).encode('utf-8')).digest()
+    value, = struct.unpack('!Q', digest[:8])
+    return value / float(1 << 64)
@@ -1,29 +1,55 @@
 """
 Common  time related functions, mostly for converting between representations of time.
+
+dateutil is only imported when a string has to be parsed or the local timezone is needed, so that the wrapper,
+which only ever deals in epoch seconds, does not pay for importing it on every start.
 """
 import datetime
-import math
-from dateutil.parser import parse
-from dateutil.tz import tzutc, tzlocal
-from six import integer_types
+import sys
+
+if sys.version_info[0] >= 3:
+    UTC = datetime.timezone.utc
+    NUMERIC_TYPES = (int, float)
+else:
+    class _UTC(datetime.tzinfo):
+        def utcoffset(self, dt):
+            return datetime.timedelta(0)
+
+        def dst(self, dt):
+            return datetime.timedelta(0)
+
+        def tzname(self, dt):
+            return "UTC"
+
+    UTC = _UTC()
+    NUMERIC_TYPES = (int, long, float)  # noqa: F821
+
+UNIX_EPOCH = datetime.datetime(year=1970, month=1, day=1, hour=0, minute=0, tzinfo=UTC)
+
 
-UNIX_EPOCH = datetime.datetime(year=1970, month=1, day=1, hour=0, minute=0, tzinfo=tzutc())
-NUMERIC_TYPES = tuple(list(integer_types) + [float])
+def _tzlocal():
+    from dateutil.tz import tzlocal
+    return tzlocal()
+
+
+def _parse(t):
+    from dateutil.parser import parse
+    return parse(t)
 
 
 def from_any_time_to_utc_seconds(t, offset_naive_ok=True, null_ok=True):
     if null_ok and t is None:
         return t
+    elif isinstance(t, NUMERIC_TYPES):
+        return t
     elif isinstance(t, datetime.datetime):
         if offset_naive_ok and t.tzinfo is None:
-            t = t.replace(tzinfo=tzlocal())
+            t = t.replace(tzinfo=_tzlocal())
         return (t - UNIX_EPOCH).total_seconds()
-    elif isinstance(t, NUMERIC_TYPES):
-        return t
     else:
-        parsed_dt = parse(t)
+        parsed_dt = _parse(t)
         if offset_naive_ok and parsed_dt.tzinfo is None:
-            parsed_dt = parsed_dt.replace(tzinfo=tzlocal())
+            parsed_dt = parsed_dt.replace(tzinfo=_tzlocal())
         return (parsed_dt - UNIX_EPOCH).total_seconds()
 
 
@@ -45,8 +71,8 @@ def from_any_time_to_datetime(t, null_ok=True):
     elif isinstance(t, datetime.datetime):
         return t
     else:
-        return parse(t)
+        return _parse(t)
 
 
 def local_now():
-    return datetime.datetime.now(tz=tzlocal())
\ No newline at end of file
+    return datetime.datetime.now(tz=_tzlocal())
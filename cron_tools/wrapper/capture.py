@@ -0,0 +1,138 @@
+"""
+Captured output handling for the wrapper, moving bytes from the child's pipes into per-job spool files.
+"""
+import os
+import errno
+
+HAS_SPLICE = hasattr(os, 'splice')
+DEFAULT_SPLICE_SIZE = 1024 * 1024
+DEFAULT_BUFFER_SIZE = 256 * 1024
+MAX_MIRRORED_LINE_LENGTH = 64 * 1024
+
+
+def readinto(fd, view):
+    if hasattr(os, 'readv'):
+        return os.readv(fd, [view])
+    data = os.read(fd, len(view))
+    view[:len(data)] = data
+    return len(data)
+
+
+def write_all(fd, view):
+    written = 0
+    while written < len(view):
+        written += os.write(fd, view[written:])
+    return written
+
+
+def spool_file_path(spool_directory, job_uuid, stream_name):
+    return os.path.join(spool_directory, "{0}.{1}".format(job_uuid, stream_name))
+
+
+def open_spool_file(path):
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    return os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o640)
+
+
+class CapturedStream(object):
+    """
+    One captured output stream of the child process (stdout or stderr).
+
+    When the only sink is the spool file the bytes are moved with splice(2) and never enter user space; if logging
+    mirroring or a chunk sink (such as the agent output streamer) is requested, or splice is unavailable, they are
+    read into a preallocated buffer instead.
+    """
+
+    def __init__(self, read_fd, stream_name, spool_fd=None, mirror_logger=None, chunk_sink=None,
+                 buffer_size=DEFAULT_BUFFER_SIZE, splice_size=DEFAULT_SPLICE_SIZE):
+        self.read_fd = read_fd
+        self.stream_name = stream_name
+        self.spool_fd = spool_fd
+        self.mirror_logger = mirror_logger
+        self.chunk_sink = chunk_sink
+        self.splice_size = splice_size
+        self.use_splice = HAS_SPLICE and spool_fd is not None and mirror_logger is None and chunk_sink is None
+        self.buffer_size = buffer_size
+        self._view = None if self.use_splice else memoryview(bytearray(buffer_size))
+        self._partial_line = bytearray()
+        self.bytes_captured = 0
+        self.closed = False
+
+    def fileno(self):
+        return self.read_fd
+
+    def _ensure_buffer(self):
+        if self._view is None:
+            self._view = memoryview(bytearray(self.buffer_size))
+
+    def _splice(self):
+        try:
+            return os.splice(self.read_fd, self.spool_fd, self.splice_size)
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+            # The spool file system does not support splice, fall back to copying through user space.
+            self.use_splice = False
+            self._ensure_buffer()
+            return self._copy()
+
+    def _copy(self):
+        amount = readinto(self.read_fd, self._view)
+        if amount:
+            chunk = self._view[:amount]
+            if self.spool_fd is not None:
+                write_all(self.spool_fd, chunk)
+            if self.mirror_logger is not None:
+                self._mirror(chunk)
+            if self.chunk_sink is not None:
+                self.chunk_sink.write(chunk)
+        return amount
+
+    def _mirror(self, chunk):
+        self._partial_line.extend(chunk)
+        end = self._partial_line.rfind(b'\n')
+        if end == -1:
+            if len(self._partial_line) >= MAX_MIRRORED_LINE_LENGTH:
+                self._emit_lines(self._partial_line)
+                del self._partial_line[:]
+            return
+        self._emit_lines(self._partial_line[:end])
+        del self._partial_line[:end + 1]
+
+    def _emit_lines(self, raw_lines):
+        for line in bytes(raw_lines).decode('utf-8', 'replace').split("\n"):
+            self.mirror_logger.info("CAPTURED ({0}): {1}".format(self.stream_name.upper(), line))
+
+    def pump(self):
+        """
+        Move one chunk of available output to the configured sinks. Returns the number of bytes moved, with zero
+        meaning the child closed its end of the pipe (the stream is closed in that case).
+        """
+        if self.closed:
+            return 0
+        try:
+            amount = self._splice() if self.use_splice else self._copy()
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return None
+            raise
+        if amount:
+            self.bytes_captured += amount
+        else:
+            self.close()
+        return amount
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self._partial_line and self.mirror_logger is not None:
+            self._emit_lines(self._partial_line)
+            del self._partial_line[:]
+        os.close(self.read_fd)
+        if self.spool_fd is not None:
+            os.close(self.spool_fd)
+        if self.chunk_sink is not None:
+            self.chunk_sink.close()
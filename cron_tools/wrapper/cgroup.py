@@ -0,0 +1,153 @@
+"""
+cgroup v2 containment for wrapped jobs, with whole process tree accounting read back from the kernel.
+"""
+import os
+import errno
+import time
+
+JOB_CONTROLLERS = ('cpu', 'memory', 'io', 'pids')
+
+
+class CgroupUnavailable(Exception):
+    pass
+
+
+def read_cgroup_file(path):
+    with open(path, 'r') as f:
+        return f.read()
+
+
+def write_cgroup_file(path, value):
+    with open(path, 'w') as f:
+        f.write(str(value))
+
+
+def parse_flat_keyed(content):
+    result = {}
+    for line in content.splitlines():
+        parts = line.split()
+        if len(parts) == 2:
+            result[parts[0]] = int(parts[1])
+    return result
+
+
+def parse_nested_keyed_totals(content):
+    totals = {}
+    for line in content.splitlines():
+        for pair in line.split()[1:]:
+            key, _, value = pair.partition('=')
+            if value.isdigit():
+                totals[key] = totals.get(key, 0) + int(value)
+    return totals
+
+
+class JobCgroup(object):
+    """
+    A transient cgroup for a single job, created under a delegated cgroup v2 subtree and removed when the job ends.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.limit_errors = {}
+
+    @classmethod
+    def create(cls, parent_path, name, limits=None):
+        parent_procs = os.path.join(parent_path, 'cgroup.procs')
+        if not os.path.exists(parent_procs):
+            raise CgroupUnavailable("{0} is not a cgroup v2 directory.".format(parent_path))
+        cls.enable_controllers(parent_path)
+        path = os.path.join(parent_path, name)
+        try:
+            os.mkdir(path)
+        except OSError as e:
+            raise CgroupUnavailable("Unable to create cgroup {0}: {1}".format(path, e))
+        job_cgroup = cls(path)
+        if not os.access(os.path.join(path, 'cgroup.procs'), os.W_OK):
+            job_cgroup.remove()
+            raise CgroupUnavailable("Unable to place processes into {0}.".format(path))
+        job_cgroup.apply_limits(limits or {})
+        return job_cgroup
+
+    @staticmethod
+    def enable_controllers(parent_path):
+        try:
+            available = read_cgroup_file(os.path.join(parent_path, 'cgroup.controllers')).split()
+            enabled = read_cgroup_file(os.path.join(parent_path, 'cgroup.subtree_control')).split()
+        except (IOError, OSError):
+            return
+        missing = [c for c in JOB_CONTROLLERS if c in available and c not in enabled]
+        if missing:
+            try:
+                write_cgroup_file(
+                    os.path.join(parent_path, 'cgroup.subtree_control'), " ".join("+" + c for c in missing)
+                )
+            except (IOError, OSError):
+                # Accounting for these controllers will simply be missing from the report.
+                pass
+
+    def apply_limits(self, limits):
+        for name, value in sorted(limits.items()):
+            try:
+                write_cgroup_file(os.path.join(self.path, name), value)
+            except (IOError, OSError) as e:
+                self.limit_errors[name] = str(e)
+
+    def add_process(self, pid):
+        write_cgroup_file(os.path.join(self.path, 'cgroup.procs'), pid)
+
+    def preexec(self):
+        """
+        Runs in the forked child before exec, moving it (pid 0 means the writer) into the job cgroup.
+        """
+        self.add_process(0)
+
+    def _read(self, name, parser):
+        try:
+            return parser(read_cgroup_file(os.path.join(self.path, name)))
+        except (IOError, OSError, ValueError):
+            return None
+
+    def read_usage(self):
+        usage = {}
+        cpu_stat = self._read('cpu.stat', parse_flat_keyed)
+        if cpu_stat:
+            for key in ('usage_usec', 'user_usec', 'system_usec'):
+                if key in cpu_stat:
+                    usage['cpu_' + key.replace('_usec', '_seconds')] = cpu_stat[key] / 1000000.0
+            for key in ('nr_throttled', 'throttled_usec'):
+                if key in cpu_stat:
+                    usage['cpu_' + key] = cpu_stat[key]
+        memory_peak = self._read('memory.peak', int)
+        if memory_peak is not None:
+            usage['memory_peak_bytes'] = memory_peak
+        io_stat = self._read('io.stat', parse_nested_keyed_totals)
+        if io_stat:
+            for key in ('rbytes', 'wbytes', 'rios', 'wios'):
+                usage['io_' + key] = io_stat.get(key, 0)
+        pids_peak = self._read('pids.peak', int)
+        if pids_peak is not None:
+            usage['pids_peak'] = pids_peak
+        return usage
+
+    def populated(self):
+        events = self._read('cgroup.events', parse_flat_keyed)
+        return bool(events and events.get('populated'))
+
+    def kill(self, timeout=1.0):
+        try:
+            write_cgroup_file(os.path.join(self.path, 'cgroup.kill'), 1)
+        except (IOError, OSError):
+            return False
+        deadline = time.time() + timeout
+        while self.populated() and time.time() < deadline:
+            time.sleep(0.01)
+        return True
+
+    def remove(self):
+        try:
+            os.rmdir(self.path)
+        except OSError as e:
+            if e.errno in (errno.EBUSY, errno.ENOTEMPTY):
+                return False
+            raise
+        return True
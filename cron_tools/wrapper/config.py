@@ -1,20 +1,79 @@
-import json
-from logging import config as logging_config_module
+import logging
+import sys
 
 from cron_tools.common.config import JSONSourcedConfiguration
 
 
+def configure_logging(logging_config, default_logging_config):
+    """
+    Apply the wrapper logging configuration. The default configuration is set up directly, to the same effect as
+    logging.config.dictConfig(), so that logging.config (and everything it imports) is only loaded when a
+    configuration file asks for something else.
+    """
+    if logging_config != default_logging_config:
+        from logging import config as logging_config_module
+        logging_config_module.dictConfig(logging_config)
+        return
+    formatter_config = default_logging_config['formatters']['detailed']
+    handler_config = default_logging_config['handlers']['stderr']
+    root_logger = logging.getLogger()
+    for handler in root_logger.handlers[:]:
+        root_logger.removeHandler(handler)
+        handler.close()
+    handler = logging.StreamHandler(sys.stderr)
+    handler.name = 'stderr'
+    handler.setFormatter(logging.Formatter(formatter_config['format']))
+    handler.setLevel(handler_config['level'])
+    root_logger.addHandler(handler)
+    root_logger.setLevel(default_logging_config['root']['level'])
+
+
 class WrapperConfiguration(JSONSourcedConfiguration):
     DEFAULT_LISTEN_SOCKET_PATH = "/var/run/cron-tools/agent.sock"
+    DEFAULT_OUTPUT_SPOOL_DIRECTORY = "/var/lib/cron-tools/output"
+    DEFAULT_JOURNAL_PATH = "/var/lib/cron-tools/journal"
+    DEFAULT_CGROUP_PARENT_PATH = "/sys/fs/cgroup/cron-tools"
 
     REQUIRED_PARAMETERS = []
     OPTIONAL_PARAMETERS = {
         'agent_socket_path': DEFAULT_LISTEN_SOCKET_PATH,
+        'agent_report_mode': 'call',
+        'agent_send_timeout_seconds': 0.5,
+        'agent_rpc_codec': 'json',
+        'agent_transport': 'stream',
+        'agent_seqpacket_socket_path': None,
+        'agent_datagram_socket_path': None,
+        'journal_path': DEFAULT_JOURNAL_PATH,
+        'journal_fsync': 'always',
+        'journal_fallback': True,
+        'heartbeat_interval_seconds': 300,
+        'stagger_window_seconds': None,
+        'stagger_mode': 'hash',
+        'pressure_thresholds': {
+            'memory_some_avg10': 10.0,
+            'io_some_avg10': 20.0,
+            'loadavg_per_cpu': 2.0
+        },
+        'pressure_max_delay_seconds': 600,
+        'pressure_poll_interval_seconds': 10,
+        'pressure_action': 'run',
+        'low_priority_tags': [],
+        'priority_tags': {},
+        'output_spool_directory': DEFAULT_OUTPUT_SPOOL_DIRECTORY,
+        'output_stream_flush_bytes': 256 * 1024,
+        'output_stream_flush_interval_seconds': 1.0,
+        'output_stream_compression_level': 1,
+        'resource_sampling_interval_seconds': None,
+        'cgroup_parent_path': DEFAULT_CGROUP_PARENT_PATH,
+        'cgroup_limits': {},
+        'cgroup_kill_on_exit': False,
         'logging_config': {
             'version': 1,
+            # The wrapper's module loggers exist by the time the configuration is applied.
+            'disable_existing_loggers': False,
             'formatters': {
                 'detailed': {
-                    'fmt': '%(asctime)s %(levelname)-3s [%(module)s:%(lineno)d] %(message)s'
+                    'format': '%(asctime)s %(levelname)-3s [%(module)s:%(lineno)d] %(message)s'
                 }
             },
             'handlers': {
@@ -26,7 +85,7 @@ class WrapperConfiguration(JSONSourcedConfiguration):
                 }
             },
             'root': {
-                'handler': 'stderr',
+                'handlers': ['stderr'],
                 'level': 'WARNING'
             }
         }
@@ -35,7 +94,7 @@ class WrapperConfiguration(JSONSourcedConfiguration):
     def __init__(self, logging_config=OPTIONAL_PARAMETERS['logging_config'], **kwargs):
         super(WrapperConfiguration, self).__init__(**kwargs)
         self.logging_config = logging_config
-        logging_config_module.dictConfig(logging_config)
+        configure_logging(logging_config, self.OPTIONAL_PARAMETERS['logging_config'])
 
     @classmethod
     def default(cls):
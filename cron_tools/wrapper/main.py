@@ -1,12 +1,9 @@
 import argparse
-import subprocess
-import select
-import signal
+import collections
+import fcntl
 import sys
-import signalfd
 import os
-import getpass
-import uuid
+import re
 import socket
 import time
 import logging
@@ -14,9 +11,16 @@ from threading import Lock as NullLock
 
 
 from cron_tools.wrapper.config import WrapperConfiguration
-from cron_tools.common.models import AgentJob
-from cron_tools.common.flock import FlockLock
-from cron_tools.common.rpc_client import RPCClient
+from cron_tools.wrapper.supervisor import create_child_supervisor
+from cron_tools.wrapper.runner import JobRun, SPAWN_FAILED_STATUS_CODE, LOCK_TIMEOUT_STATUS_CODE
+from cron_tools.wrapper.stagger import choose_start_delay, STAGGER_MODES
+from cron_tools.wrapper.pressure import wait_for_pressure_relief, priority_settings, apply_priority, \
+    PRESSURE_ACTIONS, DECISION_SKIPPED, SKIPPED_STATUS_CODE
+from cron_tools.wrapper.reporting import AgentReporter, REPORT_MODE_NOTIFY, REPORT_MODE_JOURNAL, REPORT_MODES, \
+    TRANSPORT_SEQPACKET, TRANSPORT_DATAGRAM
+from cron_tools.common.journal import EventJournal
+from cron_tools.common.models import generate_job_uuid
+from cron_tools.common.flock import FlockLock, FlockTimeout
 
 wrapper_argument_parser = argparse.ArgumentParser()
 wrapper_argument_parser.add_argument(
@@ -26,139 +30,292 @@ wrapper_argument_parser.add_argument(
     "-L", "--lock-file", type=str, default=None, help="The file to flock to prevent other jobs from running."
 )
 wrapper_argument_parser.add_argument(
-    "-Lt", "--lock-file-timeout", type=int, default=120,
-    help="The timeout (in seconds) to wait for the lock file to clear, if used."
+    "-Lt", "--lock-file-timeout", type=float, default=120,
+    help="The timeout (in seconds, fractions allowed) to wait for the lock file to clear, if used."
+)
+wrapper_argument_parser.add_argument(
+    "-Ls", "--lock-shared", action="store_true",
+    help="Take a shared instead of an exclusive lock on the lock file, if used."
 )
 wrapper_argument_parser.add_argument(
     "-t", "--tag", type=str, nargs="+", default=None, help="Tags for the job."
 )
 wrapper_argument_parser.add_argument(
-    "--capture-stdout", action="store_true", help="Capture stdout and log to the configured facility."
+    "--capture-stdout", action="store_true", help="Capture stdout into the per-job output spool file."
+)
+wrapper_argument_parser.add_argument(
+    "--capture-stderr", action="store_true", help="Capture stderr into the per-job output spool file."
+)
+wrapper_argument_parser.add_argument(
+    "--mirror-captured-output", action="store_true",
+    help="Also log captured output line by line to the configured logging facility."
+)
+wrapper_argument_parser.add_argument(
+    "--stream-output", action="store_true",
+    help="Also stream captured output to the agent in compressed chunks."
+)
+wrapper_argument_parser.add_argument(
+    "--no-output-spool", action="store_true",
+    help="Do not write captured output to the local output spool files."
+)
+wrapper_argument_parser.add_argument(
+    "--sample-resources", type=float, default=None, metavar="SECONDS",
+    help="Sample the job's process tree resource usage from /proc at this interval."
+)
+wrapper_argument_parser.add_argument(
+    "--heartbeat-interval", type=float, default=None, metavar="SECONDS",
+    help="Send the agent a heartbeat at this interval while the job runs, zero to disable."
+)
+wrapper_argument_parser.add_argument(
+    "--stagger", type=float, default=None, metavar="WINDOW",
+    help="Delay the job's start by a per host and job name offset within this many seconds, zero to disable."
+)
+wrapper_argument_parser.add_argument(
+    "--stagger-mode", choices=STAGGER_MODES, default=None,
+    help="Derive the stagger offset from a hash (the default) or have the agent assign an evenly spread slot."
+)
+wrapper_argument_parser.add_argument(
+    "--low-priority", action="store_true",
+    help="Hold the job back while host pressure is over the configured thresholds (see also low_priority_tags)."
+)
+wrapper_argument_parser.add_argument(
+    "--pressure-max-delay", type=float, default=None, metavar="SECONDS",
+    help="The longest a low priority job is held back by host pressure."
+)
+wrapper_argument_parser.add_argument(
+    "--pressure-action", choices=PRESSURE_ACTIONS, default=None,
+    help="Whether a low priority job still runs or is skipped when the pressure has not eased within the delay."
+)
+wrapper_argument_parser.add_argument(
+    "--nice", type=int, default=None, help="Run the job with this nice value."
+)
+wrapper_argument_parser.add_argument(
+    "--ioprio", type=str, default=None, metavar="CLASS[:LEVEL]",
+    help="Run the job with this I/O priority, e.g. idle, best-effort:7 or realtime:0."
+)
+wrapper_argument_parser.add_argument(
+    "--sched-batch", action="store_true", help="Run the job under the SCHED_BATCH scheduling policy."
+)
+wrapper_argument_parser.add_argument(
+    "--cgroup", action="store_true",
+    help="Run the job in its own cgroup v2 under the configured delegated subtree and report its usage."
+)
+wrapper_argument_parser.add_argument(
+    "--notify-agent", action="store_const", dest="report_mode", const=REPORT_MODE_NOTIFY,
+    help="Send job events to the agent as notifications without waiting for its responses."
 )
 wrapper_argument_parser.add_argument(
-    "--capture-stderr", action="store_true", help="Capture stderr and log to the configured facility."
+    "--report-mode", choices=REPORT_MODES, default=None,
+    help="How job events reach the agent, overriding the agent_report_mode configuration."
 )
 wrapper_argument_parser.add_argument(
     "-f", "--config-file", type=str, default=None, help="The JSON configuration file for the wrapper script."
 )
 wrapper_argument_parser.add_argument(
-    "wrapped_executable", type=str, nargs="+", help="The wrapped executable and its arguments."
+    "--no-config-cache", action="store_true",
+    help="Always parse and validate the configuration file instead of using the cached copy."
+)
+wrapper_argument_parser.add_argument(
+    "--run-parts", type=str, default=None, metavar="DIR",
+    help="Run every executable in DIR (run-parts style) as its own job instead of a single wrapped executable."
+)
+wrapper_argument_parser.add_argument(
+    "--parallel", type=int, default=1, metavar="N", help="Run up to this many of the --run-parts jobs at once."
+)
+wrapper_argument_parser.add_argument(
+    "wrapped_executable", type=str, nargs="*", help="The wrapped executable and its arguments."
 )
 
 
 wrapper_logger = logging.getLogger(__name__)
 
+# run-parts(8) only runs files whose names consist of these characters, which skips editor backups and the like.
+RUN_PARTS_NAME = re.compile(r'^[a-zA-Z0-9_-]+$')
+BATCH_TAG_PREFIX = "batch:"
+
+
+def run_parts_scripts(directory):
+    scripts = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if RUN_PARTS_NAME.match(name) and os.path.isfile(path) and os.access(path, os.X_OK):
+            scripts.append(path)
+    return scripts
+
 
-def read_at_most(fd, at_most_bytes, increment=8192):
-    data_read = bytearray()
-    delta = True
-    remaining = at_most_bytes
-    while delta and remaining > 0:
-        delta = os.read(fd, min(remaining, increment))
-        data_read.extend(delta)
-    return data_read
+def config_cache_directory():
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'cron-tools')
+
+
+def run_single_job(reporter, config, args, job_name, job_host, supervisor, lock, **kwargs):
+    job_run = JobRun(reporter, config, args, args.wrapped_executable, job_name, job_host, tags=args.tag)
+    # The job's pipes, spool files and cgroup are only set up once the lock is held, so a lock timeout leaves none
+    # of them behind.
+    with lock:
+        try:
+            job_run.setup()
+            job_run.start(supervisor, lock_wait_seconds=getattr(lock, 'wait_time', None), **kwargs)
+            supervisor.run()
+        finally:
+            supervisor.close()
+            job_run.close()
+    return job_run.status_code
+
+
+def run_batch(reporter, config, args, job_runs, supervisor, lock, **kwargs):
+    """
+    Run the jobs with at most args.parallel of them at once, starting the next pending job whenever one finishes.
+    All of them share the supervisor's event loop and the reporter's agent connection. A job that can not be
+    spawned is reported as failed and the rest of the batch carries on.
+    """
+    pending = collections.deque(job_runs)
+    running = set()
+
+    def start_next(finished_run=None):
+        running.discard(finished_run)
+        while pending and len(running) < args.parallel:
+            job_run = pending.popleft()
+            job_run.setup()
+            try:
+                job_run.start(supervisor, **kwargs)
+            except (IOError, OSError) as e:
+                wrapper_logger.error("Unable to start {0}: {1}".format(job_run.job_name, e))
+                job_run.close()
+                job_run.report_not_run(SPAWN_FAILED_STATUS_CODE, **kwargs)
+            else:
+                running.add(job_run)
+
+    for job_run in job_runs:
+        job_run.on_finished = start_next
+    with lock:
+        kwargs['lock_wait_seconds'] = getattr(lock, 'wait_time', None)
+        try:
+            start_next()
+            supervisor.run()
+        finally:
+            supervisor.close()
+            for job_run in job_runs:
+                job_run.close()
+    return 0 if all(job_run.status_code == 0 for job_run in job_runs) else 1
 
 
 def main(args=None, config=None):
     args = args or wrapper_argument_parser.parse_args()
+    if bool(args.run_parts) == bool(args.wrapped_executable):
+        wrapper_argument_parser.error("either a wrapped executable or --run-parts DIR is required, but not both")
+    if args.parallel < 1:
+        wrapper_argument_parser.error("--parallel must be at least 1")
     if config is not None:
         pass
-    elif args.config_file:
+    elif args.config_file and args.no_config_cache:
         config = WrapperConfiguration.from_file(args.config_file)
+    elif args.config_file:
+        config = WrapperConfiguration.from_file_cached(args.config_file, config_cache_directory())
     else:
         config = WrapperConfiguration.default()
 
-    try:
-        rpc_client = RPCClient(config.agent_socket_path)
-        rpc_client.connect()
-    except Exception:
-        wrapper_logger.warning("Unable to connect to agent!")
-        rpc_client = None
-    read_fds = []
-    sigchld_fd = signalfd.signalfd(-1, [signal.SIGCLD, signal.SIGCHLD], signalfd.SFD_CLOEXEC)
-    signalfd.sigprocmask(signalfd.SIG_BLOCK, [signal.SIGCLD, signal.SIGCHLD])
-    read_fds.append(sigchld_fd)
-
-    if args.capture_stdout:
-        stdout_read, stdout_write = os.pipe()
-        read_fds.append(stdout_read)
+    report_mode = args.report_mode or config.agent_report_mode
+    if config.journal_fallback or report_mode == REPORT_MODE_JOURNAL:
+        journal = EventJournal(config.journal_path, config.journal_fsync)
     else:
-        stdout_read = stdout_write = None
-
-    if args.capture_stderr:
-        stderr_read, stderr_write = os.pipe()
-        read_fds.append(stderr_read)
+        journal = None
+    reporter = AgentReporter(
+        config.agent_socket_path,
+        mode=report_mode,
+        send_timeout=config.agent_send_timeout_seconds,
+        journal=journal,
+        codec=config.agent_rpc_codec,
+        transport=config.agent_transport,
+        message_socket_path={
+            TRANSPORT_SEQPACKET: config.agent_seqpacket_socket_path,
+            TRANSPORT_DATAGRAM: config.agent_datagram_socket_path
+        }.get(config.agent_transport)
+    )
+    reporter.connect()
+    job_host = socket.gethostname()
+    if args.run_parts:
+        job_name = args.job_name or os.path.basename(os.path.normpath(args.run_parts))
+        batch_tags = (args.tag or []) + [BATCH_TAG_PREFIX + generate_job_uuid()]
+        job_runs = [
+            JobRun(
+                reporter, config, args, [script], "{0}/{1}".format(job_name, os.path.basename(script)), job_host,
+                tags=batch_tags
+            )
+            for script in run_parts_scripts(args.run_parts)
+        ]
     else:
-        stderr_read = stderr_write = None
+        job_name = args.job_name or args.wrapped_executable[0]
+        job_runs = None
 
-    end_time = None
-    if args.lock_file is not None:
-        lock_constructor = lambda: FlockLock.from_file(args.lock_file, args.lock_file_timeout)
-    else:
-        lock_constructor = NullLock
-    
-    with lock_constructor():
-        start_time = time.time()
-        process = subprocess.Popen(
-            args.wrapped_executable, stdout=stdout_write, stderr=stdout_write
+    stagger_window = args.stagger
+    if stagger_window is None:
+        stagger_window = config.stagger_window_seconds
+    start_delay = None
+    if stagger_window:
+        start_delay = choose_start_delay(
+            reporter, job_host, job_name, stagger_window, args.stagger_mode or config.stagger_mode
         )
-        if stdout_write is not None:
-            os.close(stdout_write)
-        if stderr_write is not None:
-            os.close(stderr_write)
-
-        job = AgentJob(
-            job_id=None,
-            uuid=str(uuid.uuid4()),
-            name=args.job_name or args.wrapped_executable[0],
-            args=args.wrapped_executable,
-            user=getpass.getuser(),
-            host=socket.gethostname(),
-            tags=args.tag,
-            status_code=None,
-            start_time=start_time,
-            end_time=None,
-            created_time=None,
-            last_updated_time=None,
-            last_updated_sequence_number=None
+        time.sleep(start_delay)
+
+    scheduling = None
+    if args.low_priority or set(args.tag or ()) & set(config.low_priority_tags):
+        deferral = wait_for_pressure_relief(
+            config.pressure_thresholds,
+            args.pressure_max_delay if args.pressure_max_delay is not None else config.pressure_max_delay_seconds,
+            config.pressure_poll_interval_seconds,
+            args.pressure_action or config.pressure_action
         )
+        scheduling = {'deferral': deferral}
+        if deferral['decision'] == DECISION_SKIPPED:
+            wrapper_logger.warning("Skipping low priority job {0}, host pressure over thresholds: {1}".format(
+                job_name, ", ".join(deferral['still_exceeded'])
+            ))
+            for job_run in job_runs or [JobRun(reporter, config, args, args.wrapped_executable, job_name, job_host,
+                                               tags=args.tag)]:
+                job_run.report_not_run(SKIPPED_STATUS_CODE, start_delay_seconds=start_delay, scheduling=scheduling)
+            reporter.close()
+            sys.exit(SKIPPED_STATUS_CODE)
 
-        if rpc_client:
-            rpc_client.handle_rpc_call(
-                "add_new_job", {'raw_job_record': job.serialize()}
-            )
+    priority = priority_settings(args.tag, config.priority_tags, args.nice, args.ioprio, args.sched_batch)
+    if priority:
+        applied, errors = apply_priority(priority.get('nice'), priority.get('ioprio'), priority.get('sched_batch'))
+        for name, error in sorted(errors.items()):
+            wrapper_logger.warning("Unable to apply {0} to the job: {1}".format(name, error))
+        scheduling = scheduling or {}
+        scheduling['priority'] = applied
 
-        status_code = process.poll()
-        current_read = True
-        while status_code is None or current_read:
-            current_read, _, _ = select.select(read_fds, [], [], 1.0 if status_code is None else 0)
-            for read_fd in current_read:
-                if read_fd == sigchld_fd and end_time is None:
-                    end_time = time.time()
-                if stdout_read is not None and read_fd == stdout_read:
-                    raw_read_stdout = read_at_most(stdout_read, 1024*64)
-                    read_stdout = raw_read_stdout.decode('utf-8', 'replace')
-                    for line in read_stdout.split("\n"):
-                        wrapper_logger.info("CAPTURED (STDOUT): {0}".format(line))
-                if stderr_read is not None and read_fd == stderr_read:
-                    raw_read_stderr = read_at_most(stderr_read, 1024 * 64)
-                    read_stderr = raw_read_stderr.decode('utf-8', 'replace')
-                    for line in read_stderr.split("\n"):
-                        wrapper_logger.info("CAPTURED (STDERR): {0}".format(line))
-            status_code = process.poll()
-
-        if rpc_client:
-            rpc_client.handle_rpc_call(
-                "update_job_end_time_and_status_code",
-                {
-                    'job_uuid': job.uuid,
-                    'job_end_time': end_time,
-                    'job_status_code': status_code
-                }
+    supervisor = create_child_supervisor()
+    supervisor.prepare()
+    if args.lock_file is not None:
+        lock = FlockLock.from_file(
+            args.lock_file, args.lock_file_timeout, fcntl.LOCK_SH if args.lock_shared else fcntl.LOCK_EX
+        )
+    else:
+        lock = NullLock()
+
+    try:
+        if job_runs is None:
+            status_code = run_single_job(
+                reporter, config, args, job_name, job_host, supervisor, lock,
+                start_delay_seconds=start_delay, scheduling=scheduling
             )
-        try:
-            if rpc_client:
-                rpc_client.disconnect()
-        except BaseException:
-            wrapper_logger.warning("Unable to close agent RPC connection!")
-        sys.exit(status_code)
+        else:
+            status_code = run_batch(
+                reporter, config, args, job_runs, supervisor, lock, start_delay_seconds=start_delay,
+                scheduling=scheduling
+            )
+    except FlockTimeout:
+        wrapper_logger.error("Not running {0}, timed out after {1:.3f}s waiting for the lock file {2}".format(
+            job_name, lock.wait_time, args.lock_file
+        ))
+        supervisor.close()
+        for job_run in job_runs or [JobRun(reporter, config, args, args.wrapped_executable, job_name, job_host,
+                                           tags=args.tag)]:
+            job_run.report_not_run(
+                LOCK_TIMEOUT_STATUS_CODE, lock_wait_seconds=lock.wait_time, start_delay_seconds=start_delay,
+                scheduling=scheduling
+            )
+        status_code = LOCK_TIMEOUT_STATUS_CODE
+    reporter.close()
+    sys.exit(status_code)
@@ -0,0 +1,188 @@
+"""
+Host pressure checks and priority shaping for wrapped jobs.
+
+Low priority jobs are held back while Linux pressure stall information (/proc/pressure) or the load average is over
+its configured threshold, for at most a bounded delay, after which they either run anyway or are skipped. The nice
+value, I/O priority and SCHED_BATCH policy are applied to the wrapper itself before the child is started, so the child
+inherits them without needing any code to run between fork and exec.
+"""
+import os
+import errno
+import time
+
+cpu_count = getattr(os, 'cpu_count', lambda: None)
+
+PRESSURE_RESOURCES = ('cpu', 'memory', 'io')
+
+PRESSURE_ACTION_RUN = 'run'
+PRESSURE_ACTION_SKIP = 'skip'
+PRESSURE_ACTIONS = (PRESSURE_ACTION_RUN, PRESSURE_ACTION_SKIP)
+
+DECISION_RAN = 'ran'
+DECISION_DEFERRED = 'deferred'
+DECISION_SKIPPED = 'skipped'
+
+# sysexits.h EX_TEMPFAIL, used as the job status (and wrapper exit code) of a skipped job.
+SKIPPED_STATUS_CODE = 75
+
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_CLASSES = {
+    'realtime': 1, 'rt': 1,
+    'best-effort': 2, 'be': 2,
+    'idle': 3
+}
+IOPRIO_SET_SYSCALL_NUMBERS = {
+    'x86_64': 251,
+    'i386': 289,
+    'i686': 289,
+    'aarch64': 30,
+    'armv7l': 314,
+    'ppc64le': 273,
+    's390x': 282
+}
+
+
+def read_pressure(resource, proc_root='/proc'):
+    """
+    Returns e.g. {'some_avg10': 1.5, 'full_avg10': 0.0, ...} for one of /proc/pressure/{cpu,memory,io}.
+    """
+    values = {}
+    with open(os.path.join(proc_root, 'pressure', resource), 'rb') as f:
+        for line in f:
+            fields = line.split()
+            for field in fields[1:]:
+                name, _, value = field.partition(b'=')
+                if name != b'total':
+                    values["{0}_{1}".format(fields[0].decode('ascii'), name.decode('ascii'))] = float(value)
+    return values
+
+
+def read_loadavg(proc_root='/proc'):
+    with open(os.path.join(proc_root, 'loadavg'), 'rb') as f:
+        return float(f.read().split()[0])
+
+
+def host_pressure(proc_root='/proc'):
+    """
+    A flat snapshot such as {'memory_some_avg10': 3.2, 'io_full_avg60': 0.1, 'loadavg_per_cpu': 0.5, ...}. Pressure
+    files missing on older kernels are simply left out.
+    """
+    snapshot = {}
+    for resource in PRESSURE_RESOURCES:
+        try:
+            for name, value in read_pressure(resource, proc_root).items():
+                snapshot["{0}_{1}".format(resource, name)] = value
+        except (IOError, OSError):
+            pass
+    try:
+        snapshot['loadavg_1m'] = read_loadavg(proc_root)
+        snapshot['loadavg_per_cpu'] = snapshot['loadavg_1m'] / (cpu_count() or 1)
+    except (IOError, OSError):
+        pass
+    return snapshot
+
+
+def exceeded_thresholds(snapshot, thresholds):
+    return sorted(name for name, limit in thresholds.items() if snapshot.get(name, 0) > limit)
+
+
+def wait_for_pressure_relief(thresholds, max_delay, poll_interval, action=PRESSURE_ACTION_RUN, proc_root='/proc'):
+    """
+    Polls the host pressure until every threshold is met or max_delay seconds have passed. Returns the decision
+    record reported to the agent: whether the job ran at once, ran after being deferred or is to be skipped, how
+    long it waited, which thresholds were exceeded and the last pressure snapshot.
+    """
+    started = time.time()
+    snapshot = host_pressure(proc_root)
+    exceeded = exceeded_thresholds(snapshot, thresholds)
+    first_exceeded = exceeded
+    while exceeded:
+        remaining = started + max_delay - time.time()
+        if remaining <= 0:
+            break
+        time.sleep(min(poll_interval, remaining))
+        snapshot = host_pressure(proc_root)
+        exceeded = exceeded_thresholds(snapshot, thresholds)
+
+    if not first_exceeded:
+        decision = DECISION_RAN
+    elif exceeded and action == PRESSURE_ACTION_SKIP:
+        decision = DECISION_SKIPPED
+    else:
+        decision = DECISION_DEFERRED
+    return {
+        'decision': decision,
+        'wait_seconds': time.time() - started,
+        'exceeded': first_exceeded,
+        'still_exceeded': exceeded,
+        'pressure': snapshot
+    }
+
+
+def parse_ioprio(value):
+    """
+    Parses "idle", "best-effort:7", "be:4" or "rt:0" into an ioprio_set(2) value.
+    """
+    class_name, _, level = value.partition(':')
+    if class_name not in IOPRIO_CLASSES:
+        raise ValueError("Unknown I/O priority class: {0}".format(class_name))
+    level = int(level) if level else (0 if class_name == 'idle' else 4)
+    if not 0 <= level <= 7:
+        raise ValueError("I/O priority level must be between 0 and 7, was {0}".format(level))
+    return (IOPRIO_CLASSES[class_name] << IOPRIO_CLASS_SHIFT) | level
+
+
+def set_ioprio(ioprio):
+    syscall_number = IOPRIO_SET_SYSCALL_NUMBERS.get(os.uname()[4])
+    if syscall_number is None:
+        raise OSError(errno.ENOSYS, "ioprio_set is not known on this architecture")
+    import ctypes
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.syscall(syscall_number, IOPRIO_WHO_PROCESS, 0, ioprio) != 0:
+        error = ctypes.get_errno()
+        raise OSError(error, os.strerror(error))
+
+
+def apply_priority(nice=None, ioprio=None, sched_batch=False):
+    """
+    Applies the requested priorities to the current process and returns the ones that took effect together with the
+    errors of those that did not; a job is never kept from running because its priority could not be lowered.
+    """
+    applied = {}
+    errors = {}
+    if nice is not None:
+        try:
+            os.setpriority(os.PRIO_PROCESS, 0, nice)
+            applied['nice'] = nice
+        except (AttributeError, OSError) as e:
+            errors['nice'] = str(e)
+    if ioprio is not None:
+        try:
+            set_ioprio(parse_ioprio(ioprio))
+            applied['ioprio'] = ioprio
+        except (ValueError, OSError) as e:
+            errors['ioprio'] = str(e)
+    if sched_batch:
+        try:
+            os.sched_setscheduler(0, os.SCHED_BATCH, os.sched_param(0))
+            applied['sched_batch'] = True
+        except (AttributeError, OSError) as e:
+            errors['sched_batch'] = str(e)
+    return applied, errors
+
+
+def priority_settings(tags, priority_tags, nice=None, ioprio=None, sched_batch=False):
+    """
+    Merges the priority settings of the job's tags (in tag order) with the command line flags, which win.
+    """
+    settings = {}
+    for tag in tags or ():
+        settings.update(priority_tags.get(tag, {}))
+    if nice is not None:
+        settings['nice'] = nice
+    if ioprio is not None:
+        settings['ioprio'] = ioprio
+    if sched_batch:
+        settings['sched_batch'] = True
+    return settings
@@ -0,0 +1,204 @@
+"""
+Reporting of job events from the wrapper to the agent.
+"""
+import logging
+import time
+
+from cron_tools.common.rpc import RPCException
+from cron_tools.common.rpc_client import RPCClient, SeqpacketRPCClient, DatagramRPCClient, RPCMessageTooLarge
+from cron_tools.common.rpc_codecs import CODEC_JSON
+
+REPORT_MODE_CALL = 'call'
+REPORT_MODE_NOTIFY = 'notify'
+REPORT_MODE_JOURNAL = 'journal'
+REPORT_MODES = (REPORT_MODE_CALL, REPORT_MODE_NOTIFY, REPORT_MODE_JOURNAL)
+
+TRANSPORT_STREAM = 'stream'
+TRANSPORT_SEQPACKET = 'seqpacket'
+TRANSPORT_DATAGRAM = 'datagram'
+TRANSPORTS = (TRANSPORT_STREAM, TRANSPORT_SEQPACKET, TRANSPORT_DATAGRAM)
+
+monotonic = getattr(time, 'monotonic', time.time)
+
+reporting_logger = logging.getLogger(__name__)
+
+
+class AgentReporter(object):
+    """
+    Sends job events to the agent. In "call" mode every event waits for the agent's response; in "notify" mode
+    events are sent as JSON-RPC notifications bounded by send_timeout, so a slow agent never delays the job; in
+    "journal" mode events are only appended to the local journal for the agent to ingest later.
+
+    When the agent cannot be reached, events fall back to the journal (if one is given). Once an event for the job
+    has gone to the journal all later ones follow it there, so the agent always sees them in order.
+    Captured output chunks are never journaled, they are only worth keeping while the agent is around to take them.
+    A failure to report is logged and never interrupts the wrapped job.
+
+    Events go over the agent's stream socket (socket_path) unless transport says otherwise. With "seqpacket" they
+    are single messages on a SOCK_SEQPACKET connection to message_socket_path; with "datagram", which requires the
+    notify mode, they are SOCK_DGRAM notifications to message_socket_path. Either way events too large for a
+    message, and with datagrams the calls that need an answer, still use the stream socket.
+    """
+
+    def __init__(self, socket_path, mode=REPORT_MODE_CALL, send_timeout=None, journal=None, codec=CODEC_JSON,
+                 transport=TRANSPORT_STREAM, message_socket_path=None):
+        if mode not in REPORT_MODES:
+            raise ValueError("Unknown agent report mode: {0}".format(mode))
+        if transport not in TRANSPORTS:
+            raise ValueError("Unknown agent transport: {0}".format(transport))
+        if transport != TRANSPORT_STREAM and not message_socket_path:
+            raise ValueError("The {0} transport needs the agent's {0} socket path.".format(transport))
+        if transport == TRANSPORT_DATAGRAM and mode == REPORT_MODE_CALL:
+            raise ValueError("The datagram transport only carries notifications, it needs the notify report mode.")
+        self.mode = mode
+        self.transport = transport
+        timeout = send_timeout if mode == REPORT_MODE_NOTIFY else None
+        self.stream_client = RPCClient(socket_path, timeout=timeout, codec=codec)
+        if transport == TRANSPORT_SEQPACKET:
+            self.client = SeqpacketRPCClient(message_socket_path, timeout=timeout, codec=codec)
+        elif transport == TRANSPORT_DATAGRAM:
+            self.client = DatagramRPCClient(message_socket_path, timeout=timeout, codec=codec)
+        else:
+            self.client = self.stream_client
+        self.connected = False
+        self.journal = journal
+        self.journaling = mode == REPORT_MODE_JOURNAL
+
+    def connect(self):
+        if self.mode == REPORT_MODE_JOURNAL:
+            return False
+        try:
+            self.client.connect()
+            self.connected = True
+        except Exception:
+            reporting_logger.warning("Unable to connect to agent!")
+            self.connected = False
+        return self.connected
+
+    def deliver(self, client, method, params):
+        if self.mode == REPORT_MODE_NOTIFY:
+            client.send_notification(method, params)
+        else:
+            client.handle_rpc_call(method, params)
+
+    def send(self, method, params):
+        if not self.connected:
+            return False
+        try:
+            try:
+                self.deliver(self.client, method, params)
+            except RPCMessageTooLarge:
+                self.deliver(self.stream_client, method, params)
+            return True
+        except Exception:
+            reporting_logger.warning("Unable to report {0} to the agent!".format(method))
+            self.close()
+            return False
+
+    def request(self, method, params):
+        """
+        Make a call to the agent and return its result, or None if the agent could not be asked.
+        """
+        if self.journaling or not self.connected:
+            return None
+        try:
+            if self.transport == TRANSPORT_DATAGRAM:
+                return self.stream_client.handle_rpc_call(method, params)
+            try:
+                return self.client.handle_rpc_call(method, params)
+            except RPCMessageTooLarge:
+                return self.stream_client.handle_rpc_call(method, params)
+        except RPCException as e:
+            # The agent answered with an error (e.g. it predates the method), the connection itself is fine.
+            reporting_logger.warning("The agent refused {0}: {1}".format(method, e))
+            return None
+        except Exception:
+            reporting_logger.warning("Unable to call {0} on the agent!".format(method))
+            self.close()
+            return None
+
+    def report(self, method, params, journal_fallback=True):
+        if not self.journaling and self.send(method, params):
+            return True
+        if self.journal is None or not journal_fallback:
+            return False
+        try:
+            self.journal.append(method, params)
+        except (IOError, OSError):
+            reporting_logger.warning("Unable to append {0} to the journal {1}!".format(method, self.journal.path))
+            return False
+        self.journaling = True
+        return True
+
+    def job_started(self, job):
+        return self.report("add_new_job", {'raw_job_record': job.serialize()})
+
+    def job_finished(self, job_uuid, end_time, status_code, resource_usage=None):
+        return self.report(
+            "update_job_end_time_and_status_code",
+            {
+                'job_uuid': job_uuid,
+                'job_end_time': end_time,
+                'job_status_code': status_code,
+                'job_resource_usage': resource_usage
+            }
+        )
+
+    def job_output(self, job_uuid, stream_name, sequence_number, data, raw_length):
+        return self.report(
+            "append_job_output",
+            {
+                'job_uuid': job_uuid,
+                'stream_name': stream_name,
+                'sequence_number': sequence_number,
+                'data': data,
+                'raw_length': raw_length
+            },
+            journal_fallback=False
+        )
+
+    def job_heartbeat(self, job_uuid, heartbeat_time):
+        return self.report(
+            "job_heartbeat", {'job_uuid': job_uuid, 'heartbeat_time': heartbeat_time}, journal_fallback=False
+        )
+
+    def close(self):
+        self.connected = False
+        for client in set([self.client, self.stream_client]):
+            try:
+                client.disconnect()
+            except Exception:
+                reporting_logger.warning("Unable to close agent RPC connection!")
+                client.socket = None
+
+
+class JobHeartbeat(object):
+    """
+    Supervisor timer that tells the agent every interval seconds that the job is still running, so that jobs whose
+    wrapper died without reporting their end can be told apart from ones that are merely long running.
+    """
+
+    def __init__(self, reporter, job_uuid, interval):
+        self.reporter = reporter
+        self.job_uuid = job_uuid
+        self.interval = interval
+        self.next_heartbeat_monotonic = None
+        self.heartbeats_sent = 0
+
+    def start(self, start_monotonic):
+        self.next_heartbeat_monotonic = start_monotonic + self.interval
+
+    def seconds_until_due(self):
+        if self.next_heartbeat_monotonic is None:
+            return None
+        return max(0.0, self.next_heartbeat_monotonic - monotonic())
+
+    def run_if_due(self):
+        now = monotonic()
+        if self.next_heartbeat_monotonic is None or now < self.next_heartbeat_monotonic:
+            return False
+        self.reporter.job_heartbeat(self.job_uuid, time.time())
+        self.heartbeats_sent += 1
+        while self.next_heartbeat_monotonic <= now:
+            self.next_heartbeat_monotonic += self.interval
+        return True
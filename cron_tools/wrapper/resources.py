@@ -0,0 +1,149 @@
+"""
+Resource accounting for wrapped jobs: wait4 rusage of the child plus an optional /proc sampler for its process tree.
+"""
+import os
+import time
+
+from cron_tools.wrapper.capture import readinto
+
+process_time = getattr(time, 'process_time', None) or time.clock
+monotonic = getattr(time, 'monotonic', time.time)
+
+DEFAULT_SAMPLE_BUFFER_SIZE = 16 * 1024
+
+
+def rusage_summary(rusage):
+    return {
+        'user_cpu_seconds': rusage.ru_utime,
+        'system_cpu_seconds': rusage.ru_stime,
+        'max_rss_kb': rusage.ru_maxrss,
+        'block_input_operations': rusage.ru_inblock,
+        'block_output_operations': rusage.ru_oublock,
+        'voluntary_context_switches': rusage.ru_nvcsw,
+        'involuntary_context_switches': rusage.ru_nivcsw
+    }
+
+
+class ProcessTreeSampler(object):
+    """
+    Periodically walks /proc/<pid>/{stat,io,status} for the child and all of its descendants, keeping only running
+    maxima so memory use stays flat no matter how long the job runs. Every /proc read goes through one preallocated
+    buffer, and the CPU time spent sampling is tracked in overhead_seconds so its cost can be checked in production.
+    """
+
+    def __init__(self, interval, proc_root='/proc', buffer_size=DEFAULT_SAMPLE_BUFFER_SIZE):
+        self.interval = interval
+        self.proc_root = proc_root
+        self.root_pid = None
+        self.next_sample_monotonic = None
+        self._view = memoryview(bytearray(buffer_size))
+        self._page_size_kb = os.sysconf('SC_PAGE_SIZE') // 1024
+        self._clock_ticks = float(os.sysconf('SC_CLK_TCK'))
+        self.samples = 0
+        self.overhead_seconds = 0.0
+        self.max_tree_processes = 0
+        self.max_tree_rss_kb = 0
+        self.max_tree_swap_kb = 0
+        self.max_tree_cpu_seconds = 0.0
+        self.max_tree_read_bytes = 0
+        self.max_tree_write_bytes = 0
+
+    def start(self, root_pid, start_monotonic):
+        self.root_pid = root_pid
+        self.next_sample_monotonic = start_monotonic + self.interval
+
+    def seconds_until_due(self):
+        if self.next_sample_monotonic is None:
+            return None
+        return max(0.0, self.next_sample_monotonic - monotonic())
+
+    def run_if_due(self):
+        now = monotonic()
+        if self.next_sample_monotonic is None or now < self.next_sample_monotonic:
+            return False
+        self.sample()
+        # Skip missed slots instead of bursting to catch up, keeping the sampling rate fixed.
+        while self.next_sample_monotonic <= now:
+            self.next_sample_monotonic += self.interval
+        return True
+
+    def _read(self, pid, name):
+        fd = os.open(os.path.join(self.proc_root, str(pid), name), os.O_RDONLY)
+        try:
+            amount = readinto(fd, self._view)
+        finally:
+            os.close(fd)
+        return self._view[:amount].tobytes()
+
+    def _children(self, pid):
+        children = []
+        try:
+            for tid in os.listdir(os.path.join(self.proc_root, str(pid), 'task')):
+                children.extend(int(c) for c in self._read(pid, os.path.join('task', tid, 'children')).split())
+        except (IOError, OSError):
+            pass
+        return children
+
+    @staticmethod
+    def _field_kb(status, field_name):
+        start = status.find(field_name)
+        if start == -1:
+            return 0
+        return int(status[start + len(field_name):status.find(b'\n', start)].split()[0])
+
+    @staticmethod
+    def _io_field(io, field_name):
+        start = io.find(field_name)
+        if start == -1:
+            return 0
+        return int(io[start + len(field_name):io.find(b'\n', start)])
+
+    def sample(self):
+        started = process_time()
+        processes = rss_kb = swap_kb = read_bytes = write_bytes = 0
+        cpu_ticks = 0
+        pending = [self.root_pid]
+        while pending:
+            pid = pending.pop()
+            try:
+                stat = self._read(pid, 'stat')
+            except (IOError, OSError):
+                continue
+            # The command name may contain spaces, so split only what follows its closing parenthesis.
+            fields = stat[stat.rfind(b')') + 2:].split()
+            processes += 1
+            cpu_ticks += int(fields[11]) + int(fields[12])
+            rss_kb += int(fields[21]) * self._page_size_kb
+            try:
+                swap_kb += self._field_kb(self._read(pid, 'status'), b'VmSwap:')
+            except (IOError, OSError):
+                pass
+            try:
+                io = self._read(pid, 'io')
+                read_bytes += self._io_field(io, b'read_bytes:')
+                write_bytes += self._io_field(io, b'write_bytes:')
+            except (IOError, OSError):
+                pass
+            pending.extend(self._children(pid))
+
+        self.samples += 1
+        self.max_tree_processes = max(self.max_tree_processes, processes)
+        self.max_tree_rss_kb = max(self.max_tree_rss_kb, rss_kb)
+        self.max_tree_swap_kb = max(self.max_tree_swap_kb, swap_kb)
+        self.max_tree_cpu_seconds = max(self.max_tree_cpu_seconds, cpu_ticks / self._clock_ticks)
+        self.max_tree_read_bytes = max(self.max_tree_read_bytes, read_bytes)
+        self.max_tree_write_bytes = max(self.max_tree_write_bytes, write_bytes)
+        self.overhead_seconds += process_time() - started
+
+    def summary(self):
+        return {
+            'interval_seconds': self.interval,
+            'samples': self.samples,
+            'overhead_seconds': self.overhead_seconds,
+            'max_tree_processes': self.max_tree_processes,
+            'max_tree_rss_kb': self.max_tree_rss_kb,
+            'max_tree_swap_kb': self.max_tree_swap_kb,
+            'max_tree_cpu_seconds': self.max_tree_cpu_seconds,
+            'max_tree_read_bytes': self.max_tree_read_bytes,
+            'max_tree_write_bytes': self.max_tree_write_bytes
+        }
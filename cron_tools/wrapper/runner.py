@@ -0,0 +1,195 @@
+"""
+One wrapped job from spawn to report: its captured output, timers, optional cgroup and the agent events about it.
+"""
+import getpass
+import logging
+import os
+import time
+
+from cron_tools.common.models import AgentJob, generate_job_uuid
+from cron_tools.wrapper.capture import CapturedStream, open_spool_file, spool_file_path
+from cron_tools.wrapper.cgroup import JobCgroup, CgroupUnavailable
+from cron_tools.wrapper.reporting import JobHeartbeat
+from cron_tools.wrapper.resources import ProcessTreeSampler, rusage_summary
+from cron_tools.wrapper.spawn import spawn_child
+from cron_tools.wrapper.streaming import OutputChunkBatcher
+from cron_tools.wrapper.supervisor import monotonic
+
+# Shell convention for a command that could not be executed, used as the status of a job that failed to spawn.
+SPAWN_FAILED_STATUS_CODE = 127
+# EX_TEMPFAIL, as for jobs skipped under host pressure: the status of a job not run because its lock was held too long.
+LOCK_TIMEOUT_STATUS_CODE = 75
+
+runner_logger = logging.getLogger(__name__)
+
+
+def build_captured_stream(read_fd, stream_name, job_uuid, config, mirror, spool=True, batcher=None):
+    spool_fd = None
+    if spool:
+        try:
+            spool_fd = open_spool_file(spool_file_path(config.output_spool_directory, job_uuid, stream_name))
+        except (IOError, OSError):
+            runner_logger.warning(
+                "Unable to open output spool file for {0}, falling back to logging the output.".format(stream_name)
+            )
+            mirror = mirror or batcher is None
+    return CapturedStream(
+        read_fd, stream_name, spool_fd=spool_fd, mirror_logger=runner_logger if mirror else None, chunk_sink=batcher
+    )
+
+
+def build_output_batcher(reporter, job_uuid, stream_name, config):
+    return OutputChunkBatcher(
+        reporter, job_uuid, stream_name,
+        flush_bytes=config.output_stream_flush_bytes,
+        flush_interval=config.output_stream_flush_interval_seconds,
+        compression_level=config.output_stream_compression_level
+    )
+
+
+class JobRun(object):
+    """
+    Sets up, launches and reports one wrapped job according to the wrapper's command line arguments and
+    configuration. The job is supervised as a child of a (possibly shared) child supervisor, and reported to the
+    agent through a (possibly shared) reporter once it has been reaped. on_finished, if given, is called with the
+    job run after that.
+    """
+
+    def __init__(self, reporter, config, args, argv, job_name, job_host, tags=None, on_finished=None):
+        self.reporter = reporter
+        self.config = config
+        self.args = args
+        self.argv = argv
+        self.job_name = job_name
+        self.job_host = job_host
+        self.tags = tags
+        self.on_finished = on_finished
+        self.job_uuid = generate_job_uuid()
+        self.streams = []
+        self.timers = []
+        self.write_fds = {}
+        self.sampler = None
+        self.heartbeat = None
+        self.cgroup = None
+        self.process = None
+        self.status_code = None
+
+    def setup(self):
+        args, config = self.args, self.config
+        for stream_name, capture in (("stdout", args.capture_stdout), ("stderr", args.capture_stderr)):
+            if not capture:
+                continue
+            read_fd, self.write_fds[stream_name] = os.pipe()
+            batcher = build_output_batcher(self.reporter, self.job_uuid, stream_name, config) \
+                if args.stream_output else None
+            self.streams.append(build_captured_stream(
+                read_fd, stream_name, self.job_uuid, config, args.mirror_captured_output,
+                spool=not args.no_output_spool, batcher=batcher
+            ))
+            if batcher is not None:
+                self.timers.append(batcher)
+
+        sampling_interval = args.sample_resources or config.resource_sampling_interval_seconds
+        if sampling_interval:
+            self.sampler = ProcessTreeSampler(sampling_interval)
+            self.timers.append(self.sampler)
+        heartbeat_interval = args.heartbeat_interval
+        if heartbeat_interval is None:
+            heartbeat_interval = config.heartbeat_interval_seconds
+        if heartbeat_interval:
+            self.heartbeat = JobHeartbeat(self.reporter, self.job_uuid, heartbeat_interval)
+            self.timers.append(self.heartbeat)
+
+        if args.cgroup:
+            try:
+                self.cgroup = JobCgroup.create(config.cgroup_parent_path, "job-" + self.job_uuid, config.cgroup_limits)
+            except CgroupUnavailable as e:
+                runner_logger.warning("Running without cgroup containment: {0}".format(e))
+            else:
+                for limit_name, error in sorted(self.cgroup.limit_errors.items()):
+                    runner_logger.warning("Unable to apply cgroup limit {0}: {1}".format(limit_name, error))
+
+    def job_record(self, start_time, **kwargs):
+        return AgentJob(
+            job_id=None,
+            uuid=self.job_uuid,
+            name=self.job_name,
+            args=self.argv,
+            user=getpass.getuser(),
+            host=self.job_host,
+            tags=self.tags,
+            status_code=None,
+            start_time=start_time,
+            end_time=None,
+            created_time=None,
+            last_updated_time=None,
+            last_updated_sequence_number=None,
+            **kwargs
+        )
+
+    def report_not_run(self, status_code, **kwargs):
+        """
+        Report the job as started and immediately finished with status_code, for jobs that were skipped or could not
+        be spawned.
+        """
+        now = time.time()
+        self.reporter.job_started(self.job_record(now, **kwargs))
+        self.reporter.job_finished(self.job_uuid, now, status_code)
+        self.status_code = status_code
+
+    def _close_write_fds(self):
+        for fd in self.write_fds.values():
+            os.close(fd)
+        self.write_fds = {}
+
+    def start(self, supervisor, **kwargs):
+        """
+        Spawn the job, add it to the supervisor and report its start. Keyword arguments go to the job record.
+        """
+        start_time = time.time()
+        start_monotonic = monotonic()
+        try:
+            self.process = spawn_child(
+                self.argv, stdout=self.write_fds.get("stdout"), stderr=self.write_fds.get("stderr"),
+                preexec_fn=self.cgroup.preexec if self.cgroup is not None else None
+            )
+        finally:
+            self._close_write_fds()
+        supervisor.add_child(
+            self.process.pid, start_time, start_monotonic, self.streams, self.timers, on_exit=self.finish
+        )
+        if self.sampler is not None:
+            self.sampler.start(self.process.pid, start_monotonic)
+        self.reporter.job_started(self.job_record(start_time, **kwargs))
+        if self.heartbeat is not None:
+            self.heartbeat.start(monotonic())
+
+    def finish(self, child_exit):
+        # The supervisor reaped the child itself, let the process object know.
+        self.process.returncode = self.status_code = child_exit.status_code
+        resource_usage = rusage_summary(child_exit.rusage)
+        if self.sampler is not None:
+            resource_usage['process_tree'] = self.sampler.summary()
+        if self.cgroup is not None:
+            resource_usage['cgroup'] = self.cgroup.read_usage()
+            if self.config.cgroup_kill_on_exit:
+                self.cgroup.kill()
+            if not self.cgroup.remove():
+                runner_logger.warning(
+                    "Job cgroup {0} still has running processes, leaving it in place.".format(self.cgroup.path)
+                )
+            self.cgroup = None
+        self.reporter.job_finished(self.job_uuid, child_exit.end_time, self.status_code, resource_usage)
+        if self.on_finished is not None:
+            self.on_finished(self)
+
+    def close(self):
+        """
+        Release whatever the job still holds, whether or not it was started.
+        """
+        self._close_write_fds()
+        for stream in self.streams:
+            stream.close()
+        if self.cgroup is not None and self.process is None:
+            self.cgroup.remove()
+            self.cgroup = None
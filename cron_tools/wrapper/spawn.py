@@ -0,0 +1,82 @@
+"""
+Launching of the wrapped command.
+
+When no Python code has to run in the child, the command is started with posix_spawn(3), which glibc implements with
+clone(CLONE_VM | CLONE_VFORK): nothing of the wrapper's address space is copied and the child execs straight away.
+The capture pipes are wired up with dup2 file actions, the signal mask is cleared (the signalfd supervisor blocks
+SIGCHLD in the wrapper) and the signals Python ignores are reset to their defaults, as subprocess does. Anything
+that needs a preexec function, such as joining a cgroup, goes through subprocess.Popen instead.
+"""
+import os
+import signal
+
+HAS_POSIX_SPAWN = hasattr(os, 'posix_spawnp')
+
+# The signals CPython sets to SIG_IGN at start up, which Popen(restore_signals=True) resets in the child.
+RESTORED_SIGNALS = tuple(
+    getattr(signal, name) for name in ('SIGPIPE', 'SIGXFZ', 'SIGXFSZ') if hasattr(signal, name)
+)
+
+
+class SpawnedProcess(object):
+    """
+    The part of the Popen interface the wrapper uses. Reaping is left to the child supervisor.
+    """
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.returncode = None
+
+
+def inherited_descriptors(fd_directory='/proc/self/fd'):
+    """
+    Descriptors above stderr that would survive exec, which Popen(close_fds=True) would have closed in the child.
+    """
+    try:
+        fds = [int(fd) for fd in os.listdir(fd_directory)]
+    except (IOError, OSError):
+        return []
+    inherited = []
+    for fd in fds:
+        if fd <= 2:
+            continue
+        try:
+            if os.get_inheritable(fd):
+                inherited.append(fd)
+        except (IOError, OSError):
+            # The descriptor listdir itself used, already closed again.
+            pass
+    return sorted(inherited)
+
+
+def posix_spawn_child(argv, stdout=None, stderr=None):
+    file_actions = []
+    for fd, target in ((stdout, 1), (stderr, 2)):
+        if fd is not None:
+            file_actions.append((os.POSIX_SPAWN_DUP2, fd, target))
+    redirected = set(fd for fd in (stdout, stderr) if fd is not None)
+    for fd in inherited_descriptors():
+        if fd not in redirected:
+            file_actions.append((os.POSIX_SPAWN_CLOSE, fd))
+    pid = os.posix_spawnp(
+        argv[0], argv, os.environ,
+        file_actions=file_actions,
+        setsigmask=(),
+        setsigdef=RESTORED_SIGNALS
+    )
+    return SpawnedProcess(pid)
+
+
+def popen_child(argv, stdout=None, stderr=None, preexec_fn=None):
+    import subprocess
+    return subprocess.Popen(argv, stdout=stdout, stderr=stderr, preexec_fn=preexec_fn)
+
+
+def spawn_child(argv, stdout=None, stderr=None, preexec_fn=None):
+    """
+    Starts the wrapped command with its stdout/stderr on the given descriptors (None to inherit the wrapper's) and
+    returns a Popen like object for it.
+    """
+    if HAS_POSIX_SPAWN and preexec_fn is None:
+        return posix_spawn_child(argv, stdout, stderr)
+    return popen_child(argv, stdout, stderr, preexec_fn)
@@ -0,0 +1,28 @@
+"""
+Start staggering for wrapped jobs, spreading jobs that cron fires in the same second over a window of time.
+"""
+from cron_tools.common.stagger import hashed_start_fraction
+
+STAGGER_MODE_HASH = 'hash'
+STAGGER_MODE_AGENT = 'agent'
+STAGGER_MODES = (STAGGER_MODE_HASH, STAGGER_MODE_AGENT)
+
+
+def hashed_start_delay(host, job_name, window):
+    return hashed_start_fraction(host, job_name) * window
+
+
+def choose_start_delay(reporter, host, job_name, window, mode=STAGGER_MODE_HASH):
+    """
+    Returns the delay in seconds before the job should start. In agent mode the agent assigns the delay so that
+    concurrent starts on the host are spread evenly; if it cannot be asked the hashed delay is used instead.
+    """
+    if window <= 0:
+        return 0.0
+    if mode == STAGGER_MODE_AGENT:
+        response = reporter.request(
+            "assign_start_delay", {'job_name': job_name, 'job_host': host, 'window_seconds': window}
+        )
+        if response is not None:
+            return min(max(0.0, response['delay_seconds']), window)
+    return hashed_start_delay(host, job_name, window)
@@ -0,0 +1,75 @@
+"""
+Streaming of captured output from the wrapper to the agent in batched, compressed chunks.
+"""
+import zlib
+
+from cron_tools.common.output import blob_to_output_chunk, DEFAULT_COMPRESSION_LEVEL
+from cron_tools.wrapper.supervisor import monotonic
+
+DEFAULT_FLUSH_BYTES = 256 * 1024
+DEFAULT_FLUSH_INTERVAL_SECONDS = 1.0
+
+
+class OutputChunkBatcher(object):
+    """
+    Collects the captured output of one stream and sends it to the agent with append_job_output, flushing once
+    flush_bytes have accumulated or the oldest unsent byte is flush_interval seconds old. Output is compressed as it
+    arrives, straight from the capture buffer, so only the compressed form of the pending chunk is held in memory.
+    Every chunk is a complete zlib stream and can be decompressed on its own.
+    """
+
+    def __init__(self, reporter, job_uuid, stream_name, flush_bytes=DEFAULT_FLUSH_BYTES,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL_SECONDS, compression_level=DEFAULT_COMPRESSION_LEVEL):
+        self.reporter = reporter
+        self.job_uuid = job_uuid
+        self.stream_name = stream_name
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.compression_level = compression_level
+        self._compressor = None
+        self._compressed = []
+        self._pending_length = 0
+        self._pending_since = None
+        self.sequence_number = 0
+        self.bytes_sent = 0
+        self.compressed_bytes_sent = 0
+
+    def write(self, chunk):
+        if self._compressor is None:
+            self._compressor = zlib.compressobj(self.compression_level)
+            self._pending_since = monotonic()
+        self._compressed.append(self._compressor.compress(chunk))
+        self._pending_length += len(chunk)
+        if self._pending_length >= self.flush_bytes:
+            self.flush()
+
+    def seconds_until_due(self):
+        if self._pending_since is None:
+            return None
+        return max(0.0, self._pending_since + self.flush_interval - monotonic())
+
+    def run_if_due(self):
+        if self._pending_since is None or monotonic() < self._pending_since + self.flush_interval:
+            return False
+        self.flush()
+        return True
+
+    def flush(self):
+        if self._compressor is None:
+            return
+        self._compressed.append(self._compressor.flush())
+        compressed = b"".join(self._compressed)
+        self.reporter.job_output(
+            self.job_uuid, self.stream_name, self.sequence_number, blob_to_output_chunk(compressed),
+            self._pending_length
+        )
+        self.sequence_number += 1
+        self.bytes_sent += self._pending_length
+        self.compressed_bytes_sent += len(compressed)
+        self._compressor = None
+        self._compressed = []
+        self._pending_length = 0
+        self._pending_since = None
+
+    def close(self):
+        self.flush()
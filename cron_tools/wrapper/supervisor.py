@@ -0,0 +1,299 @@
+"""
+Child process supervision for the wrapper: block until the child exits or output arrives, then reap it.
+"""
+import abc
+import collections
+import errno
+import os
+import select
+import signal
+import time
+
+monotonic = getattr(time, 'monotonic', time.time)
+
+# Size of a struct signalfd_siginfo, see signalfd(2).
+SIGNALFD_SIGINFO_SIZE = 128
+
+ChildExit = collections.namedtuple('ChildExit', ('status_code', 'end_time', 'duration', 'rusage'))
+
+# abc.ABC for Python 2 as well; six is not imported by the wrapper, see test_startup.
+AbstractBase = abc.ABCMeta('AbstractBase', (object,), {'__slots__': ()})
+
+
+def exit_status_to_code(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+class SupervisedChild(object):
+    def __init__(self, pid, start_time, start_monotonic, streams=(), timers=(), on_exit=None):
+        self.pid = pid
+        self.start_time = start_time
+        self.start_monotonic = start_monotonic
+        self.streams = list(streams)
+        self.timers = list(timers)
+        self.on_exit = on_exit
+        self.child_exit = None
+
+
+def drain_streams(streams):
+    """
+    Collect whatever an exited child left in its pipes, without waiting on anything that outlived it.
+    """
+    open_streams = [stream for stream in streams if not stream.closed]
+    while open_streams:
+        ready, _, _ = select.select(open_streams, [], [], 0)
+        if not ready:
+            break
+        for stream in ready:
+            stream.pump()
+        open_streams = [stream for stream in open_streams if not stream.closed]
+
+
+class BaseChildSupervisor(AbstractBase):
+    """
+    Supervises any number of children from one event loop. Each child has its own captured streams, timers and an
+    on_exit callback, which runs once the child has been reaped and its streams drained and closed, and may add
+    further children (this is how a bounded pool of jobs is kept full).
+
+    Timers are objects with seconds_until_due() (None when idle) and run_if_due() methods, such as the process tree
+    sampler or the output chunk batchers; the event loop never blocks past the earliest one.
+
+    The single child interface (attach() then wait()) supervises one child with the streams and timers given to
+    the constructor.
+
+    Subclasses implement how the event loop waits, in poll().
+    """
+
+    def __init__(self, streams=(), timers=()):
+        self.streams = list(streams)
+        self.timers = list(timers)
+        self.children = {}
+        self.child_exit = None
+
+    @classmethod
+    def available(cls):
+        return True
+
+    def prepare(self):
+        """
+        Called before the first child is spawned.
+        """
+        pass
+
+    def attach(self, pid, start_time, start_monotonic):
+        return self.add_child(pid, start_time, start_monotonic, self.streams)
+
+    def add_child(self, pid, start_time, start_monotonic, streams=(), timers=(), on_exit=None):
+        child = SupervisedChild(pid, start_time, start_monotonic, streams, timers, on_exit)
+        self.children[pid] = child
+        self._watch(child)
+        return child
+
+    def _watch(self, child):
+        pass
+
+    def _unwatch(self, child):
+        pass
+
+    def all_timers(self):
+        for timer in self.timers:
+            yield timer
+        for child in list(self.children.values()):
+            for timer in child.timers:
+                yield timer
+
+    def wait_timeout(self):
+        """
+        How long the event loop may block, in seconds, with None meaning until something happens.
+        """
+        timeout = None
+        for timer in self.all_timers():
+            due = timer.seconds_until_due()
+            if due is not None and (timeout is None or due < timeout):
+                timeout = due
+        return timeout
+
+    def run_timers(self):
+        for timer in self.all_timers():
+            timer.run_if_due()
+
+    def reap(self, child, options=0):
+        pid, status, rusage = os.wait4(child.pid, options)
+        if pid == 0:
+            return False
+        duration = monotonic() - child.start_monotonic
+        child.child_exit = self.child_exit = ChildExit(
+            status_code=exit_status_to_code(status),
+            end_time=child.start_time + duration,
+            duration=duration,
+            rusage=rusage
+        )
+        return True
+
+    def finish(self, child):
+        del self.children[child.pid]
+        self._unwatch(child)
+        drain_streams(child.streams)
+        for stream in child.streams:
+            stream.close()
+        if child.on_exit is not None:
+            child.on_exit(child.child_exit)
+
+    @abc.abstractmethod
+    def poll(self, timeout):
+        """
+        Block for up to timeout seconds (None meaning until something happens), pumping the streams that are ready
+        and reaping and finishing the children that have exited.
+        """
+
+    def run(self):
+        """
+        Supervise until every child, including ones added along the way, has exited.
+        """
+        while self.children:
+            self.poll(self.wait_timeout())
+            if self.children:
+                self.run_timers()
+
+    def wait(self):
+        self.run()
+        return self.child_exit
+
+    def close(self):
+        pass
+
+
+class PidfdChildSupervisor(BaseChildSupervisor):
+    """
+    Waits on a pidfd per child and on the captured output pipes with a single epoll set, so the wrapper
+    sleeps until there is actually something to do.
+    """
+
+    _available = None
+
+    def __init__(self, streams=(), timers=()):
+        super(PidfdChildSupervisor, self).__init__(streams, timers)
+        self.poller = None
+        self.children_by_pidfd = {}
+        self.streams_by_fd = {}
+
+    @classmethod
+    def available(cls):
+        if cls._available is None:
+            cls._available = False
+            if hasattr(os, 'pidfd_open') and hasattr(select, 'epoll'):
+                try:
+                    os.close(os.pidfd_open(os.getpid()))
+                    cls._available = True
+                except OSError:
+                    pass
+        return cls._available
+
+    def prepare(self):
+        if self.poller is None:
+            self.poller = select.epoll()
+
+    def _watch(self, child):
+        self.prepare()
+        child.pidfd = os.pidfd_open(child.pid)
+        self.children_by_pidfd[child.pidfd] = child
+        self.poller.register(child.pidfd, select.EPOLLIN)
+        for stream in child.streams:
+            if not stream.closed:
+                self.streams_by_fd[stream.fileno()] = stream
+                self.poller.register(stream.fileno(), select.EPOLLIN)
+
+    def _forget_stream(self, fd):
+        del self.streams_by_fd[fd]
+        try:
+            self.poller.unregister(fd)
+        except (OSError, IOError, ValueError):
+            pass
+
+    def _unwatch(self, child):
+        for stream in child.streams:
+            if not stream.closed and stream.fileno() in self.streams_by_fd:
+                self._forget_stream(stream.fileno())
+        del self.children_by_pidfd[child.pidfd]
+        self.poller.unregister(child.pidfd)
+        os.close(child.pidfd)
+
+    def _pump(self, fd):
+        stream = self.streams_by_fd[fd]
+        stream.pump()
+        if stream.closed:
+            self._forget_stream(fd)
+
+    def poll(self, timeout):
+        exited = []
+        for fd, _ in self.poller.poll(-1 if timeout is None else timeout):
+            if fd in self.children_by_pidfd:
+                exited.append(self.children_by_pidfd[fd])
+            elif fd in self.streams_by_fd:
+                self._pump(fd)
+        # Finishing a child closes its descriptors and may start new children that reuse them, so it has to come
+        # after every other event of this batch has been handled.
+        for child in exited:
+            if self.reap(child):
+                self.finish(child)
+
+    def close(self):
+        for child in list(self.children.values()):
+            self._unwatch(child)
+        if self.poller is not None:
+            self.poller.close()
+            self.poller = None
+
+
+class SignalfdChildSupervisor(BaseChildSupervisor):
+    """
+    Fallback for kernels or Pythons without pidfd support, waking up on SIGCHLD delivered through a signalfd.
+    """
+
+    SIGNALS = [signal.SIGCLD, signal.SIGCHLD]
+
+    def __init__(self, streams=(), timers=()):
+        super(SignalfdChildSupervisor, self).__init__(streams, timers)
+        self.sigchld_fd = None
+
+    def prepare(self):
+        import signalfd
+        self.sigchld_fd = signalfd.signalfd(-1, self.SIGNALS, signalfd.SFD_CLOEXEC)
+        signalfd.sigprocmask(signalfd.SIG_BLOCK, self.SIGNALS)
+
+    def _reap_exited(self):
+        for child in list(self.children.values()):
+            if self.reap(child, os.WNOHANG):
+                self.finish(child)
+
+    def poll(self, timeout):
+        open_streams = [
+            stream for child in self.children.values() for stream in child.streams if not stream.closed
+        ]
+        try:
+            ready, _, _ = select.select([self.sigchld_fd] + open_streams, [], [], timeout)
+        except (OSError, select.error) as e:
+            if e.args[0] == errno.EINTR:
+                return
+            raise
+        for ready_fd in ready:
+            if ready_fd != self.sigchld_fd:
+                ready_fd.pump()
+        if self.sigchld_fd in ready:
+            os.read(self.sigchld_fd, SIGNALFD_SIGINFO_SIZE)
+            self._reap_exited()
+
+    def close(self):
+        if self.sigchld_fd is not None:
+            import signalfd
+            os.close(self.sigchld_fd)
+            signalfd.sigprocmask(signalfd.SIG_UNBLOCK, self.SIGNALS)
+            self.sigchld_fd = None
+
+
+def create_child_supervisor(streams=(), timers=()):
+    if PidfdChildSupervisor.available():
+        return PidfdChildSupervisor(streams, timers)
+    return SignalfdChildSupervisor(streams, timers)
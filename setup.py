@@ -29,8 +29,9 @@ setup(
     entry_points={
         'console_scripts': [
             'ct-agent=cron_tools.agent.app:main',
-            'ct-agent-admin=cron_tools_agent.admin_main:main',
+            'ct-agent-admin=cron_tools.agent.admin_main:main',
             'ct-aggregator=cron_tools.aggregator.app:main',
+            'ct-benchmark=cron_tools.benchmarks.main:main',
             'ct-wrapper=cron_tools.wrapper.main:main'
         ]
     },
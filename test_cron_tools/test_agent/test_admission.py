@@ -0,0 +1,151 @@
+import unittest
+from assertpy import assert_that
+import threading
+import tempfile
+import shutil
+import socket
+import time
+import sys
+import os
+
+from cron_tools.agent.admission import AdmissionController, peer_credentials
+from cron_tools.agent.rpc_server import AgentUnixStreamRPCServer
+from cron_tools.common.config import ConfigurationException
+from cron_tools.common.rpc import RPCErrorCodes, RPCException
+from cron_tools.common.rpc_client import RPCClient, SeqpacketRPCClient, DatagramRPCClient
+
+
+class AdmissionControllerUnitTests(unittest.TestCase):
+    def test_connection_limits(self):
+        """
+        Ensure connections over the per uid or global limit are refused and not counted, and that closing one makes
+        room again.
+        """
+        admission = AdmissionController(max_connections=3, max_connections_per_uid=2)
+        assert_that([admission.connection_opened(1000) for _ in range(3)]).is_equal_to([True, True, False])
+        assert_that(admission.connection_opened(1001)).is_true()
+        assert_that(admission.connection_opened(1002)).is_false()
+        admission.connection_closed(1000)
+        assert_that(admission.connection_opened(1002)).is_true()
+        snapshot = admission.snapshot()
+        assert_that(snapshot['connections']).is_equal_to(3)
+        assert_that(snapshot['connections_by_uid']).is_equal_to({'1000': 1, '1001': 1, '1002': 1})
+        assert_that(snapshot['connections_shed']).is_equal_to(2)
+        assert_that(snapshot['shed_by_uid']).is_equal_to({'1000': 1, '1002': 1})
+
+    def test_request_rates_queue_then_shed(self):
+        """
+        Ensure a uid over its request rate is first held back and then shed, without using up anybody else's rate.
+        """
+        admission = AdmissionController(requests_per_second_per_uid=10, burst_seconds=0.5, max_queue_seconds=0.25)
+        delays = [admission.request_delay(1000) for _ in range(12)]
+        assert_that(delays[:5]).is_equal_to([0.0] * 5)
+        assert_that(delays[5]).is_between(0.05, 0.15)
+        assert_that(delays[6]).is_between(0.15, 0.25)
+        assert_that(delays[7:]).is_equal_to([None] * 5)
+        assert_that(admission.request_delay(1001)).is_equal_to(0.0)
+        assert_that(admission.request_delay(1000, queue=False)).is_none()
+        snapshot = admission.snapshot()
+        assert_that(snapshot['requests_queued']).is_equal_to(2)
+        assert_that(snapshot['requests_shed']).is_equal_to(6)
+        assert_that(AdmissionController().request_delay(1000)).is_equal_to(0.0)
+        self.assertRaises(ConfigurationException, AdmissionController.from_config, {'max_connection': 1})
+
+
+class AdmissionControlServerTests(unittest.TestCase):
+    def test_server_sheds_over_limit_connections_and_requests(self):
+        """
+        Ensure the threading server tells peers apart by uid, answers requests on connections over the limits with
+        the overloaded error, holds back then sheds requests over the rate, and counts what it sheds.
+        """
+        self.check_server_admission(AgentUnixStreamRPCServer)
+
+    @unittest.skipIf(sys.version_info < (3, 7), "The asyncio RPC server requires Python 3.7 or later.")
+    def test_asyncio_server_sheds_over_limit_connections_and_requests(self):
+        """
+        Ensure the asyncio server applies admission control just like the threading one.
+        """
+        from cron_tools.agent.async_rpc_server import AsyncioUnixStreamRPCServer
+        self.check_server_admission(AsyncioUnixStreamRPCServer)
+
+    def check_server_admission(self, server_class):
+        tempdir = tempfile.mkdtemp()
+        server = server_thread = None
+        uid = str(os.getuid())
+        try:
+            socket_path = os.path.join(tempdir, "test.socket")
+            admission = AdmissionController(max_connections_per_uid=2)
+            server = server_class(socket_path, admission=admission)
+            server.add_listener(socket.SOCK_SEQPACKET, socket_path + ".seqpacket")
+            server.add_listener(socket.SOCK_DGRAM, socket_path + ".datagram")
+            recorded = []
+            server.register_function("echo", lambda value: value)
+            server.register_function("record", lambda value: recorded.append(value))
+            server_thread = threading.Thread(target=server.serve_forever)
+            server_thread.start()
+
+            first = RPCClient(socket_path, timeout=5)
+            assert_that(first.handle_rpc_call("echo", {"value": 1})).is_equal_to(1)
+            assert_that(peer_credentials(first.socket).uid).is_equal_to(os.getuid())
+            second = SeqpacketRPCClient(socket_path + ".seqpacket", timeout=5)
+            assert_that(second.handle_rpc_call("echo", {"value": 2})).is_equal_to(2)
+            for client in (RPCClient(socket_path, timeout=5),
+                           SeqpacketRPCClient(socket_path + ".seqpacket", timeout=5)):
+                try:
+                    client.handle_rpc_call("echo", {"value": 3})
+                    self.fail("A connection over the per uid limit was served.")
+                except RPCException as e:
+                    assert_that(e.rpc_error_code).is_equal_to(RPCErrorCodes.SERVER_OVERLOADED.value)
+                client.disconnect()
+            second.disconnect()
+            # The closed connection made room, the reconnected client gets in again.
+            for _ in range(50):
+                if admission.snapshot()['connections'] == 1:
+                    break
+                time.sleep(0.05)
+            third = RPCClient(socket_path, timeout=5)
+            assert_that(third.handle_rpc_call("echo", {"value": 4})).is_equal_to(4)
+            third.disconnect()
+
+            # One request at a time over the rate is held back, which paces the client down to the rate.
+            admission.requests_per_second_per_uid = 20
+            admission.burst_seconds = 0.25
+            admission.max_queue_seconds = 0.1
+            started = time.time()
+            assert_that(first.handle_rpc_batch([("echo", {"value": 5})] * 12)).is_equal_to([5] * 12)
+            for _ in range(11):
+                assert_that(first.handle_rpc_call("echo", {"value": 6})).is_equal_to(6)
+            assert_that(time.time() - started).is_greater_than(0.25)
+
+            time.sleep(0.3)
+            admission.max_queue_seconds = 0.0
+            outcomes = []
+            for _ in range(12):
+                try:
+                    outcomes.append(first.handle_rpc_call("echo", {"value": 7}))
+                except RPCException as e:
+                    outcomes.append(e.rpc_error_code)
+            assert_that(outcomes).contains(7, RPCErrorCodes.SERVER_OVERLOADED.value)
+
+            # Datagrams over the rate are dropped rather than held back.
+            time.sleep(0.3)
+            datagram_client = DatagramRPCClient(socket_path + ".datagram", timeout=5)
+            for i in range(20):
+                datagram_client.send_notification("record", {"value": i})
+            datagram_client.disconnect()
+            time.sleep(0.3)
+            assert_that(len(recorded)).is_between(4, 10)
+
+            stats = admission.snapshot()
+            assert_that(stats['connections_shed']).is_equal_to(2)
+            assert_that(stats['requests_shed']).is_greater_than(10)
+            assert_that(stats['requests_queued']).is_greater_than(0)
+            assert_that(stats['shed_by_uid']).contains_key(uid)
+            first.disconnect()
+        finally:
+            if server is not None:
+                server.shutdown()
+                server.server_close()
+            if server_thread is not None:
+                server_thread.join(5)
+            shutil.rmtree(tempdir)
@@ -5,9 +5,13 @@ import tempfile
 import shutil
 import os
 
+from cron_tools.benchmarks.common import sample_job
+from cron_tools.common.journal import EventJournal, FSYNC_NEVER, decode_records
+from cron_tools.common.models import AgentJob
 from cron_tools.common.rpc_client import RPCClient
 from cron_tools.agent.config import AgentConfiguration
-from cron_tools.agent.app import build_app, agent_argument_parser
+from cron_tools.agent.app import build_app, agent_argument_parser, ingest_journal
+from cron_tools.agent.queries import SimpleConnectionPool, write_schema, get_all_jobs
 
 
 class CronToolsAgentApplicationUnitTest(unittest.TestCase):
@@ -38,3 +42,32 @@ class CronToolsAgentApplicationUnitTest(unittest.TestCase):
             server_thread.join(5)
         finally:
             shutil.rmtree(tempdir)
+
+    def test_journal_ingest_quarantines_failing_events(self):
+        """
+        Ensure an event that cannot be applied is quarantined while the events around it are applied, so that it
+        does not fail every later ingest.
+        """
+        tempdir = tempfile.mkdtemp()
+        try:
+            pool = SimpleConnectionPool(os.path.join(tempdir, "test.db"))
+            connection = pool.get()
+            write_schema(connection)
+            journal = EventJournal(os.path.join(tempdir, "journal"), FSYNC_NEVER)
+            first_job, second_job = sample_job(1, finished=False), sample_job(2, finished=False)
+            journal.append("add_new_job", {"raw_job_record": first_job})
+            journal.append("update_job_end_time_and_status_code", {"no_such_parameter": 1})
+            journal.append("add_new_job", {"raw_job_record": second_job})
+            assert_that(ingest_journal(pool, journal)).is_equal_to(2)
+            assert_that(sorted(job.uuid for job in get_all_jobs(connection))).is_equal_to(
+                sorted(AgentJob.deserialize(job).uuid for job in (first_job, second_job))
+            )
+            with open(journal.quarantine_path, 'rb') as f:
+                events, _ = decode_records(f.read())
+            assert_that(events).is_equal_to(
+                [{"method": "update_job_end_time_and_status_code", "params": {"no_such_parameter": 1}}]
+            )
+            assert_that(ingest_journal(pool, journal)).is_equal_to(0)
+            pool.close_all()
+        finally:
+            shutil.rmtree(tempdir)
@@ -0,0 +1,69 @@
+import unittest
+from assertpy import assert_that
+import tempfile
+import shutil
+import os
+
+from cron_tools.agent.queries import SimpleConnectionPool, write_schema, get_all_jobs
+from cron_tools.agent.rpc_server import AgentUnixStreamRPCServer, attach_agent_functions
+from cron_tools.common.models import AgentJob
+from cron_tools.common.rpc import BaseRPCClientHandler, RPCException
+
+
+def new_job(job_uuid):
+    return AgentJob(
+        job_id=None, uuid=job_uuid, name="job", args=["true"], user="user", host="host", tags=None,
+        status_code=None, start_time=1000.0, end_time=None, created_time=None, last_updated_time=None,
+        last_updated_sequence_number=None
+    ).serialize()
+
+
+class AgentRPCBatchUnitTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.pool = SimpleConnectionPool(os.path.join(self.tempdir, "test.db"))
+        write_schema(self.pool.get())
+        self.server = AgentUnixStreamRPCServer(os.path.join(self.tempdir, "test.socket"), bind_and_activate=False)
+        attach_agent_functions(self.server, self.pool)
+        self.statements = []
+        self.pool.get().set_trace_callback(self.statements.append)
+        self.client_handler = BaseRPCClientHandler()
+
+    def tearDown(self):
+        self.server.server_close()
+        self.pool.close_all()
+        shutil.rmtree(self.tempdir)
+
+    def handle_batch(self, calls):
+        raw_request, ids = self.client_handler.marshal_batch(calls)
+        return self.client_handler.unmarshal_batch_response(self.server.handler.handle_request(raw_request), ids)
+
+    def test_write_batch_commits_once(self):
+        """
+        Ensure a batch of writes runs in one transaction, with a failed call only rolling back its own changes.
+        """
+        results = self.handle_batch([
+            ("add_new_job", {"raw_job_record": new_job("job-1")}),
+            ("add_new_job", {"raw_job_record": new_job("job-2")}),
+            ("update_job_end_time_and_status_code", {
+                "job_uuid": "job-1", "job_end_time": 1010.0, "job_status_code": 0
+            }),
+            ("add_new_job", {"raw_job_record": {"job_uuid": "broken"}}),
+            ("ping", {})
+        ])
+        assert_that(results[0]["record"]["job_uuid"]).is_equal_to("job-1")
+        assert_that(results[2]["updated_info"]["job_uuid"]).is_equal_to("job-1")
+        assert_that(results[3]).is_instance_of(RPCException)
+        assert_that(results[4]).is_equal_to({"response": "pong"})
+        assert_that([s for s in self.statements if s.startswith("BEGIN")]).is_length(1)
+        assert_that([s for s in self.statements if s == "COMMIT"]).is_length(1)
+        jobs = dict((j.uuid, j) for j in get_all_jobs(self.pool.get()))
+        assert_that(sorted(jobs)).is_equal_to(["job-1", "job-2"])
+        assert_that(jobs["job-1"].status_code).is_equal_to(0)
+
+    def test_read_only_batch_takes_no_transaction(self):
+        results = self.handle_batch([("ping", {}), ("get_recent_jobs", {"limit": 10}), ("missing", {})])
+        assert_that(results[0]).is_equal_to({"response": "pong"})
+        assert_that(results[1]).is_equal_to({"recent_jobs": []})
+        assert_that(results[2]).is_instance_of(RPCException)
+        assert_that([s for s in self.statements if s.startswith("BEGIN")]).is_empty()
@@ -0,0 +1,31 @@
+import copy
+import unittest
+from assertpy import assert_that
+
+from cron_tools.benchmarks.fleet import run_benchmark, regressions, FLEET_METHODS
+
+
+class FleetBenchmarkTests(unittest.TestCase):
+    def test_short_fleet_run_and_baseline_comparison(self):
+        """
+        Ensure a short fleet run against a real agent completes jobs without errors, and that a later run only counts
+        as a regression once it is worse than the baseline by more than the tolerance.
+        """
+        results = run_benchmark([4], duration=1.0, job_seconds=0.01, active_jobs_ratio=1.0)
+        run, = results['runs']
+        assert_that(run['jobs']).is_greater_than(0)
+        assert_that(run['agent_peak_rss_mb']).is_greater_than(0)
+        assert_that(run['agent_peak_threads']).is_greater_than(0)
+        assert_that(run['database_mb']).is_greater_than(0)
+        for method in FLEET_METHODS:
+            assert_that(run['methods'][method]['calls']).is_greater_than(0)
+            assert_that(run['methods'][method]['errors']).is_equal_to(0)
+        assert_that(regressions(results, results, 0.2)).is_empty()
+
+        slower = copy.deepcopy(results)
+        slower['runs'][0]['jobs_per_second'] *= 0.9
+        slower['runs'][0]['methods']['add_new_job']['p99_ms'] *= 1.1
+        assert_that(regressions(slower, results, 0.2)).is_empty()
+        slower['runs'][0]['jobs_per_second'] *= 0.5
+        slower['runs'][0]['methods']['add_new_job']['p99_ms'] *= 2
+        assert_that(regressions(slower, results, 0.2)).is_length(2)
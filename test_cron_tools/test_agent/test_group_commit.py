@@ -0,0 +1,132 @@
+import unittest
+from assertpy import assert_that
+import threading
+import tempfile
+import shutil
+import os
+
+from cron_tools.agent.group_commit import GroupCommitWriter
+from cron_tools.agent.rpc_server import AgentUnixStreamRPCServer, attach_agent_functions
+from cron_tools.agent.queries import SimpleConnectionPool, write_schema, add_job, get_all_jobs
+from cron_tools.common.models import AgentJob
+from cron_tools.common.rpc_client import RPCClient
+from cron_tools.benchmarks.common import sample_job
+
+
+class GroupCommitWriterTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.pool = SimpleConnectionPool(os.path.join(self.tempdir, "test.db"))
+        write_schema(self.pool.get())
+        self.writer = GroupCommitWriter(self.pool, max_batch_operations=16, max_delay_seconds=0.01)
+        self.writer.start()
+
+    def tearDown(self):
+        self.writer.close()
+        self.pool.close_all()
+        shutil.rmtree(self.tempdir)
+
+    def test_concurrent_writes_share_commits(self):
+        """
+        Ensure concurrent writers get their own results back, committed, in fewer transactions than writes.
+        """
+        results = {}
+
+        def write(index):
+            job = AgentJob.deserialize(sample_job(index, finished=False))
+            results[index] = self.writer.submit(lambda t: add_job(t, job))
+
+        threads = [threading.Thread(target=write, args=(i,)) for i in range(64)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert_that(sorted(r.name for r in results.values())).is_equal_to(
+            sorted(AgentJob.deserialize(sample_job(i)).name for i in range(64))
+        )
+        assert_that(get_all_jobs(self.pool.get(), limit=100)).is_length(64)
+        snapshot = self.writer.snapshot()
+        assert_that(snapshot['operations']).is_equal_to(64)
+        assert_that(snapshot['batches']).is_less_than(64)
+        assert_that(snapshot['largest_batch_operations']).is_less_than_or_equal_to(16)
+
+    def test_failed_write_only_rolls_back_itself(self):
+        """
+        Ensure a failing write raises in its caller and undoes only its own changes, and that a closed writer
+        refuses writes.
+        """
+        failed = []
+
+        def failing_write(t):
+            add_job(t, AgentJob.deserialize(sample_job(1, finished=False)))
+            raise ValueError("bad write")
+
+        def submit_failing():
+            try:
+                self.writer.submit(failing_write)
+            except ValueError as e:
+                failed.append(e)
+
+        thread = threading.Thread(target=submit_failing)
+        thread.start()
+        self.writer.submit(lambda t: add_job(t, AgentJob.deserialize(sample_job(2, finished=False))))
+        thread.join()
+        assert_that(failed).is_length(1)
+        assert_that([j.name for j in get_all_jobs(self.pool.get())]).is_equal_to(
+            [AgentJob.deserialize(sample_job(2)).name]
+        )
+        self.writer.close()
+        self.assertRaises(RuntimeError, self.writer.submit, lambda t: None)
+
+    def test_rpc_batches_during_group_commits(self):
+        """
+        Ensure write batches sent over RPC while other writes are being group committed run whole on the writer,
+        rather than contending with it for the database, and that every write commits.
+        """
+        socket_path = os.path.join(self.tempdir, "test.socket")
+        server = AgentUnixStreamRPCServer(socket_path)
+        attach_agent_functions(server, self.pool, writer=self.writer)
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.start()
+        errors = []
+
+        def write(index):
+            try:
+                job = AgentJob.deserialize(sample_job(index, finished=False))
+                self.writer.submit(lambda t: add_job(t, job))
+            except Exception as e:
+                errors.append(e)
+
+        def send_batch(index):
+            client = RPCClient(socket_path, timeout=10)
+            try:
+                job = sample_job(index, finished=False)
+                client.handle_rpc_batch([
+                    ("add_new_job", {"raw_job_record": job}),
+                    ("update_job_end_time_and_status_code", {
+                        "job_uuid": job["job_uuid"], "job_end_time": job["job_start_time_utc_epoch_seconds"] + 60,
+                        "job_status_code": 0
+                    })
+                ])
+            except Exception as e:
+                errors.append(e)
+            finally:
+                client.disconnect()
+
+        try:
+            threads = [threading.Thread(target=write, args=(i,)) for i in range(32)]
+            threads += [threading.Thread(target=send_batch, args=(i,)) for i in range(32, 48)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            server.shutdown()
+            server.server_close()
+            server_thread.join(5)
+        assert_that(errors).is_empty()
+        jobs = get_all_jobs(self.pool.get(), limit=100)
+        assert_that(jobs).is_length(48)
+        assert_that([j for j in jobs if j.end_time is not None]).is_length(16)
+        # Each batch is one operation of the writer's, its writes savepoints inside it.
+        assert_that(self.writer.snapshot()['operations']).is_equal_to(48)
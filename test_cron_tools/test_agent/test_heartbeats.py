@@ -0,0 +1,68 @@
+import unittest
+from assertpy import assert_that
+
+from cron_tools.agent.heartbeats import HeartbeatCoalescer
+from cron_tools.agent.queries import SimpleConnectionPool, write_schema, get_all_jobs
+from cron_tools.agent.rpc_server import attach_agent_functions
+from cron_tools.common.models import AgentJob
+from cron_tools.common.rpc import BaseRPCServerHandler
+
+
+class FunctionRecordingServer(object):
+    def __init__(self):
+        self.functions = {}
+        self.handler = BaseRPCServerHandler()
+
+    def register_function(self, name, function, write=False):
+        self.functions[name] = function
+
+    def set_batch_transaction(self, batch_transaction):
+        pass
+
+
+class AgentHeartbeatUnitTests(unittest.TestCase):
+    def setUp(self):
+        self.pool = SimpleConnectionPool(":memory:")
+        write_schema(self.pool.get())
+        self.heartbeats = HeartbeatCoalescer()
+        self.server = FunctionRecordingServer()
+        attach_agent_functions(self.server, self.pool, heartbeats=self.heartbeats)
+        self.server.functions["add_new_job"](AgentJob(
+            job_id=None, uuid="job-uuid", name="job", args=["sleep", "1000"], user="user", host="host", tags=None,
+            status_code=None, start_time=1000.0, end_time=None, created_time=None, last_updated_time=None,
+            last_updated_sequence_number=None
+        ).serialize())
+
+    def tearDown(self):
+        self.pool.close_all()
+
+    def active_job(self):
+        return self.server.functions["get_active_jobs"]()["active_jobs"][0]
+
+    def test_heartbeats_are_coalesced_until_flushed(self):
+        """
+        Ensure only the latest heartbeat per job is written, in one flush, and is visible before it.
+        """
+        assert_that(self.active_job()["job_last_heartbeat_age_seconds"]).is_none()
+        for heartbeat_time in (2000.0, 2300.0, 2100.0):
+            self.server.functions["job_heartbeat"]("job-uuid", heartbeat_time)
+        assert_that(self.heartbeats.pending_count()).is_equal_to(1)
+        assert_that(self.active_job()["job_last_heartbeat_utc_epoch_seconds"]).is_equal_to(2300.0)
+        assert_that(get_all_jobs(self.pool.get())[0].last_heartbeat_time).is_none()
+
+        assert_that(self.heartbeats.flush(self.pool.get())).is_equal_to(1)
+        assert_that(self.heartbeats.flush(self.pool.get())).is_equal_to(0)
+        job = get_all_jobs(self.pool.get())[0]
+        assert_that(job.serialize()["job_last_heartbeat_utc_epoch_seconds"]).is_equal_to(2300.0)
+        assert_that(job.last_updated_sequence_number).is_equal_to(0)
+        assert_that(self.active_job()["job_last_heartbeat_age_seconds"]).is_greater_than(0)
+
+    def test_older_heartbeats_do_not_overwrite_newer(self):
+        """
+        Ensure a late flush of an older heartbeat leaves a newer stored one alone.
+        """
+        self.heartbeats.record("job-uuid", 3000.0)
+        self.heartbeats.flush(self.pool.get())
+        self.heartbeats.record("job-uuid", 2000.0)
+        self.heartbeats.flush(self.pool.get())
+        assert_that(self.active_job()["job_last_heartbeat_utc_epoch_seconds"]).is_equal_to(3000.0)
@@ -1,9 +1,13 @@
 import unittest
+import zlib
 from assertpy import assert_that
 
 from cron_tools.agent.queries import create_connection, get_and_increment_counter, \
     immediate_transaction_manager, write_schema, get_all_key_value_pairs, get_key_value_pair, \
-    set_key_value_pair, del_key_value_pair, transaction_manager
+    set_key_value_pair, del_key_value_pair, transaction_manager, add_job, update_job_end_time_and_status, \
+    get_all_jobs, add_job_output_chunk, get_job_output_chunks, remove_old_jobs
+from cron_tools.common.models import AgentJob
+from cron_tools.common.output import encode_output_chunk, output_chunk_to_blob
 
 
 class AgentSqliteQueryUnitTests(unittest.TestCase):
@@ -42,4 +46,65 @@ class AgentSqliteQueryUnitTests(unittest.TestCase):
         assert_that(get_key_value_pair(self.test_conn, "foobar")).is_none()
 
     def test_job_crud(self):
-        pass
\ No newline at end of file
+        with immediate_transaction_manager(self.test_conn) as t:
+            job = add_job(t, AgentJob(
+                job_id=None, uuid="job-uuid", name="job", args=["true"], user="user", host="host", tags=None,
+                status_code=None, start_time=1000.0, end_time=None, created_time=None, last_updated_time=None,
+                last_updated_sequence_number=None
+            ))
+        assert_that(job.job_id).is_not_none()
+        assert_that(get_all_jobs(self.test_conn)[0].resource_usage).is_none()
+
+        with immediate_transaction_manager(self.test_conn) as t:
+            update_job_end_time_and_status(t, "job-uuid", 1010.0, 0, {'max_rss_kb': 1024})
+        jobs = get_all_jobs(self.test_conn)
+        assert_that(jobs).is_length(1)
+        assert_that(jobs[0].status_code).is_equal_to(0)
+        assert_that(jobs[0].resource_usage).is_equal_to({'max_rss_kb': 1024})
+        assert_that(jobs[0].serialize()['job_resource_usage']).is_equal_to({'max_rss_kb': 1024})
+
+    def test_schema_upgrade_of_existing_database(self):
+        """
+        Ensure job table columns added after the first release are added to an existing database.
+        """
+        connection = create_connection(":memory:")
+        connection.execute(
+            "CREATE TABLE job(job_id INTEGER PRIMARY KEY, job_uuid TEXT UNIQUE NOT NULL)"
+        )
+        write_schema(connection)
+        write_schema(connection)
+        columns = [row[1] for row in connection.execute("PRAGMA table_info(job)").fetchall()]
+        assert_that(columns).contains('job_uuid', 'job_resource_usage_json')
+
+    def test_job_output_chunk_retention(self):
+        """
+        Ensure only the head and tail of a job's output are kept, and that they go away with the job, but not
+        before: output can arrive ahead of its job.
+        """
+        with immediate_transaction_manager(self.test_conn) as t:
+            add_job(t, AgentJob(
+                job_id=None, uuid="job-uuid", name="job", args=["true"], user="user", host="host", tags=None,
+                status_code=0, start_time=1000.0, end_time=1010.0, created_time=None, last_updated_time=None,
+                last_updated_sequence_number=None
+            ))
+            add_job_output_chunk(
+                t, "later-job-uuid", "stdout", 0, output_chunk_to_blob(encode_output_chunk(b"early\n")), 6,
+                head_bytes=150, tail_bytes=200
+            )
+        for sequence_number in range(10):
+            raw = "chunk {0}\n".format(sequence_number).encode('ascii') * 10
+            with immediate_transaction_manager(self.test_conn) as t:
+                add_job_output_chunk(
+                    t, "job-uuid", "stdout", sequence_number, output_chunk_to_blob(encode_output_chunk(raw)),
+                    len(raw), head_bytes=150, tail_bytes=200
+                )
+        chunks = get_job_output_chunks(self.test_conn, "job-uuid", "stdout")
+        assert_that([c[1] for c in chunks]).is_equal_to([0, 1, 7, 8, 9])
+        assert_that(zlib.decompress(chunks[-1][3])).is_equal_to(b"chunk 9\n" * 10)
+        assert_that(get_job_output_chunks(self.test_conn, "job-uuid", "stderr")).is_empty()
+
+        with immediate_transaction_manager(self.test_conn) as t:
+            remove_old_jobs(t, 0)
+        assert_that(get_job_output_chunks(self.test_conn, "job-uuid")).is_empty()
+        assert_that(get_all_jobs(self.test_conn)).is_empty()
+        assert_that(get_job_output_chunks(self.test_conn, "later-job-uuid")).is_length(1)
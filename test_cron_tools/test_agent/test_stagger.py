@@ -0,0 +1,35 @@
+import unittest
+from assertpy import assert_that
+
+from cron_tools.agent.stagger import StartSlotAllocator
+
+
+class AgentStartSlotUnitTests(unittest.TestCase):
+    def test_concurrent_starts_are_spread_evenly(self):
+        """
+        Ensure jobs asking at the same time get distinct slots until the window is full, then share them evenly.
+        """
+        allocator = StartSlotAllocator(slot_seconds=0.5)
+        delays = [allocator.assign("host", "job-{0}".format(i), 4.0, now=1000.0) for i in range(16)]
+        assert_that(sorted(set(delays))).is_equal_to([0.5 * i for i in range(8)])
+        assert_that(sorted(delays.count(d) for d in set(delays))).is_equal_to([2] * 8)
+
+    def test_uncontended_job_keeps_its_slot(self):
+        """
+        Ensure a job alone in its window always gets the same offset, and old slots are forgotten.
+        """
+        allocator = StartSlotAllocator(slot_seconds=1.0)
+        first = allocator.assign("host", "job", 60.0, now=1000.0)
+        assert_that(allocator.assign("host", "job", 60.0, now=1060.0)).is_equal_to(first)
+        assert_that(first).is_between(0, 59)
+
+    def test_window_is_checked_and_capped(self):
+        """
+        Ensure windows that are not positive numbers are rejected, and long ones cut down to the maximum.
+        """
+        allocator = StartSlotAllocator(slot_seconds=1.0, max_window_seconds=10.0)
+        for window_seconds in (0, -5, float('nan'), "60", None, True):
+            self.assertRaises(ValueError, allocator.assign, "host", "job", window_seconds, now=1000.0)
+        delays = [allocator.assign("host", "job-{0}".format(i), 1e18, now=1000.0) for i in range(20)]
+        assert_that(sorted(set(delays))).is_equal_to([float(i) for i in range(10)])
+        assert_that(allocator.assign("host", "job", float('inf'), now=1000.0)).is_between(0, 9)
@@ -0,0 +1,83 @@
+import unittest
+from assertpy import assert_that
+import tempfile
+import shutil
+import os
+
+from cron_tools.agent.config import AgentConfiguration
+from cron_tools.agent.queries import SimpleConnectionPool, write_schema, immediate_transaction_manager, add_job
+from cron_tools.agent.storage import storage_pragmas, checkpoint_wal, wal_size, WAL_CHECKPOINT_PASSIVE, \
+    WAL_CHECKPOINT_TRUNCATE
+from cron_tools.common.config import ConfigurationException
+from cron_tools.common.models import AgentJob
+from cron_tools.benchmarks.common import sample_job
+
+
+class AgentStorageProfileTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.database_path = os.path.join(self.tempdir, "test.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_profile_pragmas_are_set_on_every_connection(self):
+        """
+        Ensure a profile's pragmas, with overrides, are set on the pooled connections, and bad overrides refused.
+        """
+        pool = SimpleConnectionPool(self.database_path, pragmas=storage_pragmas('balanced', {'cache_size': -4000}))
+        try:
+            connection = pool.get()
+            assert_that(connection.execute("PRAGMA journal_mode").fetchone()[0]).is_equal_to('wal')
+            assert_that(connection.execute("PRAGMA synchronous").fetchone()[0]).is_equal_to(1)
+            assert_that(connection.execute("PRAGMA busy_timeout").fetchone()[0]).is_equal_to(5000)
+            assert_that(connection.execute("PRAGMA cache_size").fetchone()[0]).is_equal_to(-4000)
+            assert_that(connection.execute("PRAGMA temp_store").fetchone()[0]).is_equal_to(2)
+        finally:
+            pool.close_all()
+        self.assertRaises(ConfigurationException, storage_pragmas, 'reckless')
+        assert_that(storage_pragmas(None)).is_empty()
+        assert_that(storage_pragmas(None, {'cache_size': -4000})).is_equal_to({'cache_size': -4000})
+        self.assertRaises(ConfigurationException, storage_pragmas, 'fast', {'locking_mode': 'EXCLUSIVE'})
+        self.assertRaises(ConfigurationException, storage_pragmas, 'fast', {'synchronous': 'OFF; DROP TABLE job'})
+
+    def test_default_keeps_the_journal_mode(self):
+        """
+        Ensure the default configuration leaves an existing spool's rollback journal alone.
+        """
+        config = AgentConfiguration.load({'logging_config': {'version': 1, 'incremental': True}})
+        for _ in range(2):
+            pool = SimpleConnectionPool(
+                self.database_path, pragmas=storage_pragmas(config.storage_profile, config.storage_pragmas)
+            )
+            try:
+                connection = pool.get()
+                write_schema(connection)
+                assert_that(connection.execute("PRAGMA journal_mode").fetchone()[0]).is_equal_to('delete')
+            finally:
+                pool.close_all()
+
+    def test_wal_checkpoint_thresholds(self):
+        """
+        Ensure the WAL is left alone below the passive threshold, checkpointed above it and truncated above the
+        truncate threshold.
+        """
+        pool = SimpleConnectionPool(self.database_path, pragmas=storage_pragmas('durable'))
+        try:
+            connection = pool.get()
+            write_schema(connection)
+            for i in range(50):
+                with immediate_transaction_manager(connection) as t:
+                    add_job(t, AgentJob.deserialize(sample_job(i, finished=False)))
+            size = wal_size(self.database_path)
+            assert_that(size).is_greater_than(0)
+            assert_that(checkpoint_wal(connection, self.database_path, size + 1, size + 1)).is_equal_to((None, None))
+            mode, (busy, _, _) = checkpoint_wal(connection, self.database_path, size, size + 1)
+            assert_that(mode).is_equal_to(WAL_CHECKPOINT_PASSIVE)
+            assert_that(busy).is_equal_to(0)
+            assert_that(checkpoint_wal(connection, self.database_path, 0, size)[0]).is_equal_to(
+                WAL_CHECKPOINT_TRUNCATE
+            )
+            assert_that(wal_size(self.database_path)).is_equal_to(0)
+        finally:
+            pool.close_all()
@@ -0,0 +1,54 @@
+import unittest
+from assertpy import assert_that
+import tempfile
+import shutil
+import json
+import time
+import os
+
+from cron_tools.common.config import JSONSourcedConfiguration, ConfigurationException
+
+
+class ExampleConfiguration(JSONSourcedConfiguration):
+    REQUIRED_PARAMETERS = ['name']
+    OPTIONAL_PARAMETERS = {
+        'size': 1
+    }
+
+
+class CommonConfigurationUnitTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.config_path = os.path.join(self.tempdir, "config.json")
+        self.cache_directory = os.path.join(self.tempdir, "cache")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def write_config(self, raw_config, mtime):
+        with open(self.config_path, 'w') as f:
+            json.dump(raw_config, f)
+        os.utime(self.config_path, (mtime, mtime))
+
+    def test_cached_configuration_follows_file_changes(self):
+        now = time.time()
+        self.write_config({'name': 'first'}, now - 10)
+        config = ExampleConfiguration.from_file_cached(self.config_path, self.cache_directory)
+        assert_that(config.name).is_equal_to('first')
+        assert_that(config.size).is_equal_to(1)
+        assert_that(os.listdir(self.cache_directory)).is_length(1)
+
+        # Same size and mtime counts as unchanged, so this is served from the cache.
+        self.write_config({'name': 'other'}, now - 10)
+        assert_that(ExampleConfiguration.from_file_cached(self.config_path, self.cache_directory).name)\
+            .is_equal_to('first')
+
+        self.write_config({'name': 'second', 'size': 2}, now)
+        config = ExampleConfiguration.from_file_cached(self.config_path, self.cache_directory)
+        assert_that(config.name).is_equal_to('second')
+        assert_that(config.size).is_equal_to(2)
+
+        self.write_config({'size': 3}, now + 10)
+        self.assertRaises(
+            ConfigurationException, ExampleConfiguration.from_file_cached, self.config_path, self.cache_directory
+        )
@@ -0,0 +1,59 @@
+import unittest
+from assertpy import assert_that
+import threading
+import tempfile
+import shutil
+import signal
+import fcntl
+import time
+import os
+
+from cron_tools.common.flock import FlockLock, FlockTimeout
+
+
+class CommonFlockUnitTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.lock_path = os.path.join(self.tempdir, "lock")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_sub_second_timeout(self):
+        """
+        Ensure a held lock times out after a fractional timeout without touching SIGALRM.
+        """
+        original_handler = signal.getsignal(signal.SIGALRM)
+        holder = FlockLock.from_file(self.lock_path)
+        waiter = FlockLock.from_file(self.lock_path, timeout=0.2)
+        with holder:
+            started = time.time()
+            self.assertRaises(FlockTimeout, waiter.acquire)
+            assert_that(time.time() - started).is_between(0.2, 1.0)
+        assert_that(waiter.wait_time).is_greater_than_or_equal_to(0.2)
+        assert_that(signal.getsignal(signal.SIGALRM)).is_equal_to(original_handler)
+        with waiter:
+            assert_that(waiter.wait_time).is_less_than(0.2)
+        holder.close()
+        waiter.close()
+
+    def test_wait_time_and_shared_locks(self):
+        holder = FlockLock.from_file(self.lock_path)
+        waiter = FlockLock.from_file(self.lock_path, timeout=5)
+        holder.acquire()
+        releaser = threading.Timer(0.2, holder.release)
+        releaser.start()
+        with waiter:
+            assert_that(waiter.wait_time).is_between(0.15, 5)
+        releaser.join()
+
+        first = FlockLock.from_file(self.lock_path, timeout=0, flock_mode=fcntl.LOCK_SH)
+        second = FlockLock.from_file(self.lock_path, timeout=0, flock_mode=fcntl.LOCK_SH)
+        exclusive = FlockLock.from_file(self.lock_path, timeout=0)
+        with first:
+            with second:
+                self.assertRaises(FlockTimeout, exclusive.acquire)
+        with exclusive:
+            pass
+        for lock in (holder, waiter, first, second, exclusive):
+            lock.close()
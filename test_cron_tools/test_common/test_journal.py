@@ -0,0 +1,98 @@
+import unittest
+from assertpy import assert_that
+import tempfile
+import shutil
+import stat
+import os
+
+from cron_tools.common.journal import EventJournal, FSYNC_NEVER, DEFAULT_JOURNAL_MODE, RECORD_HEADER, decode_records
+
+
+class CommonJournalUnitTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.journal_path = os.path.join(self.tempdir, "journal")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def test_append_and_drain(self):
+        journal = EventJournal(self.journal_path, FSYNC_NEVER)
+        with journal.drain() as events:
+            assert_that(events).is_empty()
+
+        journal.append("add_new_job", {"raw_job_record": {"job_uuid": "a"}})
+        journal.append("update_job_end_time_and_status_code", {"job_uuid": "a", "job_status_code": 0})
+        with journal.drain() as events:
+            assert_that([e["method"] for e in events]).is_equal_to(
+                ["add_new_job", "update_job_end_time_and_status_code"]
+            )
+            assert_that(events[1]["params"]).is_equal_to({"job_uuid": "a", "job_status_code": 0})
+        assert_that(os.path.getsize(self.journal_path)).is_equal_to(0)
+
+    def test_failed_drain_keeps_events(self):
+        """
+        Ensure the journal is only truncated once the events have been handled successfully.
+        """
+        journal = EventJournal(self.journal_path)
+        journal.append("add_new_job", {})
+        try:
+            with journal.drain() as events:
+                assert_that(events).is_length(1)
+                raise ValueError("ingest failed")
+        except ValueError:
+            pass
+        with journal.drain() as events:
+            assert_that(events).is_length(1)
+
+    def test_incomplete_record_is_discarded(self):
+        journal = EventJournal(self.journal_path)
+        journal.append("add_new_job", {})
+        with open(self.journal_path, 'ab') as f:
+            f.write(b"\x00\x00\x01\x00{\"method\"")
+        with journal.drain() as events:
+            assert_that(events).is_length(1)
+        assert_that(os.path.getsize(self.journal_path)).is_equal_to(0)
+
+    def test_journal_mode_ignores_umask(self):
+        """
+        Ensure the journal gets its mode whether the agent or a wrapper creates it, whatever their umask.
+        """
+        previous_umask = os.umask(0o077)
+        try:
+            EventJournal(self.journal_path).append("add_new_job", {})
+            assert_that(stat.S_IMODE(os.stat(self.journal_path).st_mode)).is_equal_to(DEFAULT_JOURNAL_MODE)
+            os.chmod(self.journal_path, 0o600)
+            EventJournal(self.journal_path, mode=0o620).prepare(group=os.getgid())
+            assert_that(stat.S_IMODE(os.stat(self.journal_path).st_mode)).is_equal_to(0o620)
+            other_journal_path = os.path.join(self.tempdir, "other-journal")
+            EventJournal(other_journal_path).prepare()
+            assert_that(stat.S_IMODE(os.stat(other_journal_path).st_mode)).is_equal_to(DEFAULT_JOURNAL_MODE)
+        finally:
+            os.umask(previous_umask)
+        with EventJournal(self.journal_path).drain() as events:
+            assert_that(events).is_length(1)
+
+    def test_bad_records_are_quarantined(self):
+        """
+        Ensure undecodable records and events quarantined while draining are moved to the quarantine file, and do
+        not keep the rest of the journal from being drained.
+        """
+        journal = EventJournal(self.journal_path, FSYNC_NEVER)
+        journal.append("add_new_job", {"raw_job_record": {"job_uuid": "a"}})
+        with open(self.journal_path, 'ab') as f:
+            f.write(RECORD_HEADER.pack(3) + b"\xff{[")
+        journal.append("update_job_end_time_and_status_code", {"job_uuid": "a"})
+        self.assertRaises(RuntimeError, journal.quarantine, {})
+        with journal.drain() as events:
+            assert_that([e["method"] for e in events]).is_equal_to(
+                ["add_new_job", "update_job_end_time_and_status_code"]
+            )
+            journal.quarantine(events[1])
+        assert_that(os.path.getsize(self.journal_path)).is_equal_to(0)
+        with open(journal.quarantine_path, 'rb') as f:
+            quarantined = f.read()
+        assert_that(quarantined[:RECORD_HEADER.size + 3]).is_equal_to(RECORD_HEADER.pack(3) + b"\xff{[")
+        assert_that(decode_records(quarantined[RECORD_HEADER.size + 3:])).is_equal_to(
+            ([{"method": "update_job_end_time_and_status_code", "params": {"job_uuid": "a"}}], len(quarantined) - 7)
+        )
@@ -4,11 +4,26 @@ from six import binary_type
 import threading
 import tempfile
 import shutil
+import socket
+import time
+import sys
 import os
 
 from cron_tools.common.rpc import BaseRPCClientHandler, BaseRPCServerHandler, RPCException
-from cron_tools.common.rpc_client import RPCClient
+from cron_tools.common.rpc_client import RPCClient, RPCClientPool, MultiplexedRPCClient, RPCConnectionError, \
+    SeqpacketRPCClient, DatagramRPCClient, RPCMessageTooLarge
+from cron_tools.common.rpc_codecs import CODECS, COMPACT_CODEC, JSON_CODEC, get_codec, codec_for_magic_byte
 from cron_tools.agent.rpc_server import AgentUnixStreamRPCServer
+from cron_tools.benchmarks.rpc_codecs import run_benchmark
+
+# The asyncio server is written for Python 3.7 and later, so its tests import it lazily and skip themselves before.
+ASYNCIO_SERVER_SUPPORTED = sys.version_info >= (3, 7)
+ASYNCIO_SERVER_SKIP_REASON = "The asyncio RPC server requires Python 3.7 or later."
+
+
+def asyncio_server_class():
+    from cron_tools.agent.async_rpc_server import AsyncioUnixStreamRPCServer
+    return AsyncioUnixStreamRPCServer
 
 
 class CommonRPCCodeUnitTestCases(unittest.TestCase):
@@ -33,10 +48,155 @@ class CommonRPCCodeUnitTestCases(unittest.TestCase):
         assert_that(raw_request).is_instance_of(binary_type)
         assert_that(server_resp).is_instance_of(binary_type)
 
+    def test_rpc_notifications(self):
+        """
+        Ensure notifications are executed by the server handler without producing any response.
+        """
+        calls = []
+
+        def record(value):
+            calls.append(value)
+            return value
+
+        def faulty():
+            raise ValueError("???")
+
+        client_handler = BaseRPCClientHandler()
+        server_handler = BaseRPCServerHandler()
+        server_handler.register_function("record", record)
+        server_handler.register_function("faulty", faulty)
+
+        for name, params in (("record", {"value": 1}), ("faulty", {}), ("missing", {})):
+            raw_notification = client_handler.marshal_notification(name, params)
+            assert_that(server_handler.handle_request(raw_notification)).is_none()
+        assert_that(calls).is_equal_to([1])
+
+    def test_rpc_stats(self):
+        """
+        Ensure the server handler records calls, errors, payload sizes and latency percentiles per method.
+        """
+        def faulty():
+            raise ValueError("???")
+
+        client_handler = BaseRPCClientHandler()
+        server_handler = BaseRPCServerHandler()
+        server_handler.register_function("sleep", lambda seconds: time.sleep(seconds))
+        server_handler.register_function("faulty", faulty)
+
+        request_bytes = response_bytes = 0
+        for seconds in [0.0] * 8 + [0.02, 0.05]:
+            raw_request = client_handler.marshal_request("sleep", {"seconds": seconds})
+            raw_response = server_handler.handle_request(raw_request)
+            request_bytes += len(raw_request)
+            response_bytes += len(raw_response)
+        server_handler.handle_request(client_handler.marshal_request("faulty", {}))
+        server_handler.handle_request(client_handler.marshal_notification("faulty", {}))
+        server_handler.handle_request(client_handler.marshal_request("missing", {}))
+        raw_batch, _ = client_handler.marshal_batch([("sleep", {"seconds": 0}), ("faulty", {})])
+        server_handler.handle_request(raw_batch)
+
+        stats = server_handler.stats.snapshot()['methods']
+        assert_that(stats).contains_only("sleep", "faulty", "(batch)")
+        sleep_stats = stats["sleep"]
+        assert_that(sleep_stats).has_calls(11).has_errors(0).has_in_flight(0)
+        assert_that(sleep_stats['request_bytes']).is_equal_to(request_bytes)
+        assert_that(sleep_stats['response_bytes']).is_equal_to(response_bytes)
+        assert_that(sleep_stats['p50_seconds']).is_less_than(0.01)
+        assert_that(sleep_stats['p99_seconds']).is_between(0.05, 0.05 * 1.2)
+        assert_that(sleep_stats['p99_seconds']).is_less_than_or_equal_to(sleep_stats['max_seconds'])
+        assert_that(sum(count for _, count in sleep_stats['latency_histogram'])).is_equal_to(11)
+        assert_that(stats["faulty"]).has_calls(3).has_errors(3)
+        assert_that(stats["(batch)"]['request_bytes']).is_equal_to(len(raw_batch))
+        assert_that(stats["(batch)"]['calls']).is_equal_to(0)
+
+    def test_rpc_batches(self):
+        """
+        Ensure batches are answered per request, and only batches with writes run inside the batch transaction.
+        """
+        transactions = []
+
+        def recording_transaction(function):
+            transactions.append("begin")
+            result = function()
+            transactions.append("commit")
+            return result
+
+        client_handler = BaseRPCClientHandler()
+        server_handler = BaseRPCServerHandler(batch_transaction=recording_transaction)
+        server_handler.register_function("add", lambda a, b: a + b)
+        server_handler.register_function("store", lambda value: value, write=True)
+
+        raw_request, ids = client_handler.marshal_batch([("add", {"a": 1, "b": 2}), ("missing", {}), ("add", {})])
+        results = client_handler.unmarshal_batch_response(server_handler.handle_request(raw_request), ids)
+        assert_that(results[0]).is_equal_to(3)
+        assert_that(results[1]).is_instance_of(RPCException)
+        assert_that(results[2]).is_instance_of(RPCException)
+        assert_that(transactions).is_empty()
+
+        raw_request, ids = client_handler.marshal_batch([("store", {"value": 1}), ("add", {"a": 1, "b": 1})])
+        results = client_handler.unmarshal_batch_response(server_handler.handle_request(raw_request), ids)
+        assert_that(results).is_equal_to([1, 2])
+        assert_that(transactions).is_equal_to(["begin", "commit"])
+
+        notifications = b"[" + client_handler.marshal_notification("store", {"value": 1}) + b"]"
+        assert_that(server_handler.handle_request(notifications)).is_none()
+        self.assertRaises(
+            RPCException, client_handler.unmarshal_batch_response, server_handler.handle_request(b"[]"), []
+        )
+
+    def test_rpc_codecs_round_trip(self):
+        """
+        Ensure every available codec round trips the value types the agent protocol uses and rejects garbage.
+        """
+        payload = {
+            "json-rpc": "2.0", "id": 12345, "method": "add_new_job",
+            "params": {
+                "job_uuid": "abc", "job_args": ["sh", "-c", "echo \u00e9"], "job_status_code": -9,
+                "big": 2 ** 40, "negative": -2 ** 40, "ratio": 0.25, "flags": [True, False, None], "nested": {"a": {}}
+            }
+        }
+        for codec in CODECS:
+            if not codec.available():
+                continue
+            encoded = codec.encode(payload)
+            assert_that(encoded).is_instance_of(binary_type)
+            assert_that(codec.decode(encoded)).is_equal_to(payload)
+            assert_that(codec_for_magic_byte(codec.magic_byte)).is_same_as(codec)
+            self.assertRaises(ValueError, codec.decode, encoded[:-1])
+        assert_that(len(COMPACT_CODEC.encode(payload))).is_less_than(len(JSON_CODEC.encode(payload)))
+        raw_bytes = {"data": b"\x00\xff", "huge": 2 ** 70}
+        assert_that(COMPACT_CODEC.decode(COMPACT_CODEC.encode(raw_bytes))).is_equal_to(raw_bytes)
+        assert_that(get_codec("binary").name).is_in("msgpack", "compact")
+        assert_that(codec_for_magic_byte(b"\x00")).is_none()
+        self.assertRaises(ValueError, get_codec, "xml")
+
+        server_handler = BaseRPCServerHandler()
+        server_handler.register_function("add", lambda a, b: a + b)
+        client_handler = BaseRPCClientHandler(COMPACT_CODEC)
+        raw_request = client_handler.marshal_request("add", {"a": 1, "b": 2})
+        raw_response = server_handler.handle_request(raw_request, COMPACT_CODEC)
+        assert_that(client_handler.unmarshal_response(raw_response)).is_equal_to(3)
+
+        results = run_benchmark(repeat=1, recent_jobs=20, chunk_kb=4)
+        assert_that(results).contains_key("add_new_job", "get_recent_jobs", "append_job_output")
+        for by_codec in results.values():
+            assert_that(by_codec).contains_key("json", "compact")
+            assert_that([r["round_trips"] for r in by_codec.values()]).does_not_contain(False)
+
     def test_actual_client_and_server_rpc(self):
         """
         Test the agent and wrapper RPC implementations.
         """
+        self.check_client_and_server_rpc(AgentUnixStreamRPCServer)
+
+    @unittest.skipIf(not ASYNCIO_SERVER_SUPPORTED, ASYNCIO_SERVER_SKIP_REASON)
+    def test_actual_client_and_asyncio_server_rpc(self):
+        """
+        Test the wrapper RPC implementation against the asyncio server.
+        """
+        self.check_client_and_server_rpc(asyncio_server_class())
+
+    def check_client_and_server_rpc(self, server_class):
         tempdir = tempfile.mkdtemp()
 
         def add(a, b):
@@ -50,7 +210,7 @@ class CommonRPCCodeUnitTestCases(unittest.TestCase):
 
         try:
             socket_path = os.path.join(tempdir, "test.socket")
-            server = AgentUnixStreamRPCServer(socket_path)
+            server = server_class(socket_path)
             server.register_function("cat", cat)
             server.register_function("add", add)
             server.register_function("faulty", faulty)
@@ -70,9 +230,248 @@ class CommonRPCCodeUnitTestCases(unittest.TestCase):
                 RPCException, client.handle_rpc_call,
                 "faulty", {}
             )
+            client.send_notification("faulty", {})
+            client.send_notification("add", {"a": 1, "b": 1})
+            assert_that(client.handle_rpc_call("add", {"a": 2, "b": 2})).is_equal_to(4)
+            batch_results = client.handle_rpc_batch([("add", {"a": 1, "b": 2}), ("cat", {"a": "x", "b": "y"})])
+            assert_that(batch_results).is_equal_to([3, "x y"])
+            # Clients using other codecs share the same server, each answered in its own codec.
+            for codec in ("compact", "binary"):
+                binary_client = RPCClient(socket_path, codec=codec)
+                assert_that(binary_client.handle_rpc_call("cat", {"a": "foo", "b": "bar"})).is_equal_to("foo bar")
+                self.assertRaises(RPCException, binary_client.handle_rpc_call, "faulty", {})
+                binary_client.disconnect()
             client.disconnect()
             server.shutdown()
             server.server_close()
             server_thread.join(5)
         finally:
             shutil.rmtree(tempdir)
+
+    def test_rpc_client_robustness(self):
+        """
+        Ensure the client copes with large responses, timeouts, stale connections and use from many threads.
+        """
+        tempdir = tempfile.mkdtemp()
+        server = server_thread = None
+        try:
+            socket_path = os.path.join(tempdir, "test.socket")
+            server = AgentUnixStreamRPCServer(socket_path)
+            server.register_function("echo", lambda value: value)
+            server.register_function("big", lambda size: "x" * size)
+            server.register_function("slow", lambda seconds: time.sleep(seconds))
+            server_thread = threading.Thread(target=server.serve_forever)
+            server_thread.start()
+
+            client = RPCClient(socket_path, timeout=5, reconnect_attempts=2)
+            for size in (10, 200 * 1024, 5 * 1024 * 1024, 10):
+                assert_that(client.handle_rpc_call("big", {"size": size})).is_length(size)
+
+            # A connection the agent has closed is replaced before anything is sent on it.
+            stale, peer = socket.socketpair()
+            peer.close()
+            client.disconnect()
+            client.socket = stale
+            assert_that(client.handle_rpc_call("echo", {"value": 1})).is_equal_to(1)
+
+            impatient_client = RPCClient(socket_path, timeout=0.1)
+            self.assertRaises(socket.timeout, impatient_client.handle_rpc_call, "slow", {"seconds": 0.5})
+            assert_that(impatient_client.socket).is_none()
+            assert_that(impatient_client.handle_rpc_call("echo", {"value": 2})).is_equal_to(2)
+            impatient_client.disconnect()
+
+            started = time.time()
+            missing_client = RPCClient(os.path.join(tempdir, "missing"), reconnect_attempts=2, reconnect_backoff=0.05)
+            self.assertRaises(IOError, missing_client.connect)
+            assert_that(time.time() - started).is_between(0.15, 2)
+
+            pool = RPCClientPool(socket_path, size=2, timeout=5)
+            results = []
+
+            def call_repeatedly(offset):
+                for i in range(20):
+                    results.append(pool.handle_rpc_call("echo", {"value": offset + i}) == offset + i)
+
+            threads = [threading.Thread(target=call_repeatedly, args=(n * 100,)) for n in range(6)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(10)
+            assert_that(results).is_length(120).does_not_contain(False)
+            assert_that(len(pool._idle)).is_between(1, 2)
+            pool.close()
+            client.disconnect()
+        finally:
+            if server is not None:
+                server.shutdown()
+                server.server_close()
+            if server_thread is not None:
+                server_thread.join(5)
+            shutil.rmtree(tempdir)
+
+    @unittest.skipIf(not ASYNCIO_SERVER_SUPPORTED, ASYNCIO_SERVER_SKIP_REASON)
+    def test_asyncio_server_multiplexes_connections(self):
+        """
+        Ensure the asyncio server serves many simultaneous connections with its fixed handful of threads.
+        """
+        tempdir = tempfile.mkdtemp()
+        server = server_thread = None
+        clients = []
+        try:
+            socket_path = os.path.join(tempdir, "test.socket")
+            server = asyncio_server_class()(socket_path, executor_workers=2)
+            server.register_function("echo", lambda value: value)
+            server_thread = threading.Thread(target=server.serve_forever)
+            server_thread.start()
+            threads_before = threading.active_count()
+            clients = [RPCClient(socket_path, timeout=5) for _ in range(300)]
+            for i, client in enumerate(clients):
+                client.connect()
+            for i, client in enumerate(clients):
+                assert_that(client.handle_rpc_call("echo", {"value": i})).is_equal_to(i)
+            assert_that(server.connection_count).is_equal_to(300)
+            assert_that(threading.active_count() - threads_before).is_less_than_or_equal_to(2)
+        finally:
+            for client in clients:
+                client.disconnect()
+            if server is not None:
+                server.shutdown()
+                server.server_close()
+            if server_thread is not None:
+                server_thread.join(5)
+            shutil.rmtree(tempdir)
+
+    def test_multiplexed_client_pipelines_requests(self):
+        """
+        Ensure calls overlap on one connection, reads completing out of order while writes keep their order.
+        """
+        self.check_multiplexed_client_pipelining(AgentUnixStreamRPCServer)
+
+    @unittest.skipIf(not ASYNCIO_SERVER_SUPPORTED, ASYNCIO_SERVER_SKIP_REASON)
+    def test_multiplexed_client_pipelines_requests_asyncio(self):
+        """
+        Ensure the multiplexed client pipelines requests to the asyncio server too.
+        """
+        self.check_multiplexed_client_pipelining(asyncio_server_class())
+
+    def check_multiplexed_client_pipelining(self, server_class):
+        tempdir = tempfile.mkdtemp()
+        server = server_thread = None
+        try:
+            socket_path = os.path.join(tempdir, "test.socket")
+            server = server_class(socket_path)
+            written = []
+            server.register_function("echo", lambda value: value)
+            server.register_function("slow", lambda seconds: time.sleep(seconds) or seconds)
+            server.register_function("write", lambda value: written.append(value) or list(written), write=True)
+            server_thread = threading.Thread(target=server.serve_forever)
+            server_thread.start()
+
+            client = MultiplexedRPCClient(socket_path, timeout=5)
+            slow = client.call_async("slow", {"seconds": 0.3})
+            echoes = [client.call_async("echo", {"value": i}) for i in range(20)]
+            assert_that([client.wait(future) for future in echoes]).is_equal_to(list(range(20)))
+            if server_class is not AgentUnixStreamRPCServer:
+                # The reads behind the slow one were answered without waiting for it.
+                assert_that(slow.done()).is_false()
+            assert_that(client.wait(slow)).is_equal_to(0.3)
+
+            writes = client.map_rpc_calls([("write", {"value": i}) for i in range(5)])
+            assert_that(writes[-1]).is_equal_to(list(range(5)))
+            assert_that(client.handle_rpc_batch([("echo", {"value": "a"}), ("missing", {})])[1]).is_instance_of(
+                RPCException
+            )
+
+            # A caller giving up leaves the connection usable; the late response is dropped.
+            impatient = MultiplexedRPCClient(socket_path, timeout=0.05)
+            self.assertRaises(socket.timeout, impatient.handle_rpc_call, "slow", {"seconds": 0.2})
+            time.sleep(0.3)
+            assert_that(impatient.handle_rpc_call("echo", {"value": "still here"})).is_equal_to("still here")
+            impatient.disconnect()
+
+            results = []
+
+            def call_repeatedly(offset):
+                for i in range(20):
+                    results.append(client.handle_rpc_call("echo", {"value": offset + i}) == offset + i)
+
+            threads = [threading.Thread(target=call_repeatedly, args=(n * 100,)) for n in range(5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(10)
+            assert_that(results).is_length(100).does_not_contain(False)
+
+            pending = client.call_async("slow", {"seconds": 0.5})
+            client.disconnect()
+            self.assertRaises(RPCConnectionError, pending.result, 1)
+            assert_that(client.handle_rpc_call("echo", {"value": 1})).is_equal_to(1)
+            client.disconnect()
+        finally:
+            if server is not None:
+                server.shutdown()
+                server.server_close()
+            if server_thread is not None:
+                server_thread.join(5)
+            shutil.rmtree(tempdir)
+
+    def test_seqpacket_and_datagram_transports(self):
+        """
+        Ensure the server serves its functions on seqpacket and datagram listeners next to the stream socket.
+        """
+        self.check_seqpacket_and_datagram_transports(AgentUnixStreamRPCServer)
+
+    @unittest.skipIf(not ASYNCIO_SERVER_SUPPORTED, ASYNCIO_SERVER_SKIP_REASON)
+    def test_seqpacket_and_datagram_transports_asyncio(self):
+        """
+        Ensure the asyncio server serves seqpacket and datagram listeners too.
+        """
+        self.check_seqpacket_and_datagram_transports(asyncio_server_class())
+
+    def check_seqpacket_and_datagram_transports(self, server_class):
+        tempdir = tempfile.mkdtemp()
+        server = server_thread = None
+        try:
+            socket_path = os.path.join(tempdir, "test.socket")
+            server = server_class(socket_path)
+            server.add_listener(socket.SOCK_SEQPACKET, socket_path + ".seqpacket")
+            server.add_listener(socket.SOCK_DGRAM, socket_path + ".datagram")
+            recorded = []
+            server.register_function("echo", lambda value: value)
+            server.register_function("big", lambda size: "x" * size)
+            server.register_function("record", lambda value: recorded.append(value))
+            server_thread = threading.Thread(target=server.serve_forever)
+            server_thread.start()
+
+            for codec in ("json", "compact"):
+                client = SeqpacketRPCClient(socket_path + ".seqpacket", timeout=5, codec=codec)
+                assert_that(client.handle_rpc_call("echo", {"value": [1, "two"]})).is_equal_to([1, "two"])
+                assert_that(client.handle_rpc_call("big", {"size": 100000})).is_length(100000)
+                self.assertRaises(RPCException, client.handle_rpc_call, "big", {"size": 300 * 1024})
+                self.assertRaises(RPCMessageTooLarge, client.handle_rpc_call, "echo", {"value": "y" * 300 * 1024})
+                client.send_notification("record", {"value": "seqpacket"})
+                # Messages are received whole; the stream client's byte level reads are not there.
+                assert_that(hasattr(client, "recv_bytes")).is_false()
+                assert_that(client.handle_rpc_batch([("echo", {"value": 1}), ("echo", {"value": 2})])).is_equal_to(
+                    [1, 2]
+                )
+                client.disconnect()
+
+            datagram_client = DatagramRPCClient(socket_path + ".datagram", timeout=5)
+            for i in range(100):
+                datagram_client.send_notification("record", {"value": i})
+            # Datagrams are never answered, so the datagram client has no way to make a call.
+            assert_that(hasattr(datagram_client, "handle_rpc_call")).is_false()
+            for _ in range(50):
+                if len(recorded) == 102:
+                    break
+                time.sleep(0.05)
+            assert_that(recorded[2:]).is_equal_to(list(range(100)))
+            datagram_client.disconnect()
+        finally:
+            if server is not None:
+                server.shutdown()
+                server.server_close()
+            if server_thread is not None:
+                server_thread.join(5)
+            shutil.rmtree(tempdir)
@@ -0,0 +1,87 @@
+import unittest
+from assertpy import assert_that
+import tempfile
+import shutil
+import uuid
+import time
+import os
+
+from cron_tools.common.output import remove_old_spool_files
+from cron_tools.wrapper.capture import CapturedStream, open_spool_file, spool_file_path
+
+
+class RecordingLogger(object):
+    def __init__(self):
+        self.messages = []
+
+    def info(self, message):
+        self.messages.append(message)
+
+
+class WrapperCaptureUnitTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def pump_until_closed(self, stream):
+        while not stream.closed:
+            stream.pump()
+
+    def test_capture_to_spool_file(self):
+        """
+        Ensure captured bytes end up in the spool file unchanged, whether moved with splice or copied.
+        """
+        payload = b"".join(b"line " + str(i).encode('ascii') + b"\n" for i in range(10000))
+        for mirror in (None, RecordingLogger()):
+            read_fd, write_fd = os.pipe()
+            path = spool_file_path(os.path.join(self.tempdir, "spool"), "job-uuid", "stdout")
+            stream = CapturedStream(read_fd, "stdout", spool_fd=open_spool_file(path), mirror_logger=mirror)
+            written = 0
+            while written < len(payload):
+                written += os.write(write_fd, payload[written:written + 4096])
+                stream.pump()
+            os.close(write_fd)
+            self.pump_until_closed(stream)
+            assert_that(stream.bytes_captured).is_equal_to(len(payload))
+            with open(path, 'rb') as f:
+                assert_that(f.read()).is_equal_to(payload)
+
+    def test_mirrored_lines_crossing_chunk_boundaries(self):
+        """
+        Ensure lines split across reads are only logged once they are complete.
+        """
+        logger = RecordingLogger()
+        read_fd, write_fd = os.pipe()
+        stream = CapturedStream(read_fd, "stderr", mirror_logger=logger, buffer_size=7)
+        os.write(write_fd, b"first line\nsecond")
+        stream.pump()
+        stream.pump()
+        assert_that(logger.messages).is_equal_to(["CAPTURED (STDERR): first line"])
+        os.write(write_fd, b" half\nunterminated")
+        os.close(write_fd)
+        self.pump_until_closed(stream)
+        assert_that(logger.messages).is_equal_to([
+            "CAPTURED (STDERR): first line",
+            "CAPTURED (STDERR): second half",
+            "CAPTURED (STDERR): unterminated"
+        ])
+
+    def test_remove_old_spool_files(self):
+        """
+        Ensure only spool files older than the retention are removed, and that other files are left alone.
+        """
+        now = time.time()
+        old_uuid, new_uuid = str(uuid.uuid4()), str(uuid.uuid4())
+        paths = [
+            spool_file_path(self.tempdir, old_uuid, 'stdout'), spool_file_path(self.tempdir, old_uuid, 'stderr'),
+            spool_file_path(self.tempdir, new_uuid, 'stdout'), os.path.join(self.tempdir, 'agent.db')
+        ]
+        for path in paths:
+            os.close(open_spool_file(path))
+        for path in paths[:2] + paths[3:]:
+            os.utime(path, (now - 5 * 3600, now - 5 * 3600))
+        assert_that(remove_old_spool_files(self.tempdir, 4, now=now)).is_equal_to(2)
+        assert_that(sorted(os.listdir(self.tempdir))).is_equal_to(sorted(os.path.basename(p) for p in paths[2:]))
+        assert_that(remove_old_spool_files(os.path.join(self.tempdir, 'missing'), 4)).is_equal_to(0)
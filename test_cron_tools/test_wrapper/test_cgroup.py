@@ -0,0 +1,71 @@
+import unittest
+from assertpy import assert_that
+import tempfile
+import shutil
+import os
+
+from cron_tools.wrapper.cgroup import JobCgroup, CgroupUnavailable
+
+
+class WrapperCgroupUnitTests(unittest.TestCase):
+    """
+    Exercise the cgroup handling against a plain directory laid out like a delegated cgroup v2 subtree, so these
+    run on any box regardless of how its cgroups are set up.
+    """
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.write("cgroup.procs", "")
+        self.write("cgroup.controllers", "cpu io memory pids\n")
+        self.write("cgroup.subtree_control", "cpu\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def write(self, name, content):
+        with open(os.path.join(self.tempdir, name), 'w') as f:
+            f.write(content)
+
+    def read(self, name):
+        with open(os.path.join(self.tempdir, name)) as f:
+            return f.read()
+
+    def test_unavailable_cgroup(self):
+        self.assertRaises(CgroupUnavailable, JobCgroup.create, os.path.join(self.tempdir, "missing"), "job")
+
+    def test_create_limit_and_read_usage(self):
+        # A plain directory gets no cgroup.procs file when created, which looks like a subtree we may not use.
+        self.assertRaises(CgroupUnavailable, JobCgroup.create, self.tempdir, "job", {"cpu.weight": 10})
+        assert_that(os.path.exists(os.path.join(self.tempdir, "job"))).is_false()
+        assert_that(self.read("cgroup.subtree_control")).is_equal_to("+memory +io +pids")
+
+        os.mkdir(os.path.join(self.tempdir, "existing"))
+        self.write("existing/cgroup.procs", "")
+        job_cgroup = JobCgroup(os.path.join(self.tempdir, "existing"))
+        job_cgroup.apply_limits({"cpu.weight": 10, "memory.high": "512M", "missing/io.weight": 50})
+        assert_that(self.read("existing/cpu.weight")).is_equal_to("10")
+        assert_that(self.read("existing/memory.high")).is_equal_to("512M")
+        assert_that(job_cgroup.limit_errors).contains_key("missing/io.weight")
+
+        job_cgroup.add_process(1234)
+        assert_that(self.read("existing/cgroup.procs")).is_equal_to("1234")
+
+        self.write("existing/cpu.stat", "usage_usec 2500000\nuser_usec 2000000\nsystem_usec 500000\n")
+        self.write("existing/memory.peak", "1048576\n")
+        self.write("existing/io.stat", "8:0 rbytes=10 wbytes=20 rios=1 wios=2 dbytes=0 dios=0\n"
+                                       "8:16 rbytes=5 wbytes=5 rios=1 wios=1 dbytes=0 dios=0\n")
+        self.write("existing/pids.peak", "7\n")
+        self.write("existing/cgroup.events", "populated 0\nfrozen 0\n")
+        assert_that(job_cgroup.read_usage()).is_equal_to({
+            'cpu_usage_seconds': 2.5,
+            'cpu_user_seconds': 2.0,
+            'cpu_system_seconds': 0.5,
+            'memory_peak_bytes': 1048576,
+            'io_rbytes': 15,
+            'io_wbytes': 25,
+            'io_rios': 2,
+            'io_wios': 3,
+            'pids_peak': 7
+        })
+        assert_that(job_cgroup.populated()).is_false()
+        assert_that(job_cgroup.remove()).is_false()
@@ -0,0 +1,34 @@
+import unittest
+from assertpy import assert_that
+import time
+
+from cron_tools.wrapper.reporting import JobHeartbeat, monotonic
+
+
+class RecordingReporter(object):
+    def __init__(self):
+        self.heartbeats = []
+
+    def job_heartbeat(self, job_uuid, heartbeat_time):
+        self.heartbeats.append((job_uuid, heartbeat_time))
+        return True
+
+
+class WrapperHeartbeatUnitTests(unittest.TestCase):
+    def test_heartbeat_schedule(self):
+        """
+        Ensure heartbeats are only due once started and then once per interval, without bursts after a stall.
+        """
+        reporter = RecordingReporter()
+        heartbeat = JobHeartbeat(reporter, "job-uuid", 0.05)
+        assert_that(heartbeat.seconds_until_due()).is_none()
+        assert_that(heartbeat.run_if_due()).is_false()
+        heartbeat.start(monotonic())
+        assert_that(heartbeat.seconds_until_due()).is_between(0, 0.05)
+        assert_that(heartbeat.run_if_due()).is_false()
+        time.sleep(0.16)
+        assert_that(heartbeat.run_if_due()).is_true()
+        assert_that(heartbeat.run_if_due()).is_false()
+        assert_that(reporter.heartbeats).is_length(1)
+        assert_that(reporter.heartbeats[0][0]).is_equal_to("job-uuid")
+        assert_that(reporter.heartbeats[0][1]).is_close_to(time.time(), 1)
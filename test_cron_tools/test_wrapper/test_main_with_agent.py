@@ -3,9 +3,13 @@ from assertpy import assert_that
 import threading
 import tempfile
 import shutil
+import time
 import os
 
+from cron_tools.common.flock import FlockLock
+from cron_tools.common.journal import EventJournal
 from cron_tools.common.rpc_client import RPCClient
+from cron_tools.common.output import decode_output_chunk
 from cron_tools.agent.config import AgentConfiguration
 from cron_tools.agent.app import build_app, agent_argument_parser
 from cron_tools.wrapper.main import main, wrapper_argument_parser
@@ -17,10 +21,14 @@ class CronToolsWrapperIntegrationTest(unittest.TestCase):
         tempdir = tempfile.mkdtemp()
         socket_path = os.path.join(tempdir, "test.socket")
         database_path = os.path.join(tempdir, "test.db")
+        seqpacket_socket_path = os.path.join(tempdir, "test.seqpacket.socket")
+        datagram_socket_path = os.path.join(tempdir, "test.datagram.socket")
         raw_config = {
             "sqlite_database_path": database_path,
             "logging_config": {"version": 1, "incremental": True},
-            "listen_socket_path": socket_path
+            "listen_socket_path": socket_path,
+            "seqpacket_socket_path": seqpacket_socket_path,
+            "datagram_socket_path": datagram_socket_path
         }
         agent_config = AgentConfiguration.load(raw_config)
         agent_args = agent_argument_parser.parse_args(args=[])
@@ -46,7 +54,9 @@ class CronToolsWrapperIntegrationTest(unittest.TestCase):
                 'agent_socket_path': socket_path,
                 'logging_config': {"version": 1, "incremental": True}
             })
-            wrapper_args = wrapper_argument_parser.parse_args(args=["--job-name", "foo", "--", "sleep", "3"])
+            wrapper_args = wrapper_argument_parser.parse_args(
+                args=["--job-name", "foo", "-L", os.path.join(tempdir, "lock"), "-Lt", "0.5", "--", "sleep", "3"]
+            )
             try:
                 main(args=wrapper_args, config=wrapper_config)
             except SystemExit as e:
@@ -56,6 +66,150 @@ class CronToolsWrapperIntegrationTest(unittest.TestCase):
             assert_that(recent_jobs).contains_key("recent_jobs")
             assert_that(recent_jobs["recent_jobs"]).is_not_empty()
             assert_that(recent_jobs["recent_jobs"][0]["job_args"]).is_equal_to(["sleep", "3"])
+            assert_that(recent_jobs["recent_jobs"][0]["job_lock_wait_seconds"]).is_between(0, 0.5)
+
+            spool_directory = os.path.join(tempdir, "output")
+            wrapper_config = WrapperConfiguration.load({
+                'agent_socket_path': socket_path,
+                'output_spool_directory': spool_directory,
+                'logging_config': {"version": 1, "incremental": True}
+            })
+            wrapper_args = wrapper_argument_parser.parse_args(
+                args=["--job-name", "bar", "--capture-stdout", "--capture-stderr", "--sample-resources", "0.01", "--",
+                      "sh", "-c", "echo out; echo err 1>&2; exit 3"]
+            )
+            try:
+                main(args=wrapper_args, config=wrapper_config)
+            except SystemExit as e:
+                assert_that(e.code).is_equal_to(3)
+            recent_jobs = client.handle_rpc_call("get_recent_jobs", {"limit": None, "offset": None})
+            captured_job = [j for j in recent_jobs["recent_jobs"] if j["job_name"] == "bar"][0]
+            assert_that(captured_job["job_status_code"]).is_equal_to(3)
+            assert_that(captured_job["job_resource_usage"]).contains_key("user_cpu_seconds", "max_rss_kb")
+            assert_that(captured_job["job_resource_usage"]["process_tree"]["interval_seconds"]).is_equal_to(0.01)
+            with open(os.path.join(spool_directory, captured_job["job_uuid"] + ".stdout"), 'rb') as f:
+                assert_that(f.read()).is_equal_to(b"out\n")
+            with open(os.path.join(spool_directory, captured_job["job_uuid"] + ".stderr"), 'rb') as f:
+                assert_that(f.read()).is_equal_to(b"err\n")
+
+            wrapper_args = wrapper_argument_parser.parse_args(
+                args=["--job-name", "streamed", "--capture-stdout", "--stream-output", "--no-output-spool",
+                      "--stagger", "0.3", "--stagger-mode", "agent", "--", "sh", "-c", "seq 1 100000"]
+            )
+            try:
+                main(args=wrapper_args, config=wrapper_config)
+            except SystemExit as e:
+                assert_that(e.code).is_equal_to(0)
+            recent_jobs = client.handle_rpc_call("get_recent_jobs", {"limit": None, "offset": None})
+            streamed_job = [j for j in recent_jobs["recent_jobs"] if j["job_name"] == "streamed"][0]
+            assert_that(os.path.exists(os.path.join(spool_directory, streamed_job["job_uuid"] + ".stdout"))).is_false()
+            assert_that(streamed_job["job_start_delay_seconds"]).is_between(0, 0.3)
+            output = client.handle_rpc_call("get_job_output", {"job_uuid": streamed_job["job_uuid"]})
+            assert_that(b"".join(decode_output_chunk(c["data"]) for c in output["chunks"])).is_equal_to(
+                b"".join(str(i).encode('ascii') + b"\n" for i in range(1, 100001))
+            )
+
+            wrapper_args = wrapper_argument_parser.parse_args(
+                args=["--job-name", "notified", "--notify-agent", "--heartbeat-interval", "0.05", "--",
+                      "sh", "-c", "sleep 0.2; exit 4"]
+            )
+            try:
+                main(args=wrapper_args, config=wrapper_config)
+            except SystemExit as e:
+                assert_that(e.code).is_equal_to(4)
+            # Notifications are processed asynchronously by the agent, so give it a moment to catch up.
+            notified_jobs = []
+            for _ in range(50):
+                recent_jobs = client.handle_rpc_call("get_recent_jobs", {"limit": None, "offset": None})
+                notified_jobs = [
+                    j for j in recent_jobs["recent_jobs"]
+                    if j["job_name"] == "notified" and j["job_status_code"] is not None
+                ]
+                if notified_jobs:
+                    break
+                time.sleep(0.1)
+            assert_that(notified_jobs).is_length(1)
+            assert_that(notified_jobs[0]["job_status_code"]).is_equal_to(4)
+
+            for transport, report_mode in (("seqpacket", "call"), ("datagram", "notify")):
+                transport_config = WrapperConfiguration.load({
+                    'agent_socket_path': socket_path,
+                    'agent_transport': transport,
+                    'agent_report_mode': report_mode,
+                    'agent_seqpacket_socket_path': seqpacket_socket_path,
+                    'agent_datagram_socket_path': datagram_socket_path,
+                    'logging_config': {"version": 1, "incremental": True}
+                })
+                wrapper_args = wrapper_argument_parser.parse_args(
+                    args=["--job-name", transport, "--capture-stdout", "--stream-output", "--no-output-spool", "--",
+                          "sh", "-c", "head -c 600000 /dev/urandom | base64; exit 5"]
+                )
+                try:
+                    main(args=wrapper_args, config=transport_config)
+                except SystemExit as e:
+                    assert_that(e.code).is_equal_to(5)
+                message_jobs = []
+                for _ in range(50):
+                    recent_jobs = client.handle_rpc_call("get_recent_jobs", {"limit": None, "offset": None})
+                    message_jobs = [
+                        j for j in recent_jobs["recent_jobs"]
+                        if j["job_name"] == transport and j["job_status_code"] is not None
+                    ]
+                    if message_jobs:
+                        break
+                    time.sleep(0.1)
+                assert_that(message_jobs).is_length(1)
+                assert_that(message_jobs[0]["job_status_code"]).is_equal_to(5)
+                # The output chunks, too large for a message, went over the stream socket instead.
+                output = client.handle_rpc_call("get_job_output", {"job_uuid": message_jobs[0]["job_uuid"]})
+                assert_that(sum(c["raw_length"] for c in output["chunks"])).is_greater_than(600000)
+
+            run_parts_directory = os.path.join(tempdir, "parts")
+            os.mkdir(run_parts_directory)
+            for name, body, mode in (("10-first", "sleep 0.5", 0o755), ("20-second", "exit 2", 0o755),
+                                     ("30-third", "sleep 0.5", 0o755), ("40-backup.bak", "exit 9", 0o755),
+                                     ("50-disabled", "exit 9", 0o644)):
+                with open(os.path.join(run_parts_directory, name), 'w') as f:
+                    f.write("#!/bin/sh\n" + body + "\n")
+                os.chmod(os.path.join(run_parts_directory, name), mode)
+            wrapper_args = wrapper_argument_parser.parse_args(
+                args=["--run-parts", run_parts_directory, "--parallel", "2", "-t", "nightly"]
+            )
+            try:
+                main(args=wrapper_args, config=wrapper_config)
+            except SystemExit as e:
+                assert_that(e.code).is_equal_to(1)
+            recent_jobs = client.handle_rpc_call("get_recent_jobs", {"limit": None, "offset": None})
+            batch_jobs = sorted(
+                (j for j in recent_jobs["recent_jobs"] if j["job_name"].startswith("parts/")),
+                key=lambda j: j["job_name"]
+            )
+            assert_that([j["job_name"] for j in batch_jobs]).is_equal_to(
+                ["parts/10-first", "parts/20-second", "parts/30-third"]
+            )
+            assert_that([j["job_status_code"] for j in batch_jobs]).is_equal_to([0, 2, 0])
+            assert_that(batch_jobs[0]["job_tags"]).contains("nightly").is_length(2)
+            assert_that(set(tuple(j["job_tags"]) for j in batch_jobs)).is_length(1)
+
+            wrapper_config = WrapperConfiguration.load({
+                'agent_socket_path': socket_path,
+                'pressure_thresholds': {'loadavg_1m': -1},
+                'low_priority_tags': ['bulk'],
+                'logging_config': {"version": 1, "incremental": True}
+            })
+            wrapper_args = wrapper_argument_parser.parse_args(
+                args=["--job-name", "pressured", "-t", "bulk", "--pressure-max-delay", "0.1", "--pressure-action",
+                      "skip", "--", "sh", "-c", "exit 0"]
+            )
+            try:
+                main(args=wrapper_args, config=wrapper_config)
+            except SystemExit as e:
+                assert_that(e.code).is_equal_to(75)
+            recent_jobs = client.handle_rpc_call("get_recent_jobs", {"limit": None, "offset": None})
+            pressured_job = [j for j in recent_jobs["recent_jobs"] if j["job_name"] == "pressured"][0]
+            assert_that(pressured_job["job_status_code"]).is_equal_to(75)
+            assert_that(pressured_job["job_scheduling"]["deferral"]["decision"]).is_equal_to("skipped")
+            assert_that(pressured_job["job_scheduling"]["deferral"]["wait_seconds"]).is_between(0.1, 1)
         finally:
             if client:
                 client.disconnect()
@@ -66,3 +220,102 @@ class CronToolsWrapperIntegrationTest(unittest.TestCase):
             if server_thread is not None:
                 server_thread.join(5)
             shutil.rmtree(tempdir)
+
+    def test_wrapper_journal_fallback_and_agent_ingest(self):
+        """
+        Ensure runs are journaled while the agent is down and ingested once it starts.
+        """
+        tempdir = tempfile.mkdtemp()
+        socket_path = os.path.join(tempdir, "test.socket")
+        journal_path = os.path.join(tempdir, "journal")
+        shutdown = None
+        server_thread = None
+        client = None
+
+        try:
+            wrapper_config = WrapperConfiguration.load({
+                'agent_socket_path': socket_path,
+                'journal_path': journal_path,
+                'journal_fsync': 'never',
+                'logging_config': {"version": 1, "incremental": True}
+            })
+            for job_name, mode in (("fallback", "call"), ("journaled", "journal")):
+                wrapper_args = wrapper_argument_parser.parse_args(
+                    args=["--job-name", job_name, "--report-mode", mode, "--", "true"]
+                )
+                try:
+                    main(args=wrapper_args, config=wrapper_config)
+                except SystemExit as e:
+                    assert_that(e.code).is_equal_to(0)
+            assert_that(os.path.getsize(journal_path)).is_greater_than(0)
+
+            agent_config = AgentConfiguration.load({
+                "sqlite_database_path": os.path.join(tempdir, "test.db"),
+                "logging_config": {"version": 1, "incremental": True},
+                "listen_socket_path": socket_path,
+                "journal_path": journal_path
+            })
+            run, shutdown = build_app(args=agent_argument_parser.parse_args(args=[]), config=agent_config)
+            server_thread = threading.Thread(target=run)
+            server_thread.daemon = True
+            server_thread.start()
+            client = RPCClient(socket_path)
+            for _ in range(50):
+                try:
+                    recent_jobs = client.handle_rpc_call("get_recent_jobs", {"limit": None, "offset": None})
+                    break
+                except (IOError, OSError):
+                    client = RPCClient(socket_path)
+                    time.sleep(0.1)
+            assert_that(sorted(j["job_name"] for j in recent_jobs["recent_jobs"])).is_equal_to(
+                ["fallback", "journaled"]
+            )
+            assert_that([j["job_status_code"] for j in recent_jobs["recent_jobs"]]).is_equal_to([0, 0])
+            assert_that(os.path.getsize(journal_path)).is_equal_to(0)
+        finally:
+            if client:
+                client.disconnect()
+            if shutdown is not None:
+                shutdown()
+            if server_thread is not None:
+                server_thread.join(5)
+            shutil.rmtree(tempdir)
+
+    def test_wrapper_reports_lock_timeout(self):
+        """
+        Ensure a job whose lock file stays held past the timeout is reported as not run, with its lock wait.
+        """
+        tempdir = tempfile.mkdtemp()
+        journal_path = os.path.join(tempdir, "journal")
+        lock_path = os.path.join(tempdir, "lock")
+        holder = FlockLock.from_file(lock_path)
+        try:
+            wrapper_config = WrapperConfiguration.load({
+                'agent_socket_path': os.path.join(tempdir, "test.socket"),
+                'journal_path': journal_path,
+                'journal_fsync': 'never',
+                'output_spool_directory': os.path.join(tempdir, "output"),
+                'logging_config': {"version": 1, "incremental": True}
+            })
+            wrapper_args = wrapper_argument_parser.parse_args(
+                args=["--job-name", "locked", "--report-mode", "journal", "-L", lock_path, "-Lt", "0.2",
+                      "--capture-stdout", "--", "sh", "-c", "exit 0"]
+            )
+            with holder:
+                try:
+                    main(args=wrapper_args, config=wrapper_config)
+                    self.fail("The wrapper did not exit.")
+                except SystemExit as e:
+                    assert_that(e.code).is_equal_to(75)
+            # Nothing was set up for the job while waiting for the lock.
+            assert_that(os.path.exists(os.path.join(tempdir, "output"))).is_false()
+            with EventJournal(journal_path).drain() as events:
+                assert_that([e["method"] for e in events]).is_equal_to(
+                    ["add_new_job", "update_job_end_time_and_status_code"]
+                )
+                assert_that(events[0]["params"]["raw_job_record"]["job_name"]).is_equal_to("locked")
+                assert_that(events[0]["params"]["raw_job_record"]["job_lock_wait_seconds"]).is_between(0.2, 1)
+                assert_that(events[1]["params"]["job_status_code"]).is_equal_to(75)
+        finally:
+            holder.close()
+            shutil.rmtree(tempdir)
@@ -0,0 +1,92 @@
+import unittest
+from assertpy import assert_that
+import subprocess
+import tempfile
+import shutil
+import json
+import sys
+import os
+
+from cron_tools.wrapper.pressure import host_pressure, exceeded_thresholds, wait_for_pressure_relief, parse_ioprio, \
+    priority_settings
+
+PRESSURE_FILE = """some avg10={0:.2f} avg60=1.00 avg300=0.50 total=123456
+full avg10=0.00 avg60=0.00 avg300=0.00 total=0
+"""
+
+
+class WrapperPressureUnitTests(unittest.TestCase):
+    def setUp(self):
+        self.proc_root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.proc_root, "pressure"))
+        self.write_pressure(memory=0.0)
+        with open(os.path.join(self.proc_root, "loadavg"), "w") as f:
+            f.write("0.50 0.40 0.30 1/100 12345\n")
+
+    def tearDown(self):
+        shutil.rmtree(self.proc_root)
+
+    def write_pressure(self, memory):
+        for resource, value in (("cpu", 5.0), ("memory", memory), ("io", 1.5)):
+            with open(os.path.join(self.proc_root, "pressure", resource), "w") as f:
+                f.write(PRESSURE_FILE.format(value))
+
+    def test_host_pressure_snapshot(self):
+        """
+        Ensure PSI and loadavg are read into a flat snapshot that thresholds are checked against.
+        """
+        snapshot = host_pressure(self.proc_root)
+        assert_that(snapshot).contains_entry({"cpu_some_avg10": 5.0}, {"io_full_avg300": 0.0}, {"loadavg_1m": 0.5})
+        assert_that(snapshot).does_not_contain_key("cpu_some_total")
+        assert_that(exceeded_thresholds(snapshot, {"cpu_some_avg10": 4.0, "io_some_avg10": 2.0})).is_equal_to(
+            ["cpu_some_avg10"]
+        )
+        os.remove(os.path.join(self.proc_root, "pressure", "io"))
+        assert_that(host_pressure(self.proc_root)).does_not_contain_key("io_some_avg10")
+
+    def test_deferral_decisions(self):
+        """
+        Ensure jobs run at once without pressure, and are deferred or skipped once the bounded delay is up.
+        """
+        thresholds = {"memory_some_avg10": 10.0}
+        decision = wait_for_pressure_relief(thresholds, 1, 0.01, proc_root=self.proc_root)
+        assert_that(decision).contains_entry({"decision": "ran"}, {"exceeded": []})
+        assert_that(decision["wait_seconds"]).is_less_than(0.01)
+
+        self.write_pressure(memory=50.0)
+        for action, expected in (("run", "deferred"), ("skip", "skipped")):
+            decision = wait_for_pressure_relief(thresholds, 0.05, 0.01, action, proc_root=self.proc_root)
+            assert_that(decision).contains_entry({"decision": expected}, {"exceeded": ["memory_some_avg10"]})
+            assert_that(decision["wait_seconds"]).is_between(0.05, 1)
+
+    def test_priority_settings(self):
+        """
+        Ensure priority tags are merged with the flags winning, and I/O priorities are parsed.
+        """
+        priority_tags = {"batch": {"nice": 10, "sched_batch": True}, "bulk": {"nice": 19, "ioprio": "idle"}}
+        assert_that(priority_settings(["batch", "bulk"], priority_tags)).is_equal_to(
+            {"nice": 19, "ioprio": "idle", "sched_batch": True}
+        )
+        assert_that(priority_settings(["batch"], priority_tags, nice=5, ioprio="be:7")).is_equal_to(
+            {"nice": 5, "ioprio": "be:7", "sched_batch": True}
+        )
+        assert_that(parse_ioprio("idle")).is_equal_to(3 << 13)
+        assert_that(parse_ioprio("best-effort:7")).is_equal_to((2 << 13) | 7)
+        assert_that(parse_ioprio).raises(ValueError).when_called_with("be:8")
+        assert_that(parse_ioprio).raises(ValueError).when_called_with("fast")
+
+    def test_apply_priority(self):
+        """
+        Ensure the priorities are applied to the calling process (run in a child to leave the test runner alone).
+        """
+        output = subprocess.check_output([sys.executable, "-c", (
+            "import os, json\n"
+            "from cron_tools.wrapper.pressure import apply_priority\n"
+            "applied, errors = apply_priority(nice=os.getpriority(os.PRIO_PROCESS, 0) + 1, ioprio='idle', "
+            "sched_batch=True)\n"
+            "print(json.dumps([sorted(applied), errors, os.sched_getscheduler(0) == os.SCHED_BATCH]))"
+        )])
+        applied, errors, sched_batch = json.loads(output.decode("utf-8"))
+        assert_that(errors).is_empty()
+        assert_that(applied).is_equal_to(["ioprio", "nice", "sched_batch"])
+        assert_that(sched_batch).is_true()
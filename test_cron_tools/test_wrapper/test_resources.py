@@ -0,0 +1,42 @@
+import unittest
+from assertpy import assert_that
+import subprocess
+import time
+import os
+
+from cron_tools.wrapper.resources import ProcessTreeSampler, rusage_summary
+from cron_tools.wrapper.supervisor import monotonic
+
+
+class WrapperResourceAccountingUnitTests(unittest.TestCase):
+    def test_process_tree_sampler(self):
+        """
+        Ensure the sampler walks the whole process tree and keeps a bounded set of running maxima.
+        """
+        process = subprocess.Popen(["sh", "-c", "sleep 2 & sleep 2 & wait"])
+        try:
+            time.sleep(0.3)
+            sampler = ProcessTreeSampler(0.01)
+            sampler.start(process.pid, monotonic())
+            for _ in range(5):
+                sampler.sample()
+            summary = sampler.summary()
+            assert_that(summary['samples']).is_equal_to(5)
+            assert_that(summary['max_tree_processes']).is_equal_to(3)
+            assert_that(summary['max_tree_rss_kb']).is_greater_than(0)
+            assert_that(summary['overhead_seconds']).is_greater_than_or_equal_to(0)
+            assert_that(len(sampler.__dict__)).is_equal_to(len(ProcessTreeSampler(1).__dict__))
+        finally:
+            process.kill()
+            process.wait()
+
+    def test_rusage_summary(self):
+        process = subprocess.Popen(["true"])
+        _, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = os.WEXITSTATUS(status)
+        summary = rusage_summary(rusage)
+        assert_that(summary).contains_key(
+            'user_cpu_seconds', 'system_cpu_seconds', 'max_rss_kb', 'block_input_operations',
+            'block_output_operations', 'voluntary_context_switches', 'involuntary_context_switches'
+        )
+        assert_that(summary['max_rss_kb']).is_greater_than(0)
@@ -0,0 +1,124 @@
+import unittest
+from assertpy import assert_that
+import tempfile
+import shutil
+import os
+
+from cron_tools.benchmarks.common import peak_concurrency
+from cron_tools.common.journal import EventJournal
+from cron_tools.wrapper.config import WrapperConfiguration
+from cron_tools.wrapper.main import main, wrapper_argument_parser, run_parts_scripts
+
+
+class WrapperRunPartsUnitTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.parts_directory = os.path.join(self.tempdir, "parts")
+        os.mkdir(self.parts_directory)
+        self.journal_path = os.path.join(self.tempdir, "journal")
+        self.config = WrapperConfiguration.load({
+            'agent_socket_path': os.path.join(self.tempdir, "test.socket"),
+            'journal_path': self.journal_path,
+            'journal_fsync': 'never',
+            'logging_config': {"version": 1, "incremental": True}
+        })
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def add_part(self, name, body, mode=0o755, interpreter="/bin/sh"):
+        path = os.path.join(self.parts_directory, name)
+        with open(path, 'w') as f:
+            f.write("#!{0}\n{1}\n".format(interpreter, body))
+        os.chmod(path, mode)
+        return path
+
+    def run_parts(self, *extra_args):
+        """
+        Runs the parts directory through the wrapper, reporting to the journal, and returns the exit status along
+        with the reported jobs by name: their start time, end time and status.
+        """
+        args = wrapper_argument_parser.parse_args(
+            args=["--report-mode", "journal", "--run-parts", self.parts_directory] + list(extra_args)
+        )
+        try:
+            main(args=args, config=self.config)
+            self.fail("The wrapper did not exit.")
+        except SystemExit as e:
+            exit_code = e.code
+        jobs = {}
+        with EventJournal(self.journal_path).drain() as events:
+            for event in events:
+                params = event["params"]
+                if event["method"] == "add_new_job":
+                    record = params["raw_job_record"]
+                    jobs[record["job_uuid"]] = [record["job_name"], record["job_start_time_utc_epoch_seconds"]]
+                else:
+                    jobs[params["job_uuid"]] += [params["job_end_time"], params["job_status_code"]]
+        return exit_code, dict((job[0], tuple(job[1:])) for job in jobs.values())
+
+    def test_run_parts_name_filtering(self):
+        """
+        Ensure only executable regular files with run-parts(8) names are run, in name order.
+        """
+        expected = [self.add_part(name, "exit 0") for name in ("10-first", "20_second", "30third")]
+        self.add_part("40-backup.bak", "exit 9")
+        self.add_part("50-editor~", "exit 9")
+        self.add_part(".60-hidden", "exit 9")
+        self.add_part("70-disabled", "exit 9", mode=0o644)
+        os.mkdir(os.path.join(self.parts_directory, "80-directory"))
+        assert_that(run_parts_scripts(self.parts_directory)).is_equal_to(expected)
+
+    def test_parallel_bound(self):
+        """
+        Ensure no more than --parallel jobs run at once, judging by when each job started and ended.
+        """
+        for i in range(5):
+            self.add_part("{0}-sleeper".format(i), "sleep 0.3")
+        exit_code, jobs = self.run_parts("--parallel", "2")
+        assert_that(exit_code).is_equal_to(0)
+        assert_that(jobs).is_length(5)
+        assert_that(peak_concurrency([(start, end) for start, end, _ in jobs.values()])).is_equal_to(2)
+
+        exit_code, jobs = self.run_parts("--parallel", "1")
+        assert_that(peak_concurrency([(start, end) for start, end, _ in jobs.values()])).is_equal_to(1)
+
+    def test_spawn_failure_and_batch_status(self):
+        """
+        Ensure a part that cannot be spawned is reported with status 127 while the rest still run, and that the
+        batch exits 1 if any part failed and 0 only if all of them succeeded.
+        """
+        self.add_part("10-first", "exit 0")
+        self.add_part("20-unspawnable", "exit 0", interpreter=os.path.join(self.tempdir, "no-such-interpreter"))
+        self.add_part("30-third", "exit 0")
+        exit_code, jobs = self.run_parts("--parallel", "2")
+        assert_that(exit_code).is_equal_to(1)
+        assert_that(dict((name, job[2]) for name, job in jobs.items())).is_equal_to(
+            {"parts/10-first": 0, "parts/20-unspawnable": 127, "parts/30-third": 0}
+        )
+
+        os.remove(os.path.join(self.parts_directory, "20-unspawnable"))
+        exit_code, jobs = self.run_parts()
+        assert_that(exit_code).is_equal_to(0)
+        assert_that(sorted(jobs)).is_equal_to(["parts/10-first", "parts/30-third"])
+
+        self.add_part("20-failing", "exit 3")
+        exit_code, jobs = self.run_parts()
+        assert_that(exit_code).is_equal_to(1)
+        assert_that(jobs["parts/20-failing"][2]).is_equal_to(3)
+
+    def test_parallel_must_be_positive(self):
+        """
+        Ensure --parallel below 1 is rejected as a usage error.
+        """
+        self.add_part("10-first", "exit 0")
+        for parallel in ("0", "-1"):
+            args = wrapper_argument_parser.parse_args(
+                args=["--report-mode", "journal", "--run-parts", self.parts_directory, "--parallel", parallel]
+            )
+            try:
+                main(args=args, config=self.config)
+                self.fail("--parallel {0} was accepted.".format(parallel))
+            except SystemExit as e:
+                assert_that(e.code).is_equal_to(2)
+        assert_that(os.path.exists(self.journal_path)).is_false()
@@ -0,0 +1,65 @@
+import unittest
+from assertpy import assert_that
+import signal
+import os
+
+from cron_tools.wrapper.spawn import spawn_child, popen_child, HAS_POSIX_SPAWN, SpawnedProcess
+
+
+def read_all(fd):
+    data = bytearray()
+    chunk = os.read(fd, 65536)
+    while chunk:
+        data.extend(chunk)
+        chunk = os.read(fd, 65536)
+    os.close(fd)
+    return bytes(data)
+
+
+def status_mask(status, field_name):
+    for line in status.decode('ascii').splitlines():
+        if line.startswith(field_name):
+            return int(line.split()[1], 16)
+    raise AssertionError("No {0} in status".format(field_name))
+
+
+class WrapperSpawnUnitTests(unittest.TestCase):
+    def spawn_and_read_status(self, **kwargs):
+        read_fd, write_fd = os.pipe()
+        inheritable_fd = os.dup(write_fd)
+        os.set_inheritable(inheritable_fd, True)
+        previous_mask = signal.pthread_sigmask(signal.SIG_BLOCK, [signal.SIGCHLD])
+        try:
+            process = spawn_child(
+                ["sh", "-c", "cat /proc/self/status; echo FDS; ls /proc/self/fd"], stdout=write_fd, **kwargs
+            )
+        finally:
+            signal.pthread_sigmask(signal.SIG_SETMASK, previous_mask)
+            os.close(write_fd)
+            os.close(inheritable_fd)
+        output = read_all(read_fd)
+        _, status = os.waitpid(process.pid, 0)
+        process.returncode = 0
+        assert_that(status).is_equal_to(0)
+        return process, output
+
+    def test_spawned_child_environment(self):
+        """
+        Ensure the child gets a clean signal mask, default SIGPIPE handling and no stray descriptors, on both paths.
+        """
+        for kwargs in ({}, {'preexec_fn': lambda: None}):
+            process, output = self.spawn_and_read_status(**kwargs)
+            status, _, fds = output.partition(b"FDS\n")
+            assert_that(status_mask(status, "SigBlk:") & (1 << (signal.SIGCHLD - 1))).is_equal_to(0)
+            assert_that(status_mask(status, "SigIgn:") & (1 << (signal.SIGPIPE - 1))).is_equal_to(0)
+            # stdin, stdout, stderr and the directory ls is reading.
+            assert_that(fds.split()).is_length(4)
+            if HAS_POSIX_SPAWN and not kwargs:
+                assert_that(process).is_instance_of(SpawnedProcess)
+
+    def test_spawn_of_missing_executable(self):
+        """
+        Ensure a missing executable raises in the wrapper, like Popen does.
+        """
+        assert_that(spawn_child).raises(OSError).when_called_with(["/nonexistent/executable"])
+        assert_that(popen_child).raises(OSError).when_called_with(["/nonexistent/executable"])
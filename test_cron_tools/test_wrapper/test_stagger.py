@@ -0,0 +1,36 @@
+import unittest
+from assertpy import assert_that
+
+from cron_tools.wrapper.stagger import choose_start_delay, hashed_start_delay
+
+
+class FailingReporter(object):
+    def request(self, method, params):
+        return None
+
+
+class AssigningReporter(object):
+    def request(self, method, params):
+        return {'delay_seconds': params['window_seconds'] * 2}
+
+
+class WrapperStaggerUnitTests(unittest.TestCase):
+    def test_hashed_delay_is_stable_and_spread(self):
+        """
+        Ensure the hashed delay depends only on host and job name and covers the window.
+        """
+        assert_that(hashed_start_delay("host", "job", 60)).is_equal_to(hashed_start_delay("host", "job", 60))
+        delays = [hashed_start_delay("host-{0}".format(i), "job", 60) for i in range(1000)]
+        assert_that(min(delays)).is_between(0, 3)
+        assert_that(max(delays)).is_between(57, 60)
+        assert_that(len([d for d in delays if d < 30])).is_between(400, 600)
+
+    def test_agent_mode_falls_back_to_hash(self):
+        """
+        Ensure agent assigned delays are clamped to the window, and the hash is used when the agent is not available.
+        """
+        assert_that(choose_start_delay(AssigningReporter(), "host", "job", 10, "agent")).is_equal_to(10)
+        assert_that(choose_start_delay(FailingReporter(), "host", "job", 10, "agent")).is_equal_to(
+            hashed_start_delay("host", "job", 10)
+        )
+        assert_that(choose_start_delay(FailingReporter(), "host", "job", 0, "agent")).is_equal_to(0)
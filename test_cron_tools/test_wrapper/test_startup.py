@@ -0,0 +1,48 @@
+import unittest
+from assertpy import assert_that
+import logging
+import sys
+from logging import config as logging_config_module
+
+from cron_tools.benchmarks.wrapper_startup import newly_loaded_modules, deferred_modules_loaded
+from cron_tools.wrapper.config import WrapperConfiguration, configure_logging
+
+
+class WrapperStartupUnitTests(unittest.TestCase):
+    def test_wrapper_import_defers_heavy_modules(self):
+        """
+        Ensure importing the wrapper entry point does not pull in modules it only needs on cold paths.
+        """
+        loaded_modules = newly_loaded_modules()
+        assert_that(loaded_modules).contains('cron_tools.wrapper.main')
+        assert_that(deferred_modules_loaded(loaded_modules)).is_empty()
+
+    def configured_logging_state(self, configure):
+        root_logger = logging.getLogger()
+        previous_handler = logging.StreamHandler(sys.stderr)
+        root_logger.addHandler(previous_handler)
+        existing_logger = logging.getLogger('cron_tools.test_existing_logger')
+        existing_logger.disabled = False
+        configure(WrapperConfiguration.OPTIONAL_PARAMETERS['logging_config'])
+        state = {
+            'root_level': root_logger.level,
+            'root_handlers': [
+                (type(h), h.name, h.level, h.formatter._fmt, h.stream is sys.stderr) for h in root_logger.handlers
+            ],
+            'previous_handler_removed': previous_handler not in root_logger.handlers,
+            'existing_logger_disabled': existing_logger.disabled
+        }
+        for handler in root_logger.handlers[:]:
+            root_logger.removeHandler(handler)
+        return state
+
+    def test_default_logging_matches_dict_config(self):
+        """
+        Ensure the default logging configuration, applied without logging.config, ends up as dictConfig() has it.
+        """
+        default_logging_config = WrapperConfiguration.OPTIONAL_PARAMETERS['logging_config']
+        expected = self.configured_logging_state(logging_config_module.dictConfig)
+        actual = self.configured_logging_state(lambda c: configure_logging(c, default_logging_config))
+        assert_that(actual).is_equal_to(expected)
+        assert_that(actual['root_handlers']).is_length(1)
+        assert_that(actual['existing_logger_disabled']).is_false()
@@ -0,0 +1,61 @@
+import unittest
+from assertpy import assert_that
+import time
+
+from cron_tools.common.output import decode_output_chunk
+from cron_tools.wrapper.streaming import OutputChunkBatcher
+from cron_tools.benchmarks.output_streaming import run_benchmark
+
+
+class RecordingReporter(object):
+    def __init__(self):
+        self.chunks = []
+
+    def job_output(self, job_uuid, stream_name, sequence_number, data, raw_length):
+        self.chunks.append((sequence_number, decode_output_chunk(data), raw_length))
+        return True
+
+
+class WrapperOutputStreamingUnitTests(unittest.TestCase):
+    def test_flush_on_size(self):
+        """
+        Ensure output is sent in order once enough of it has been buffered, with the rest sent on close.
+        """
+        reporter = RecordingReporter()
+        batcher = OutputChunkBatcher(reporter, "job-uuid", "stdout", flush_bytes=10, flush_interval=60)
+        batcher.write(memoryview(b"12345"))
+        assert_that(reporter.chunks).is_empty()
+        batcher.write(memoryview(b"6789012"))
+        batcher.write(memoryview(b"abc"))
+        assert_that(reporter.chunks).is_equal_to([(0, b"123456789012", 12)])
+        batcher.close()
+        assert_that(reporter.chunks[1:]).is_equal_to([(1, b"abc", 3)])
+        assert_that(batcher.bytes_sent).is_equal_to(15)
+        batcher.close()
+        assert_that(reporter.chunks).is_length(2)
+
+    def test_flush_on_time(self):
+        """
+        Ensure buffered output is only due once the flush interval has passed.
+        """
+        reporter = RecordingReporter()
+        batcher = OutputChunkBatcher(reporter, "job-uuid", "stderr", flush_bytes=1024, flush_interval=0.05)
+        assert_that(batcher.seconds_until_due()).is_none()
+        batcher.write(memoryview(b"partial"))
+        assert_that(batcher.seconds_until_due()).is_between(0, 0.05)
+        assert_that(batcher.run_if_due()).is_false()
+        time.sleep(0.06)
+        assert_that(batcher.seconds_until_due()).is_equal_to(0)
+        assert_that(batcher.run_if_due()).is_true()
+        assert_that(reporter.chunks).is_equal_to([(0, b"partial", 7)])
+        assert_that(batcher.seconds_until_due()).is_none()
+
+    def test_streaming_benchmark(self):
+        """
+        Ensure a small run of the streaming benchmark gets all output to the agent within its head/tail retention.
+        """
+        results = run_benchmark(output_bytes=8 * 1024 * 1024)
+        assert_that(results['last_sequence_number']).is_greater_than(8)
+        # Whole chunks are kept, so retention may overshoot by up to a chunk at each end.
+        assert_that(results['retained_raw_bytes']).is_between(2 * 1024 * 1024, 3 * 1024 * 1024)
+        assert_that(results['wrapper_max_rss_mb']).is_less_than(64)
@@ -0,0 +1,93 @@
+import unittest
+from assertpy import assert_that
+import subprocess
+import time
+import os
+
+from cron_tools.wrapper.capture import CapturedStream
+from cron_tools.wrapper.supervisor import BaseChildSupervisor, PidfdChildSupervisor, SignalfdChildSupervisor, \
+    monotonic
+
+
+class RecordingLogger(object):
+    def __init__(self):
+        self.messages = []
+
+    def info(self, message):
+        self.messages.append(message)
+
+
+class WrapperSupervisorUnitTests(unittest.TestCase):
+    def run_supervised(self, supervisor_class):
+        logger = RecordingLogger()
+        read_fd, write_fd = os.pipe()
+        stream = CapturedStream(read_fd, "stdout", mirror_logger=logger)
+        supervisor = supervisor_class([stream])
+        supervisor.prepare()
+        try:
+            start_time, start_monotonic = time.time(), monotonic()
+            process = subprocess.Popen(["sh", "-c", "echo hello; sleep 0.2; exit 3"], stdout=write_fd)
+            os.close(write_fd)
+            supervisor.attach(process.pid, start_time, start_monotonic)
+            child_exit = supervisor.wait()
+            process.returncode = child_exit.status_code
+        finally:
+            supervisor.close()
+            stream.close()
+        return child_exit, logger.messages
+
+    def check_supervisor(self, supervisor_class):
+        child_exit, messages = self.run_supervised(supervisor_class)
+        assert_that(child_exit.status_code).is_equal_to(3)
+        assert_that(child_exit.duration).is_greater_than_or_equal_to(0.2).is_less_than(5)
+        assert_that(child_exit.end_time).is_close_to(time.time(), 5)
+        assert_that(child_exit.rusage).is_not_none()
+        assert_that(messages).is_equal_to(["CAPTURED (STDOUT): hello"])
+
+    def check_supervisor_pool(self, supervisor_class):
+        """
+        Ensure on_exit callbacks can keep adding children and every child is reaped with its own streams.
+        """
+        supervisor = supervisor_class()
+        supervisor.prepare()
+        pending = ["exit 1", "echo two; exit 2", "exit 3"]
+        exits = []
+        logger = RecordingLogger()
+
+        def start_next(child_exit=None):
+            if child_exit is not None:
+                exits.append(child_exit.status_code)
+            if pending:
+                read_fd, write_fd = os.pipe()
+                stream = CapturedStream(read_fd, "stdout", mirror_logger=logger)
+                start_time, start_monotonic = time.time(), monotonic()
+                process = subprocess.Popen(["sh", "-c", pending.pop(0)], stdout=write_fd)
+                os.close(write_fd)
+                supervisor.add_child(process.pid, start_time, start_monotonic, [stream], on_exit=start_next)
+                process.returncode = 0
+
+        try:
+            start_next()
+            start_next()
+            supervisor.run()
+        finally:
+            supervisor.close()
+        assert_that(sorted(exits)).is_equal_to([1, 2, 3])
+        assert_that(supervisor.children).is_empty()
+        assert_that(logger.messages).is_equal_to(["CAPTURED (STDOUT): two"])
+
+    def test_pidfd_supervisor(self):
+        if not PidfdChildSupervisor.available():
+            self.skipTest("pidfd_open is not available on this system.")
+        self.check_supervisor(PidfdChildSupervisor)
+        self.check_supervisor_pool(PidfdChildSupervisor)
+
+    def test_signalfd_supervisor(self):
+        self.check_supervisor(SignalfdChildSupervisor)
+        self.check_supervisor_pool(SignalfdChildSupervisor)
+
+    def test_supervisors_implement_poll(self):
+        """
+        Ensure the base supervisor cannot be used without the poll() of a concrete one.
+        """
+        self.assertRaises(TypeError, BaseChildSupervisor)